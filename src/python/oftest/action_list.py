@@ -5,6 +5,10 @@ OpenFlow actions list class
 from action import *
 from cstruct import ofp_header
 import copy
+import struct
+
+# Type and length at the start of every action
+_action_type_len = struct.Struct("!HH")
 
 # # Map OFP action identifiers to the actual structures used on the wire
 # action_object_map = {
@@ -85,26 +89,52 @@ class action_list(object):
         @return The remainder of binary_string that was not parsed
 
         """
-        if bytes == None:
-            bytes = len(binary_string)
-        bytes_done = 0
-        count = 0
-        cur_string = binary_string
-        while bytes_done < bytes:
-            hdr = ofp_action_header()
-            hdr.unpack(cur_string)
-            if hdr.len < OFP_ACTION_HEADER_BYTES:
+        offset = self.unpack_from(binary_string, 0, bytes)
+        return binary_string[offset:]
+
+    def unpack_from(self, buffer, offset=0, bytes=None):
+        """
+        Unpack a list of actions from buffer at offset
+
+        Each action is unpacked in place with its unpack_from, so the
+        buffer is never sliced.  Plain output actions, which most flows
+        carry, are created without running __init__ since unpack_from
+        sets every member.
+
+        @param buffer A string, buffer or memoryview holding the list
+        @param offset Offset of the first action in buffer
+        @param bytes The total length of the action list in bytes.  If
+        None, the list is assumed to extend through the end of buffer.
+        @return The offset following the last action parsed
+
+        """
+        end = len(buffer)
+        if bytes != None:
+            end = min(end, offset + bytes)
+        actions = self.actions
+        while offset < end:
+            if end - offset < OFP_ACTION_HEADER_BYTES:
                 print "ERROR: Action too short"
                 break
-            if not hdr.type in action_object_map.keys():
-                print "WARNING: Skipping unknown action ", hdr.type, hdr.len
+            (act_type, act_len) = _action_type_len.unpack_from(buffer, offset)
+            if act_len < OFP_ACTION_HEADER_BYTES:
+                print "ERROR: Action too short"
+                break
+            if offset + act_len > end:
+                print "ERROR: Action truncated"
+                break
+            if act_type == OFPAT_OUTPUT and act_len == OFP_ACTION_OUTPUT_BYTES:
+                act = action_output.__new__(action_output)
+                act.unpack_from(buffer, offset)
+                actions.append(act)
+            elif not act_type in action_object_map:
+                print "WARNING: Skipping unknown action ", act_type, act_len
             else:
-                self.actions.append(action_object_map[hdr.type]())
-                self.actions[count].unpack(cur_string)
-                count += 1
-            cur_string = cur_string[hdr.len:]
-            bytes_done += hdr.len
-        return cur_string
+                act = action_object_map[act_type]()
+                act.unpack_from(buffer, offset)
+                actions.append(act)
+            offset += act_len
+        return offset
 
     def add(self, action):
         """
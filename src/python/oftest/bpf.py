@@ -0,0 +1,220 @@
+"""
+OpenFlow Test Framework
+
+Classic BPF filter programs for dataplane sockets
+
+Compiles an ignore list (ethertypes, MAC address ranges, VLAN ids) and
+a set of expected packets into a classic BPF program that can be
+attached to a dataplane port socket with SO_ATTACH_FILTER.  Frames
+rejected by the program are dropped in the kernel and never reach the
+port queue.
+
+A program is a list of (code, jt, jf, k) tuples; filter_pack converts
+it into the struct sock_filter array expected by the kernel.
+
+The program is laid out as a sequence of blocks.  Each ignore rule is
+a block that ends in "ret #0"; a frame that does not match the rule
+jumps over the rest of the block.  If expected packets are given, each
+one is a block that ends in "ret #ACCEPT" and a frame that fails any
+comparison jumps to the next block; a frame matching none of them is
+dropped.
+"""
+
+import struct
+
+# From linux/filter.h
+BPF_LD   = 0x00
+BPF_ALU  = 0x04
+BPF_JMP  = 0x05
+BPF_RET  = 0x06
+BPF_W    = 0x00
+BPF_H    = 0x08
+BPF_B    = 0x10
+BPF_ABS  = 0x20
+BPF_AND  = 0x50
+BPF_JEQ  = 0x10
+BPF_K    = 0x00
+
+SKF_AD_OFF              = 0xfffff000  # -0x1000 as a u32
+SKF_AD_VLAN_TAG         = 44
+SKF_AD_VLAN_TAG_PRESENT = 48
+
+# Returned for accepted frames: the number of bytes to keep
+ACCEPT_SNAPLEN = 0x40000
+
+# Bytes of each expected packet compared by its block; jump offsets
+# are 8 bits so a block must stay well under 256 instructions
+EXP_PKT_CMP_BYTES = 128
+
+ETH_P_8021Q = 0x8100
+
+# Commonly ignored control plane chatter
+NOISE_DL_DST = [
+    "01:80:c2:00:00:00/ff:ff:ff:ff:ff:f0", # STP, LLDP, LACP, ...
+    "33:33:00:00:00:00/ff:ff:00:00:00:00"  # IPv6 multicast (ND)
+]
+NOISE_DL_TYPE = [
+    0x88cc,                                # LLDP
+    0x86dd                                 # IPv6
+]
+
+def _ld(size, k):
+    return (BPF_LD | size | BPF_ABS, 0, 0, k)
+
+def _and(k):
+    return (BPF_ALU | BPF_AND | BPF_K, 0, 0, k)
+
+def _jeq(k, jt, jf):
+    return (BPF_JMP | BPF_JEQ | BPF_K, jt, jf, k)
+
+def _ret(k):
+    return (BPF_RET | BPF_K, 0, 0, k)
+
+def _mac_parse(spec):
+    """
+    Parse a MAC address range
+
+    @param spec A MAC string '00:01:02:03:04:05', a string with a mask
+    '01:80:c2:00:00:00/ff:ff:ff:ff:ff:f0' or a (mac, mask) pair of strings
+    @return Pair of 6 byte strings (addr, mask)
+    """
+    if isinstance(spec, tuple):
+        (mac, mask) = spec
+    elif "/" in spec:
+        (mac, mask) = spec.split("/")
+    else:
+        (mac, mask) = (spec, "ff:ff:ff:ff:ff:ff")
+    to_bytes = lambda s: "".join([chr(int(x, 16)) for x in s.split(":")])
+    return (to_bytes(mac), to_bytes(mask))
+
+def _cmp_list(data, offset, mask=None):
+    """
+    Generate (code, offset, mask, value) comparisons covering data
+
+    @param data The byte string to compare
+    @param offset The frame offset at which data should appear
+    @param mask Optional byte string of the same length as data
+    """
+    cmps = []
+    idx = 0
+    for (size, code, fmt) in [(4, BPF_W, "!I"), (2, BPF_H, "!H"),
+                              (1, BPF_B, "!B")]:
+        while len(data) - idx >= size:
+            (value,) = struct.unpack(fmt, data[idx:idx + size])
+            full = (1 << (size * 8)) - 1
+            if mask is None:
+                m = full
+            else:
+                (m,) = struct.unpack(fmt, mask[idx:idx + size])
+            if m != 0:
+                cmps.append((code, offset + idx, m, value & m))
+            idx += size
+    return cmps
+
+def _block(cmps, ret):
+    """
+    Build a block that executes ret if every comparison matches
+
+    On the first mismatch control jumps past the end of the block.
+    """
+    insns = []
+    for (code, k, mask, value) in cmps:
+        insns.append(_ld(code, k))
+        if mask != (1 << {BPF_W: 32, BPF_H: 16, BPF_B: 8}[code]) - 1:
+            insns.append(_and(mask))
+        insns.append(None) # placeholder for jeq
+    insns.append(_ret(ret))
+    values = iter([value for (code, k, mask, value) in cmps])
+    for idx in range(len(insns)):
+        if insns[idx] is None:
+            insns[idx] = _jeq(values.next(), 0, len(insns) - idx - 1)
+    return insns
+
+def _vlan_block(cmps_tagged, vid, ret):
+    """
+    Build a block matching frames carrying VLAN id vid
+
+    The kernel moves the tag into packet metadata, so it is read with
+    the ancillary VLAN loads rather than from the frame data.
+    @param cmps_tagged Further comparisons on the (untagged) frame data
+    @param vid Pair (value, mask) compared against the TCI
+    """
+    body = _block(cmps_tagged, ret)
+    insns = [_ld(BPF_W, SKF_AD_OFF + SKF_AD_VLAN_TAG_PRESENT)]
+    insns.append(_jeq(0, 0, 0)) # patched below
+    insns.append(_ld(BPF_W, SKF_AD_OFF + SKF_AD_VLAN_TAG))
+    insns.append(_and(vid[1]))
+    insns.append(None)
+    size = len(insns) + len(body)
+    insns[1] = _jeq(0, size - 2, 0)
+    insns[4] = _jeq(vid[0], 0, size - 5)
+    return insns + body
+
+def _untagged_block(cmps, ret):
+    """
+    Build a block matching only frames that carried no VLAN tag
+    """
+    body = _block(cmps, ret)
+    return [_ld(BPF_W, SKF_AD_OFF + SKF_AD_VLAN_TAG_PRESENT),
+            _jeq(0, 0, len(body))] + body
+
+def filter_compile(ignore_dl_type=[], ignore_dl_dst=[], ignore_dl_src=[],
+                   ignore_vlan=[], exp_pkts=None):
+    """
+    Compile an ignore list and expected packets into a BPF program
+
+    @param ignore_dl_type List of ethertypes to drop
+    @param ignore_dl_dst List of destination MAC ranges to drop
+    @param ignore_dl_src List of source MAC ranges to drop
+    @param ignore_vlan List of VLAN ids to drop
+    @param exp_pkts If not None, a list of packets (strings, scapy
+    objects or dataplane.ExpectedPacket); only frames that start with
+    one of them are accepted.  At most EXP_PKT_CMP_BYTES bytes of each
+    are compared.  The don't care bits of a dataplane.MaskedPacket are
+    not compared.
+    @return List of (code, jt, jf, k) instructions
+    """
+    prog = []
+    for dl_type in ignore_dl_type:
+        prog.extend(_block([(BPF_H, 12, 0xffff, dl_type)], 0))
+    for (spec_list, offset) in [(ignore_dl_dst, 0), (ignore_dl_src, 6)]:
+        for spec in spec_list:
+            (mac, mask) = _mac_parse(spec)
+            prog.extend(_block(_cmp_list(mac, offset, mask), 0))
+    for vid in ignore_vlan:
+        prog.extend(_vlan_block([], (vid, 0xfff), 0))
+
+    if exp_pkts is None:
+        prog.append(_ret(ACCEPT_SNAPLEN))
+        return prog
+
+    for pkt in exp_pkts:
+        data = str(pkt)[:EXP_PKT_CMP_BYTES]
+        mask = getattr(pkt, "mask", None)
+        if mask is None:
+            mask = "\xff" * len(data)
+        mask = mask[:EXP_PKT_CMP_BYTES]
+        (dl_type,) = struct.unpack("!H", data[12:14])
+        if dl_type == ETH_P_8021Q and len(data) >= 16:
+            (tci,) = struct.unpack("!H", data[14:16])
+            (tci_mask,) = struct.unpack("!H", mask[14:16])
+            # Ignore CFI; older kernels use that bit internally
+            tci_mask &= 0xefff
+            cmps = _cmp_list(data[:12], 0, mask[:12]) + \
+                _cmp_list(data[16:], 12, mask[16:])
+            prog.extend(_vlan_block(cmps, (tci & tci_mask, tci_mask),
+                                    ACCEPT_SNAPLEN))
+        else:
+            prog.extend(_untagged_block(_cmp_list(data, 0, mask),
+                                        ACCEPT_SNAPLEN))
+    prog.append(_ret(0))
+    return prog
+
+def filter_pack(prog):
+    """
+    Pack a program into an array of struct sock_filter
+    @param prog List of (code, jt, jf, k) instructions
+    @return The packed string
+    """
+    return "".join([struct.pack("HBBI", code, jt, jf, k)
+                    for (code, jt, jf, k) in prog])
@@ -15,7 +15,12 @@ poll calls.
 
 Callbacks and polling support specifying the message type
 
-@todo Support transaction semantics via xid
+Requests that expect a reply are tracked by xid in a transaction table,
+so any number of them can be outstanding and complete in any order:
+
+    xacts = [ctrl.transact_start(req) for req in requests]
+    replies = ctrl.transact_wait_all(xacts)
+
 @todo Support select and listen on an administrative socket (or
 use a timeout to support clean shutdown).
 
@@ -32,9 +37,11 @@ import time
 from threading import Thread
 from threading import Lock
 from threading import Condition
+from collections import deque
 from message import *
 from parse import *
 from ofutils import *
+from framing import MessageFramer
 # For some reason, it seems select to be last (or later).
 # Otherwise get an attribute error when calling select.select
 import select
@@ -64,6 +71,38 @@ def hex_dump_buffer(src, length=16):
 RCV_SIZE_DEFAULT = 32768
 LISTEN_QUEUE_SIZE = 1
 
+class Transaction:
+    """
+    A request sent to the switch that is waiting for its reply
+
+    Created by Controller.transact_start.  The controller thread
+    completes it with the first message received with the same xid.
+
+    @var xid The transaction id
+    @var msg The request message object
+    @var data The request as packed when it was sent; unlike msg it does
+    not change if msg is a MessageTemplate that is stamped again
+    @var response The reply as a (msg, rawmsg) pair, or None
+    @var rcv_time The receive time of the reply, from ofutils.timestamp()
+    @var finished True once a reply arrived or the transaction was cancelled
+    """
+
+    def __init__(self, msg, data=None):
+        self.xid = msg.header.xid
+        self.msg = msg
+        self.data = data
+        self.response = None
+        self.rcv_time = None
+        self.finished = False
+
+    def result(self):
+        """
+        @return The (msg, rawmsg) reply, or (None, None) if there is none
+        """
+        if self.response is None:
+            return (None, None)
+        return self.response
+
 class Controller(Thread):
     """
     Class abstracting the control interface to the switch.  
@@ -92,6 +131,8 @@ class Controller(Thread):
     @var packets_expired Number of packets popped from queue as queue full
     @var packets_handled Number of packets handled by something
     @var dbg_state Debug indication of state
+    @var lazy_decode If true, message bodies are unpacked on first use
+    rather than in the controller thread (see parse.LazyMessage)
     """
 
     def __init__(self, host='127.0.0.1', port=6633, max_pkts=1024):
@@ -119,11 +160,23 @@ class Controller(Thread):
         self.keep_alive = False
         self.active = True
         self.initial_hello = True
-
-        # OpenFlow message/packet queue
-        # Protected by the packets_cv lock / condition variable
-        self.packets = []
-        self.packets_cv = Condition()
+        self.lazy_decode = True
+
+        # OpenFlow message/packet queue, indexed by message type
+        # Protected by packets_lock
+        #   packets: Map from message type to a deque of
+        #            (seq, msg, rawmsg, rcv_time) in arrival order
+        #   packets_len: Number of messages queued over all types
+        #   packets_seq: Arrival sequence number of the next message
+        #   packets_cv: Condition variable for pollers of any type
+        #   type_cvs: Map from message type to the condition variable
+        #             for pollers of that type only
+        self.packets = {}
+        self.packets_len = 0
+        self.packets_seq = 0
+        self.packets_lock = Lock()
+        self.packets_cv = Condition(self.packets_lock)
+        self.type_cvs = {}
 
         # Settings
         self.max_pkts = max_pkts
@@ -138,15 +191,13 @@ class Controller(Thread):
         self.pkt_in_dropped = 0 # Total dropped packet ins
         self.transact_to = 15 # Transact timeout default value; add to config
 
-        # Transaction and message type waiting variables 
-        #   xid_cv: Condition variable (semaphore) for packet waiters
-        #   xid: Transaction ID being waited on
-        #   xid_response: Transaction response message
+        # Outstanding transactions
+        #   xid_cv: Condition variable (semaphore) for transaction waiters
+        #   transactions: Map from xid to pending Transaction object
         self.xid_cv = Condition()
-        self.xid = None
-        self.xid_response = None
+        self.transactions = {}
 
-        self.buffered_input = ""
+        self.framer = MessageFramer(self.rcv_size)
 
     def filter_packet(self, rawmsg, hdr):
         """
@@ -168,7 +219,7 @@ class Controller(Thread):
 
         return False
 
-    def _pkt_handle(self, pkt):
+    def _pkt_handle(self, pkt=None, rcv_time=None):
         """
         Check for all packet handling conditions
 
@@ -181,38 +232,41 @@ class Controller(Thread):
 
         an echo request in case keep_alive is true, followed by
         registered message handlers.
-        @param pkt The raw packet (string) which may contain multiple OF msgs
-        """
-
-        # snag any left over data from last read()
-        pkt = self.buffered_input + pkt
-        self.buffered_input = ""
-
-        # Process each of the OF msgs inside the pkt
-        offset = 0
-        while offset < len(pkt):
-            # Parse the header to get type
-            hdr = of_header_parse(pkt[offset:])
-            if not hdr or hdr.length == 0:
-                self.logger.error("Could not parse header")
-                self.logger.error("pkt len %d." % len(pkt))
-                if hdr:
-                    self.logger.error("hdr len %d." % hdr.length)
-                self.logger.error("%s" % hex_dump_buffer(pkt[:200]))
+        Messages are taken from the framer, which holds any partial
+        message left over from the last read.
+
+        @param pkt Raw bytes (string) to add to the framer first, if any
+        @param rcv_time The time the data was read, from ofutils.timestamp()
+        """
+        if rcv_time is None:
+            rcv_time = timestamp()
+        if pkt:
+            self.framer.feed(pkt)
+
+        # Process each complete OF msg in the framer
+        while True:
+            try:
+                view = self.framer.next_message()
+            except Exception, e:
+                self.logger.error("Could not parse header: " + str(e))
+                self.logger.error("buf len %d." % len(self.framer))
+                self.logger.error("%s" %
+                                  hex_dump_buffer(self.framer.peek(200)))
                 self.kill()
                 return
-
-            # Extract the raw message bytes
-            if (offset + hdr.length) > len(pkt):
+            if view is None:
                 break
-            rawmsg = pkt[offset : offset + hdr.length]
-            offset += hdr.length
+
+            # The one copy of the message bytes that is kept
+            rawmsg = view.tobytes()
+            hdr = of_header_parse(rawmsg)
 
             if self.filter_packet(rawmsg, hdr):
                 continue
 
             self.logger.debug("Msg in: buf len %d. hdr.type %s. hdr.len %d" %
-                              (len(pkt), ofp_type_map[hdr.type], hdr.length))
+                              (len(self.framer), ofp_type_map[hdr.type],
+                               hdr.length))
             if hdr.version != OFP_VERSION:
                 self.logger.error("Version %d does not match OFTest version %d"
                                   % (hdr.version, OFP_VERSION))
@@ -222,7 +276,7 @@ class Controller(Thread):
                 self.switch_socket = None
                 return
 
-            msg = of_message_parse(rawmsg)
+            msg = of_message_parse(rawmsg, lazy=self.lazy_decode)
             if not msg:
                 self.parse_errors += 1
                 self.logger.warn("Could not parse message")
@@ -231,11 +285,13 @@ class Controller(Thread):
             with self.sync:
                 # Check if transaction is waiting
                 with self.xid_cv:
-                    if self.xid and hdr.xid == self.xid:
+                    trans = self.transactions.pop(hdr.xid, None)
+                    if trans:
                         self.logger.debug("Matched expected XID " + str(hdr.xid))
-                        self.xid_response = (msg, rawmsg)
-                        self.xid = None
-                        self.xid_cv.notify()
+                        trans.response = (msg, rawmsg)
+                        trans.rcv_time = rcv_time
+                        trans.finished = True
+                        self.xid_cv.notify_all()
                         continue
 
                 # Check if keep alive is set; if so, respond to echo requests
@@ -259,21 +315,55 @@ class Controller(Thread):
 
                 if not handled: # Not handled, enqueue
                     self.logger.debug("Enqueuing pkt type " + ofp_type_map[hdr.type])
-                    with self.packets_cv:
-                        if len(self.packets) >= self.max_pkts:
-                            self.packets.pop(0)
-                            self.packets_expired += 1
-                        self.packets.append((msg, rawmsg))
-                        self.packets_cv.notify_all()
+                    with self.packets_lock:
+                        self._enqueue(hdr.type, msg, rawmsg, rcv_time)
                     self.packets_total += 1
                 else:
                     self.packets_handled += 1
                     self.logger.debug("Message handled by callback")
 
-        # end of 'while offset < len(pkt)'
-        #   note that if offset = len(pkt), this is
-        #   appends a harmless empty string
-        self.buffered_input += pkt[offset:]
+    def _enqueue(self, msg_type, msg, rawmsg, rcv_time):
+        """
+        Queue a message for poll and wake the pollers that want it
+
+        The caller must hold packets_lock.  If the queue is full the
+        oldest message of any type is thrown away.
+        """
+        if self.packets_len >= self.max_pkts:
+            self._dequeue()
+            self.packets_expired += 1
+        queue = self.packets.get(msg_type)
+        if queue is None:
+            queue = self.packets[msg_type] = deque()
+        queue.append((self.packets_seq, msg, rawmsg, rcv_time))
+        self.packets_seq += 1
+        self.packets_len += 1
+        self.packets_cv.notify_all()
+        cv = self.type_cvs.get(msg_type)
+        if cv is not None:
+            cv.notify_all()
+
+    def _dequeue(self, msg_type=None):
+        """
+        Remove the oldest queued message of a type
+
+        The caller must hold packets_lock.
+        @param msg_type The message type, or None for the oldest message
+        of any type
+        @return The triple (msg, rawmsg, rcv_time) or None if none is queued
+        """
+        if msg_type is None:
+            queue = None
+            for q in self.packets.values():
+                if q and (queue is None or q[0][0] < queue[0][0]):
+                    queue = q
+        else:
+            queue = self.packets.get(msg_type)
+        if not queue:
+            return None
+        (seq, msg, rawmsg, rcv_time) = queue.popleft()
+        self.packets_len -= 1
+        return (msg, rawmsg, rcv_time)
 
     def _socket_ready_handle(self, s):
         """
@@ -304,7 +394,8 @@ class Controller(Thread):
         elif s and s == self.switch_socket:
             for idx in range(3): # debug: try a couple of times
                 try:
-                    pkt = self.switch_socket.recv(self.rcv_size)
+                    count = self.framer.recv(self.switch_socket)
+                    rcv_time = timestamp()
                 except:
                     self.logger.warning("Error on switch read")
                     return -1
@@ -312,17 +403,17 @@ class Controller(Thread):
                 if not self.active:
                     return 0
       
-                if len(pkt) == 0:
+                if count == 0:
                     self.logger.warning("Zero-length switch read, %d" % idx)
                 else:
                     break
 
-            if len(pkt) == 0: # Still no packet
+            if count == 0: # Still no packet
                 self.logger.warning("Zero-length switch read; closing cxn")
                 self.logger.info(str(self))
                 return -1
 
-            self._pkt_handle(pkt)
+            self._pkt_handle(rcv_time=rcv_time)
         else:
             self.logger.error("Unknown socket ready: " + str(s))
             return -1
@@ -455,67 +546,217 @@ class Controller(Thread):
             return
         self.handlers[msg_type] = handler
 
-    def poll(self, exp_msg=None, timeout=-1):
+    def poll(self, exp_msg=None, timeout=-1, with_time=False):
         """
         Wait for the next OF message received from the switch.
 
         @param exp_msg If set, return only when this type of message 
-        is received (unless timeout occurs).
+        is received (unless timeout occurs).  A false value, including 0,
+        means any message.
 
         @param timeout Maximum number of seconds to wait for the message.
         Pass -1 for the default timeout.
 
+        @param with_time If True, also return the receive time
+
         @retval A pair (msg, pkt) where msg is a message object and pkt
         the string representing the packet as received from the socket.
         This allows additional parsing by the receiver if necessary.
+        With with_time, a triple (msg, pkt, rcv_time) where rcv_time is
+        on the same clock as the dataplane pkt_time.
 
         The data members in the message are in host endian order.
         If an error occurs, (None, None) is returned
         """
 
-        if exp_msg:
+        if not exp_msg:
+            exp_msg = None
+        if exp_msg is not None:
             self.logger.debug("Poll for %s" % ofp_type_map[exp_msg])
         else:
             self.logger.debug("Poll for any OF message")
 
-        # Take the packet from the queue
+        # Take the packet from the queue.  Pollers for one type wait on
+        # their own condition variable, so other arrivals do not wake them.
         def grab():
-            if len(self.packets) > 0:
-                if not exp_msg:
-                    self.logger.debug("Looking for any packet")
-                    (msg, pkt) = self.packets.pop(0)
-                    return (msg, pkt)
-                else:
-                    self.logger.debug("Looking for %s" % ofp_type_map[exp_msg])
-                    for i in range(len(self.packets)):
-                        msg = self.packets[i][0]
-                        self.logger.debug("Checking packets[%d] (%s)" % (i, ofp_type_map[msg.header.type]))
-                        if msg.header.type == exp_msg:
-                            (msg, pkt) = self.packets.pop(i)
-                            return (msg, pkt)
-            # Not found
-            self.logger.debug("Packet not in queue")
-            return None
+            return self._dequeue(exp_msg)
 
-        with self.packets_cv:
-            ret = timed_wait(self.packets_cv, grab, timeout=timeout)
+        with self.packets_lock:
+            if exp_msg is not None:
+                cv = self.type_cvs.get(exp_msg)
+                if cv is None:
+                    cv = self.type_cvs[exp_msg] = Condition(self.packets_lock)
+            else:
+                cv = self.packets_cv
+            ret = timed_wait(cv, grab, timeout=timeout)
 
         if ret != None:
-            (msg, pkt) = ret
+            (msg, pkt, rcv_time) = ret
             self.logger.debug("Got message %s" % str(msg))
+            if with_time:
+                return (msg, pkt, rcv_time)
             return (msg, pkt)
+        elif with_time:
+            return (None, None, None)
         else:
             return (None, None)
 
+    def transact_start(self, msg, zero_xid=False):
+        """
+        Send a request and return without waiting for the reply
+
+        The transaction is entered in the table before the message is
+        sent, so the reply cannot be missed.  Replies have the highest
+        priority in received message handling: they are never queued
+        for poll or passed to handlers.
+
+        @param msg The message object or MessageTemplate to send; must
+        not be a string
+        @param zero_xid Normally, if the XID is 0 an XID will be generated
+        for the message.  Set zero_xid to override this behavior
+        @return A Transaction object to pass to transact_wait_all or
+        transact_wait_any
+        """
+
+        return self.transact_start_batch([msg], zero_xid=zero_xid)[0]
+
+    def transact_start_batch(self, msgs, zero_xid=False):
+        """
+        Send several requests in one write and return without waiting
+
+        As transact_start, for each message.  Each message is packed as
+        it is taken from msgs, so msgs may be a generator that restamps
+        one MessageTemplate.  A request whose reply is an error, e.g. a
+        flow_mod, completes its transaction with the error message.
+
+        @param msgs List or iterable of message objects or
+        MessageTemplates to send
+        @param zero_xid See transact_start
+        @return List of Transaction objects in the order of msgs
+        """
+
+        transactions = []
+        data = []
+        for msg in msgs:
+            if not zero_xid and msg.header.xid == 0:
+                msg.header.xid = gen_xid()
+            packed = msg.pack()
+            transactions.append(Transaction(msg, packed))
+            data.append(packed)
+        if not transactions:
+            return transactions
+
+        with self.xid_cv:
+            xids = set()
+            for trans in transactions:
+                if trans.xid in self.transactions or trans.xid in xids:
+                    raise Exception("Transaction %d already outstanding" %
+                                    trans.xid)
+                xids.add(trans.xid)
+            for trans in transactions:
+                self.transactions[trans.xid] = trans
+
+        if len(transactions) == 1:
+            self.logger.debug("Running transaction %d" % transactions[0].xid)
+        else:
+            self.logger.debug("Running %d transactions" % len(transactions))
+        try:
+            if self.message_send("".join(data)) < 0:
+                self.logger.error("Error sending pkt for %d transactions" %
+                                  len(transactions))
+                self.transact_cancel(transactions)
+        except:
+            self.transact_cancel(transactions)
+            raise
+        return transactions
+
+    def transact_cancel(self, transactions):
+        """
+        Stop waiting for the replies to some transactions
+
+        A reply that arrives later is handled like any other message.
+
+        @param transactions List of Transaction objects
+        """
+        with self.xid_cv:
+            for trans in transactions:
+                if self.transactions.get(trans.xid) is trans:
+                    del self.transactions[trans.xid]
+                trans.finished = True
+            self.xid_cv.notify_all()
+
+    def transact_wait_all(self, transactions, timeout=-1):
+        """
+        Wait until every transaction in a batch has completed
+
+        Transactions still pending when the timeout expires are cancelled.
+
+        @param transactions List of Transaction objects
+        @param timeout The timeout in seconds for the whole batch; if -1
+        use default.
+        @return List of (msg, rawmsg) replies in the order of transactions,
+        with (None, None) for each transaction that got no reply
+        """
+        def all_finished():
+            for trans in transactions:
+                if not trans.finished:
+                    return None
+            return True
+
+        with self.xid_cv:
+            timed_wait(self.xid_cv, all_finished, timeout=timeout)
+        pending = [trans for trans in transactions if not trans.finished]
+        if pending:
+            self.logger.warning("No response for xids " +
+                                str([trans.xid for trans in pending]))
+            self.transact_cancel(pending)
+        return [trans.result() for trans in transactions]
+
+    def transact_wait_any(self, transactions, timeout=-1):
+        """
+        Wait until any transaction in a batch has completed
+
+        Nothing is cancelled on timeout.  To process replies as they
+        arrive, remove each returned transaction from the list and call
+        again until the list is empty.
+
+        @param transactions List of Transaction objects
+        @param timeout The timeout in seconds; if -1 use default.
+        @return A finished Transaction from the list, or None on timeout
+        """
+        def first_finished():
+            for trans in transactions:
+                if trans.finished:
+                    return trans
+            return None
+
+        with self.xid_cv:
+            return timed_wait(self.xid_cv, first_finished, timeout=timeout)
+
+    def transact_batch(self, msgs, timeout=-1, zero_xid=False):
+        """
+        Pipeline a list of requests and wait for all the replies
+
+        @param msgs List of message objects or MessageTemplates to send
+        @param timeout The timeout in seconds for the whole batch; if -1
+        use default.
+        @param zero_xid See transact_start
+        @return List of (msg, rawmsg) replies in the order of msgs,
+        with (None, None) for each request that got no reply
+        """
+        transactions = self.transact_start_batch(msgs, zero_xid=zero_xid)
+        return self.transact_wait_all(transactions, timeout=timeout)
+
     def transact(self, msg, timeout=-1, zero_xid=False):
         """
         Run a message transaction with the switch
 
         Send the message in msg and wait for a reply with a matching
-        transaction id.  Transactions have the highest priority in
-        received message handling.
+        transaction id.  Any number of transactions may be run at once
+        from different threads.
 
-        @param msg The message object to send; must not be a string
+        @param msg The message object or MessageTemplate to send; must
+        not be a string
         @param timeout The timeout in seconds; if -1 use default.
         @param zero_xid Normally, if the XID is 0 an XID will be generated
         for the message.  Set zero_xid to override this behavior
@@ -523,42 +764,16 @@ class Controller(Thread):
 
         """
 
-        if not zero_xid and msg.header.xid == 0:
-            msg.header.xid = gen_xid()
-
-        self.logger.debug("Running transaction %d" % msg.header.xid)
-
-        with self.xid_cv:
-            if self.xid:
-                self.logger.error("Can only run one transaction at a time")
-                return (None, None)
-
-            self.xid = msg.header.xid
-            self.xid_response = None
-            if self.message_send(msg.pack()) < 0:
-                self.logger.error("Error sending pkt for transaction %d" %
-                                  msg.header.xid)
-                return (None, None)
-
-            self.logger.debug("Waiting for transaction %d" % msg.header.xid)
-            timed_wait(self.xid_cv, lambda: self.xid_response, timeout=timeout)
-
-            if self.xid_response:
-                (resp, pkt) = self.xid_response
-                self.xid_response = None
-            else:
-                (resp, pkt) = (None, None)
-
-        if resp is None:
-            self.logger.warning("No response for xid " + str(self.xid))
-        return (resp, pkt)
+        trans = self.transact_start(msg, zero_xid=zero_xid)
+        self.logger.debug("Waiting for transaction %d" % trans.xid)
+        return self.transact_wait_all([trans], timeout=timeout)[0]
 
     def message_send(self, msg, zero_xid=False):
         """
         Send the message to the switch
 
-        @param msg A string or OpenFlow message object to be forwarded to
-        the switch.
+        @param msg A string, bytearray or OpenFlow message object to be
+        forwarded to the switch.
         @param zero_xid If msg is an OpenFlow object (not a string) and if
         the XID in the header is 0, then an XID will be generated
         for the message.  Set zero_xid to override this behavior (and keep an
@@ -572,7 +787,7 @@ class Controller(Thread):
             # Sending a string indicates the message is ready to go
             raise Exception("no socket")
         #@todo If not string, try to pack
-        if type(msg) != type(""):
+        if not isinstance(msg, (str, bytearray)):
             if msg.header.xid == 0 and not zero_xid:
                 msg.header.xid = gen_xid()
             outpkt = msg.pack()
@@ -589,7 +804,8 @@ class Controller(Thread):
         string = "Controller:\n"
         string += "  state           " + self.dbg_state + "\n"
         string += "  switch_addr     " + str(self.switch_addr) + "\n"
-        string += "  pending pkts    " + str(len(self.packets)) + "\n"
+        string += "  pending pkts    " + str(self.packets_len) + "\n"
+        string += "  pending xacts   " + str(len(self.transactions)) + "\n"
         string += "  total pkts      " + str(self.packets_total) + "\n"
         string += "  expired pkts    " + str(self.packets_expired) + "\n"
         string += "  handled pkts    " + str(self.packets_handled) + "\n"
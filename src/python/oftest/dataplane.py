@@ -10,27 +10,277 @@ See the class dataplaneport for more details.  This class wraps
 a set of those objects allowing general calls and parsing
 configuration.
 
-@todo Add "filters" for matching packets.  Actions supported
-for filters should include a callback or a counter
+Receive path filters are registered per port with a match predicate
+and a callback; PacketCounter is a callback that only counts.  Frames
+they match are consumed in the port thread and never queued.
 """
 
 import sys
 import os
+import errno
 import socket
+import struct
+import mmap
 import time
 import netutils
+import bpf
+import latency
 from threading import Thread
 from threading import Lock
 from threading import Condition
 import select
 import logging
+import heapq
+from collections import deque
 from oft_assert import oft_assert
 from ofutils import *
 
 ##@todo Find a better home for these identifiers (dataplane)
 RCV_SIZE_DEFAULT = 4096
+RCV_BATCH = 64
+SEND_BATCH = 64
 ETH_P_ALL = 0x03
+ETH_P_8021Q = 0x8100
+ETH_P_IP = 0x0800
 RCV_TIMEOUT = 10000
+HEAP_SLACK = 64
+
+# TPACKET_V3 ring layout (struct tpacket_block_desc, struct tpacket3_hdr)
+BLOCK_STATUS_OFFSET = 8
+BLOCK_NUM_PKTS_OFFSET = 12
+TP_VLAN_OFFSET = 32
+TPACKET3_HDR = struct.Struct("IIIIIIH")
+
+##@var MIN_PKT_LEN
+# Minimum Ethernet frame size without CRC; shorter frames are padded
+MIN_PKT_LEN = 60
+
+##@var EXP_PREFIX_LEN
+# Bytes compared by ExpectedPacket before the full compare; covers the
+# Ethernet header, where unrelated traffic usually differs
+EXP_PREFIX_LEN = 16
+
+class ExpectedPacket:
+    """
+    An expected packet serialized once for repeated matching
+
+    Matching checks the length, then a short prefix, then the whole
+    frame, so most non-matching frames are rejected after a few bytes.
+    As with match_exp_pkt, if the expected packet is shorter than the
+    minimum Ethernet frame then padding in the received frame is
+    ignored.
+
+    Instances hash and compare by the serialized packet, so they can be
+    kept in sets and used as dictionary keys.
+
+    @var data The expected packet as a string
+    @var length len(data)
+    @var hash hash(data)
+    """
+
+    def __init__(self, exp_pkt):
+        self.data = str(exp_pkt)
+        self.length = len(self.data)
+        self.hash = hash(self.data)
+        self.prefix = self.data[:EXP_PREFIX_LEN]
+        self.padded = self.length < MIN_PKT_LEN
+
+    def matches(self, pkt):
+        """
+        Return True if the received frame pkt (a string) matches
+        """
+        if self.padded:
+            if len(pkt) < self.length or not pkt.startswith(self.prefix):
+                return False
+            return pkt[:self.length] == self.data
+        if len(pkt) != self.length or not pkt.startswith(self.prefix):
+            return False
+        return pkt == self.data
+
+    def equals(self, pkt):
+        """
+        Return True if pkt is exactly the expected packet
+        """
+        return pkt == self.data
+
+    def __hash__(self):
+        return self.hash
+
+    def __eq__(self, other):
+        return isinstance(other, ExpectedPacket) and \
+            self.__class__ is other.__class__ and \
+            self.hash == other.hash and self.data == other.data
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __len__(self):
+        return self.length
+
+    def __str__(self):
+        return self.data
+
+def _pkt_fields(data):
+    """
+    Locate the named fields of an Ethernet/VLAN/IPv4/TCP/UDP/ICMP frame
+
+    @param data The frame as a string
+    @return Dictionary from field name to a list of (offset, bits) pairs,
+    one per byte, where bits selects the field's bits in that byte
+    """
+    def span(offset, width):
+        return [(idx, 0xff) for idx in range(offset, offset + width)]
+
+    fields = {"dl_dst": span(0, 6), "dl_src": span(6, 6)}
+    offset = 12
+    if len(data) < offset + 2:
+        return fields
+    (dl_type,) = struct.unpack_from("!H", data, offset)
+    if dl_type == ETH_P_8021Q and len(data) >= 18:
+        fields["dl_vlan_pcp"] = [(14, 0xe0)]
+        fields["dl_vlan_cfi"] = [(14, 0x10)]
+        fields["dl_vlan"] = [(14, 0x0f), (15, 0xff)]
+        offset = 16
+        (dl_type,) = struct.unpack_from("!H", data, offset)
+    l3 = offset + 2
+    if dl_type != ETH_P_IP or len(data) < l3 + 20:
+        return fields
+
+    (ver_ihl, ip_len, ip_proto) = struct.unpack_from("!BxH5xB", data, l3)
+    fields["ip_tos"] = span(l3 + 1, 1)
+    fields["ip_dscp"] = [(l3 + 1, 0xfc)]
+    fields["ip_ecn"] = [(l3 + 1, 0x03)]
+    fields["ip_id"] = span(l3 + 4, 2)
+    fields["ip_ttl"] = span(l3 + 8, 1)
+    fields["ip_checksum"] = span(l3 + 10, 2)
+    fields["ip_src"] = span(l3 + 12, 4)
+    fields["ip_dst"] = span(l3 + 16, 4)
+    fields["padding"] = span(l3 + ip_len, max(0, len(data) - l3 - ip_len))
+    l4 = l3 + (ver_ihl & 0xf) * 4
+    if ip_proto in [6, 17] and len(data) >= l4 + 4:
+        fields["tcp_sport"] = span(l4, 2)
+        fields["tcp_dport"] = span(l4 + 2, 2)
+    checksum_offset = {1: 2, 6: 16, 17: 6}.get(ip_proto)
+    if checksum_offset is not None and len(data) >= l4 + checksum_offset + 2:
+        fields["l4_checksum"] = span(l4 + checksum_offset, 2)
+    return fields
+
+##@var MASK_FIELD_GROUPS
+# Names that stand for several don't care fields
+MASK_FIELD_GROUPS = {
+    "checksums" : ["ip_checksum", "l4_checksum"],
+    "vlan"      : ["dl_vlan", "dl_vlan_pcp", "dl_vlan_cfi"]
+}
+
+##@var MASK_FIELDS
+# Every field name accepted by MaskedPacket
+MASK_FIELDS = ["dl_dst", "dl_src", "dl_vlan", "dl_vlan_pcp", "dl_vlan_cfi",
+               "ip_tos", "ip_dscp", "ip_ecn", "ip_id", "ip_ttl",
+               "ip_checksum", "ip_src", "ip_dst", "tcp_sport", "tcp_dport",
+               "l4_checksum", "padding"] + MASK_FIELD_GROUPS.keys()
+
+class MaskedPacket(ExpectedPacket):
+    """
+    An expected packet with don't care bits
+
+    The packet is a byte template and a byte mask; a received frame
+    matches if it agrees with the template on every bit set in the
+    mask.  Don't care fields are given by name, for example
+
+        exp = dataplane.MaskedPacket(pkt, dont_care=["ip_ttl", "checksums"])
+        (port, rcv_pkt, t) = dp.poll(port_number=2, exp_pkt=exp)
+
+    See MASK_FIELDS for the names.  Fields that the packet does not have
+    (dl_vlan on an untagged frame, tcp_sport on ICMP) are ignored.
+    "padding" also accepts frames longer than the template, as switches
+    may pad on egress; without it the length must be equal, except that
+    templates shorter than the minimum frame accept padding as for
+    ExpectedPacket.
+
+    The mask is compiled into runs of fully significant bytes, compared
+    as slices, and a few partially masked bytes, so matching costs a
+    handful of string operations per frame.
+
+    @var mask The mask as a string, same length as data
+    """
+
+    def __init__(self, exp_pkt, dont_care=[], mask=None):
+        """
+        @param exp_pkt The template packet (string, scapy object or
+        ExpectedPacket)
+        @param dont_care List of field names to ignore
+        @param mask Optional mask string; bits clear in it are also ignored
+        """
+        ExpectedPacket.__init__(self, str(exp_pkt))
+        if mask is None:
+            bits = [0xff] * self.length
+        else:
+            if len(mask) != self.length:
+                raise Exception("Mask length %d != packet length %d" %
+                                (len(mask), self.length))
+            bits = [ord(c) for c in mask]
+        fields = _pkt_fields(self.data)
+        names = []
+        for name in dont_care:
+            if name not in MASK_FIELDS:
+                raise Exception("Unknown don't care field " + str(name))
+            names.extend(MASK_FIELD_GROUPS.get(name, [name]))
+        for name in names:
+            for (offset, field_bits) in fields.get(name, []):
+                bits[offset] &= ~field_bits & 0xff
+        self.padded = self.padded or "padding" in dont_care
+        self.mask = "".join([chr(b) for b in bits])
+        self.hash = hash((self.data, self.mask))
+
+        # Runs of 0xff bytes are compared as slices; other non-zero
+        # mask bytes individually
+        self.runs = []
+        self.partial = []
+        start = None
+        for idx in range(self.length + 1):
+            if idx < self.length and bits[idx] == 0xff:
+                if start is None:
+                    start = idx
+                continue
+            if start is not None:
+                self.runs.append((start, idx, self.data[start:idx]))
+                start = None
+            if idx < self.length and bits[idx] != 0:
+                self.partial.append((idx, bits[idx],
+                                     ord(self.data[idx]) & bits[idx]))
+
+    def matches(self, pkt):
+        """
+        Return True if the received frame pkt (a string) matches
+        """
+        if len(pkt) != self.length:
+            if not self.padded or len(pkt) < self.length:
+                return False
+        for (start, end, value) in self.runs:
+            if pkt[start:end] != value:
+                return False
+        for (offset, bits, value) in self.partial:
+            if ord(pkt[offset]) & bits != value:
+                return False
+        return True
+
+    def equals(self, pkt):
+        return self.matches(pkt)
+
+    def __eq__(self, other):
+        return isinstance(other, MaskedPacket) and \
+            self.data == other.data and self.mask == other.mask
+
+def exp_pkt_compile(exp_pkt):
+    """
+    Return an ExpectedPacket for exp_pkt
+
+    @param exp_pkt A packet (string or scapy object) or an ExpectedPacket,
+    which is returned unchanged
+    """
+    if isinstance(exp_pkt, ExpectedPacket):
+        return exp_pkt
+    return ExpectedPacket(exp_pkt)
 
 def match_exp_pkt(exp_pkt, pkt):
     """
@@ -38,12 +288,55 @@ def match_exp_pkt(exp_pkt, pkt):
     and return True iff they are identical.  If the length of exp_pkt is
     less than the minimum Ethernet frame size (60 bytes), then padding
     bytes in pkt are ignored.
+
+    To match the same exp_pkt repeatedly, compile it once with
+    exp_pkt_compile and call its matches method.
+    """
+    return exp_pkt_compile(exp_pkt).matches(str(pkt))
+
+def _matcher(match):
+    """
+    Return a predicate on the packet string for a register() match
+    """
+    if match is None:
+        return lambda pkt: True
+    if callable(match):
+        return match
+    # Compiled once here, not per frame on the port thread
+    return exp_pkt_compile(match).matches
+
+
+class PacketCounter:
+    """
+    Receive path callback that counts the frames it is given
+
+    Register it on a port to count matching frames instead of queueing
+    them:
+
+        counter = dataplane.PacketCounter()
+        self.dataplane.register(counter, match=pkt)
+        ...
+        self.assertEqual(counter.packets, 1000)
+
+    @var packets Number of frames counted
+    @var bytes Number of bytes counted
+    @var ports Map from port number to number of frames counted
     """
-    e = str(exp_pkt)
-    p = str(pkt)
-    if len(e) < 60:
-        p = p[:len(e)]
-    return e == p
+
+    def __init__(self):
+        self.packets = 0
+        self.bytes = 0
+        self.ports = {}
+
+    def __call__(self, pkt, interface_name, port_number, rcv_time):
+        self.packets += 1
+        self.bytes += len(pkt)
+        self.ports[port_number] = self.ports.get(port_number, 0) + 1
+
+    def clear(self):
+        self.packets = 0
+        self.bytes = 0
+        self.ports = {}
 
 
 class DataPlanePort(Thread):
@@ -73,8 +366,15 @@ class DataPlanePort(Thread):
         self.interface_name = interface_name
         self.max_pkts = max_pkts
         self.packets_total = 0
-        self.packets = []
+        self.packets = deque(maxlen=max_pkts)
         self.packets_discarded = 0
+        # Sequence number of the packet at the head of the queue; used
+        # by the parent to spot stale entries in its arrival heap
+        self.head_seq = 0
+        # List of (predicate, handler) for receive path filters;
+        # replaced rather than modified so the port thread needs no lock
+        self.handlers = []
+        self.packets_handled = 0
         self.port_number = port_number
         logname = "dp-" + interface_name
         self.logger = logging.getLogger(logname)
@@ -85,6 +385,8 @@ class DataPlanePort(Thread):
             sys.exit(1)
         self.logger.info("Openned port monitor socket")
         self.parent = parent
+        self.running = True
+        self.error_warned = False # Have we warned about error?
 
     def interface_open(self, interface_name):
         """
@@ -96,6 +398,10 @@ class DataPlanePort(Thread):
                           socket.htons(ETH_P_ALL))
         s.bind((interface_name, 0))
         netutils.set_promisc(s, interface_name)
+        try:
+            netutils.enable_timestamps(s)
+        except IOError:
+            self.logger.info("No kernel timestamps; using receive time")
         s.settimeout(RCV_TIMEOUT)
         return s
 
@@ -103,9 +409,7 @@ class DataPlanePort(Thread):
         """
         Activity function for class
         """
-        self.running = True
         self.socs = [self.socket]
-        error_warned = False # Have we warned about error?
         while self.running:
             try:
                 sel_in, sel_out, sel_err = \
@@ -121,36 +425,130 @@ class DataPlanePort(Thread):
             if (sel_in is None) or (len(sel_in) == 0):
                 continue
 
+            pkts = self.receive()
+            if pkts:
+                self._enqueue(pkts)
+
+        self.logger.info("Thread exit")
+
+    def drain(self, max_pkts=RCV_BATCH):
+        """
+        Read the packets already waiting on the socket without blocking
+
+        The socket has a timeout set, so its descriptor is non-blocking;
+        it is read directly to get EAGAIN rather than Python's timeout
+        emulation.  Frames are stamped with the kernel receive time only
+        if the parent asks for it, as that takes an ioctl per frame.
+        @param max_pkts Maximum number of packets to read in one call
+        @return List of (packet, receive time) pairs
+        """
+        pkts = []
+        if not self.running:
+            return pkts
+        fd = self.socket.fileno()
+        kernel_stamp = self.parent.kernel_timestamps or \
+            self.parent.meter is not None
+        while len(pkts) < max_pkts:
             try:
-                rcvmsg = self.socket.recv(RCV_SIZE_DEFAULT)
-            except socket.error:
-                if not error_warned:
+                rcvmsg = os.read(fd, RCV_SIZE_DEFAULT)
+            except OSError, e:
+                if e.errno not in [errno.EAGAIN, errno.EINTR] and \
+                        not self.error_warned:
                     self.logger.info("Socket error on recv")
-                    error_warned = True
-                continue
+                    self.error_warned = True
+                break
 
             if len(rcvmsg) == 0:
                 self.logger.info("Zero len pkt rcvd")
                 self.kill()
                 break
 
-            rcvtime = time.clock()
+            if kernel_stamp:
+                try:
+                    rcvtime = netutils.get_timestamp(fd)
+                except IOError:
+                    rcvtime = timestamp()
+            else:
+                rcvtime = timestamp()
             self.logger.debug("Pkt len " + str(len(rcvmsg)) +
                      " in at " + str(rcvtime) + " on port " +
                      str(self.port_number))
+            pkts.append((rcvmsg, rcvtime))
+        return pkts
 
-            # Enqueue packet
-            with self.parent.pkt_sync:
-                if len(self.packets) >= self.max_pkts:
-                    # Queue full, throw away oldest
-                    self.packets.pop(0)
-                    self.packets_discarded += 1
-                    self.logger.debug("Discarding oldest packet to make room")
-                self.packets.append((rcvmsg, rcvtime))
-                self.packets_total += 1
-                self.parent.pkt_sync.notify_all()
+    def receive(self):
+        """
+        Drain the socket and take out frames consumed on the receive path
 
-        self.logger.info("Thread exit")
+        Frames carrying a latency signature are accounted in the
+        parent's meter when measurement is on.  Each remaining frame is
+        given to the first registered handler whose match accepts it.
+        @return List of (packet, receive time) pairs still to be queued
+        """
+        pkts = self.drain()
+        meter = self.parent.meter
+        if meter is not None and pkts:
+            pkts = meter.rx_batch(self.port_number, pkts)
+        handlers = self.handlers
+        if handlers and pkts:
+            rest = []
+            for (pkt, rcv_time) in pkts:
+                for (predicate, handler) in handlers:
+                    if predicate(pkt):
+                        handler(pkt, self.interface_name, self.port_number,
+                                rcv_time)
+                        self.packets_handled += 1
+                        break
+                else:
+                    rest.append((pkt, rcv_time))
+            pkts = rest
+        return pkts
+
+    def _queue_append(self, pkts):
+        """
+        Add a batch of packets to the queue
+
+        The caller must hold the parent pkt_sync lock and notify pollers.
+        @param pkts List of (packet, receive time) pairs
+        """
+        old_head = None
+        if len(self.packets) > 0:
+            old_head = self.head_seq
+        for pkt in pkts:
+            if len(self.packets) >= self.max_pkts:
+                # Queue full, the append throws away the oldest
+                self.packets_discarded += 1
+                self.head_seq += 1
+                self.logger.debug("Discarding oldest packet to make room")
+            self.packets.append(pkt)
+            self.packets_total += 1
+        if self.head_seq != old_head:
+            self.parent._head_push(self)
+
+    def dequeue(self):
+        """
+        Remove and return the packet at the head of the queue
+
+        The caller must hold the parent pkt_sync lock.
+        @return A (packet, receive time) pair
+        """
+        pkt = self.packets.popleft()
+        self.head_seq += 1
+        if len(self.packets) > 0:
+            self.parent._head_push(self)
+        return pkt
+
+    def _enqueue(self, pkts):
+        """
+        Add a batch of packets to the queue
+
+        The parent lock is taken once and pollers are woken once for
+        the whole batch.
+        @param pkts List of (packet, receive time) pairs
+        """
+        with self.parent.pkt_sync:
+            self._queue_append(pkts)
+            self.parent.pkt_sync.notify_all()
 
     def kill(self):
         """
@@ -180,7 +578,8 @@ class DataPlanePort(Thread):
         """
         with self.parent.pkt_sync:
             self.packets_discarded += len(self.packets)
-            self.packets = []
+            self.head_seq += len(self.packets)
+            self.packets.clear()
 
     def send(self, packet):
         """
@@ -191,24 +590,315 @@ class DataPlanePort(Thread):
         return self.socket.send(packet)
 
 
-    def register(self, handler):
+    def send_many(self, packets):
+        """
+        Send a list of packets to the dataplane port in one batch
+        @param packets List of packet data strings
+        @retval List of the number of bytes sent for each packet
+        """
+        return netutils.send_batch(self.socket, packets)
+
+    def filter_attach(self, prog):
+        """
+        Attach a BPF program to the port socket
+
+        Frames rejected by the program are dropped by the kernel and
+        never queued.  Replaces any program already attached.
+        @param prog A program from bpf.filter_compile
+        """
+        netutils.attach_filter(self.socket, bpf.filter_pack(prog))
+
+    def filter_detach(self):
+        """
+        Remove the BPF program from the port socket, if any
+        """
+        try:
+            netutils.detach_filter(self.socket)
+        except socket.error:
+            pass # No filter attached
+
+    def register(self, handler, match=None):
         """
         Register a callback function to receive packets from this
         port.  The callback will be passed the packet, the
-        interface name and the port number (if set) on which the
-        packet was received.
+        interface name, the port number on which the packet was
+        received and the receive time.
 
-        To be implemented
+        The callback runs in the receive thread, so it should be quick
+        and must not block; frames it is given are not queued.  Filters
+        are tried in registration order and the first match wins.
+
+        @param handler The callback, for example a PacketCounter
+        @param match None to take every frame, a function returning True
+        for packet strings to take, or a packet compared with
+        match_exp_pkt
+        """
+        self.handlers = self.handlers + [(_matcher(match), handler)]
+
+    def unregister(self, handler):
+        """
+        Remove every filter registered with handler
         """
-        pass
+        self.handlers = [entry for entry in self.handlers
+                         if entry[1] is not handler]
 
     def show(self, prefix=''):
         print prefix + "Name:          " + self.interface_name
         print prefix + "Pkts pending:  " + str(len(self.packets))
         print prefix + "Pkts total:    " + str(self.packets_total)
+        print prefix + "Pkts handled:  " + str(self.packets_handled)
         print prefix + "socket:        " + str(self.socket)
 
 
+class DataPlanePortMmap(DataPlanePort):
+    """
+    Port monitor reading from a memory mapped TPACKET_V3 receive ring
+
+    The kernel writes frames directly into blocks of a ring shared
+    with this process, so a single wakeup hands over a whole block of
+    frames with no per-frame syscall.  Select this class with
+
+        config["dataplane"] = {"portclass" : dataplane.DataPlanePortMmap}
+
+    The ring geometry is given by the class variables below; subclass
+    to tune it.  Frames received with an offloaded VLAN tag have the
+    tag reinserted so the queued frame matches what was on the wire.
+
+    @var block_size Size in bytes of each ring block (multiple of page size)
+    @var block_nr Number of blocks in the ring
+    @var frame_size Nominal frame slot size used to size the ring
+    @var block_timeout Time in ms after which a partial block is retired
+    """
+
+    block_size = 1 << 17
+    block_nr = 32
+    frame_size = 2048
+    block_timeout = 4
+
+    def interface_open(self, interface_name):
+        """
+        Open a promiscuous packet socket with a mmap'd receive ring
+        @param interface_name port name as a string such as 'eth1'
+        @retval s socket
+        """
+        s = socket.socket(socket.AF_PACKET, socket.SOCK_RAW,
+                          socket.htons(ETH_P_ALL))
+        netutils.set_rx_ring(s, self.block_size, self.block_nr,
+                             self.frame_size, self.block_timeout)
+        self.ring = mmap.mmap(s.fileno(), self.block_size * self.block_nr,
+                              mmap.MAP_SHARED,
+                              mmap.PROT_READ | mmap.PROT_WRITE)
+        self.block_idx = 0
+        s.bind((interface_name, 0))
+        netutils.set_promisc(s, interface_name)
+        return s
+
+    def _block_ready(self):
+        """
+        Return True if the current ring block has been handed to user space
+        """
+        offset = self.block_idx * self.block_size
+        (status,) = struct.unpack_from("I", self.ring,
+                                       offset + BLOCK_STATUS_OFFSET)
+        return (status & netutils.TP_STATUS_USER) != 0
+
+    def _block_drain(self):
+        """
+        Copy all frames out of the current block and return it to the kernel
+        @return List of (packet, receive time) pairs
+        """
+        ring = self.ring
+        base = self.block_idx * self.block_size
+        (num_pkts, first) = struct.unpack_from("II", ring,
+                                               base + BLOCK_NUM_PKTS_OFFSET)
+        pkts = []
+        offset = base + first
+        for idx in xrange(num_pkts):
+            (next_offset, sec, nsec, snaplen, pktlen, status, mac) = \
+                TPACKET3_HDR.unpack_from(ring, offset)
+            start = offset + mac
+            pkt = ring[start:start + snaplen]
+            if status & netutils.TP_STATUS_VLAN_VALID:
+                (tci, tpid) = struct.unpack_from("IH", ring,
+                                                 offset + TP_VLAN_OFFSET)
+                if not status & netutils.TP_STATUS_VLAN_TPID_VALID:
+                    tpid = ETH_P_8021Q
+                pkt = pkt[:12] + struct.pack("!HH", tpid, tci) + pkt[12:]
+            pkts.append((pkt, sec + nsec * 1e-9))
+            offset += next_offset
+
+        struct.pack_into("I", ring, base + BLOCK_STATUS_OFFSET,
+                         netutils.TP_STATUS_KERNEL)
+        self.block_idx = (self.block_idx + 1) % self.block_nr
+        return pkts
+
+    def drain(self, max_pkts=None):
+        """
+        Copy out every block the kernel has handed over
+
+        The DataPlaneEpoll thread may still be here when kill() unmaps
+        the ring; reads of the closed ring then end the drain.
+        @param max_pkts Ignored; the ring is always drained in whole blocks
+        @return List of (packet, receive time) pairs
+        """
+        pkts = []
+        if not self.running:
+            return pkts
+        try:
+            for idx in xrange(self.block_nr):
+                if not self._block_ready():
+                    break
+                pkts.extend(self._block_drain())
+        except ValueError:
+            # kill() unmapped the ring
+            if self.running:
+                raise
+        return pkts
+
+    def run(self):
+        """
+        Activity function for class
+
+        Drains every block that is ready, then sleeps in select until
+        the kernel retires the next one.
+        """
+        self.socs = [self.socket]
+        while self.running:
+            try:
+                ready = self._block_ready()
+            except ValueError:
+                # kill() unmapped the ring
+                if self.running:
+                    raise
+                break
+            if not ready:
+                try:
+                    sel_in, sel_out, sel_err = \
+                        select.select(self.socs, [], [], 1)
+                except:
+                    if self.running:
+                        print sys.exc_info()
+                        self.logger.error("Select error, exiting")
+                    break
+                continue
+
+            pkts = self.receive()
+            if not self.running:
+                break
+            self.logger.debug("Block of %d pkts in on port %d" %
+                              (len(pkts), self.port_number))
+            if pkts:
+                self._enqueue(pkts)
+
+        self.logger.info("Thread exit")
+
+    def kill(self):
+        """
+        Terminate the running thread and unmap the ring
+
+        Done here rather than at the end of run so the ring is also
+        released when the port is serviced by DataPlaneEpoll.
+        """
+        DataPlanePort.kill(self)
+        try:
+            self.ring.close()
+        except:
+            self.logger.info("Ignoring ring unmap error")
+
+
+class DataPlaneEpoll(Thread):
+    """
+    Single I/O thread servicing the sockets of every dataplane port
+
+    Used in place of one thread per port when the configuration sets
+
+        config["dataplane"]["epoll"] = True
+
+    Ports are still created from the configured port class but are not
+    started; their sockets are registered in one epoll set instead.
+    On each wakeup every ready port is drained, all the packets are
+    queued under one acquisition of the parent pkt_sync lock and
+    pollers are notified once.  The per-port queues are unchanged so
+    DataPlane.poll behaves as with per-port threads.
+    """
+
+    def __init__(self, parent):
+        """
+        @param parent The controlling dataplane object; for pkt wait CV
+        """
+        Thread.__init__(self)
+        self.parent = parent
+        self.epoll = select.epoll()
+        self.ports = {} # Map from socket fd to port object
+        self.running = True
+        self.wakeups = 0
+        self.logger = logging.getLogger("dp-epoll")
+
+    def port_register(self, port):
+        """
+        Start servicing a port's socket
+        @param port A DataPlanePort object (not started)
+        """
+        fd = port.socket.fileno()
+        self.ports[fd] = port
+        self.epoll.register(fd, select.EPOLLIN)
+
+    def port_unregister(self, port):
+        """
+        Stop servicing a port's socket; call before the socket is closed
+        @param port A DataPlanePort object previously registered
+        """
+        for fd, p in self.ports.items():
+            if p is port:
+                del self.ports[fd]
+                try:
+                    self.epoll.unregister(fd)
+                except:
+                    self.logger.info("Ignoring epoll unregister error")
+
+    def run(self):
+        """
+        Activity function for class
+        """
+        while self.running:
+            try:
+                events = self.epoll.poll(1)
+            except IOError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                self.logger.error("Epoll error, exiting")
+                break
+
+            if not self.running:
+                break
+
+            batch = []
+            for fd, event in events:
+                port = self.ports.get(fd)
+                if port is None:
+                    continue
+                pkts = port.receive()
+                if pkts:
+                    batch.append((port, pkts))
+
+            if batch:
+                self.wakeups += 1
+                with self.parent.pkt_sync:
+                    for port, pkts in batch:
+                        port._queue_append(pkts)
+                    self.parent.pkt_sync.notify_all()
+
+        self.epoll.close()
+        self.logger.info("Thread exit")
+
+    def kill(self):
+        """
+        Terminate the running thread
+        """
+        self.logger.debug("Epoll thread kill")
+        self.running = False
+
+
 class DataPlane:
     """
     Class defining access primitives to the data plane
@@ -226,6 +916,11 @@ class DataPlane:
         self.want_pkt_port = None # What port required (or None)
         self.got_pkt_port = None # On what port received?
         self.packets_pending = 0 # Total pkts in all port queues
+        # Heap of (time, head_seq, port_number) for the head packet of each
+        # port queue, so the oldest packet is found in O(log P)
+        self.arrival_heap = []
+        # LatencyMeter signing sent frames, or None when not measuring
+        self.meter = None
         self.logger = logging.getLogger("dataplane")
 
         if config is None:
@@ -257,6 +952,30 @@ class DataPlane:
         if self.dppclass == None:
             raise Exception("Problem determining DataPlanePort class.")
 
+        ############################################################
+        #
+        # Set config.dataplane.epoll = True to service all ports from
+        # one epoll thread (DataPlaneEpoll) instead of a thread per port.
+        #
+        self.io_thread = None
+        if "dataplane" in self.config:
+            if self.config["dataplane"].get("epoll", False):
+                self.io_thread = DataPlaneEpoll(self)
+                self.io_thread.start()
+
+        ############################################################
+        #
+        # Set config.dataplane.kernel_timestamps = True to stamp frames
+        # on socket ports with their kernel receive time, read with one
+        # ioctl per frame.  Otherwise frames are stamped when read,
+        # except while measuring latency.  Mmap ports always use the
+        # ring timestamp, which costs nothing extra.
+        #
+        self.kernel_timestamps = False
+        if "dataplane" in self.config:
+            self.kernel_timestamps = \
+                self.config["dataplane"].get("kernel_timestamps", False)
+
 
     def port_add(self, interface_name, port_number):
         """
@@ -269,52 +988,212 @@ class DataPlane:
         self.port_list[port_number] = self.dppclass(interface_name, 
                                                     port_number, self); 
 
-        self.port_list[port_number].start()
+        if self.io_thread:
+            self.io_thread.port_register(self.port_list[port_number])
+        else:
+            self.port_list[port_number].start()
 
 
 
-    def send(self, port_number, packet):
+    def send(self, port_number, packet, stream_id=None):
         """
         Send a packet to the given port
         @param port_number The port to send the data to
         @param packet Raw packet data to send to port
+        @param stream_id Stream to sign the packet for when measuring;
+        defaults to port_number
         """
-        self.logger.debug("Sending %d bytes to port %d" %
-                          (len(packet), port_number))
+        if self.meter is not None:
+            if stream_id is None:
+                stream_id = port_number
+            packet = self.meter.tx_sign(stream_id, str(packet))
+        self.logger.debug("Sending %d bytes to port %d",
+                          len(packet), port_number)
         bytes = self.port_list[port_number].send(packet)
         if bytes != len(packet):
             self.logger.error("Unhandled send error, length mismatch %d != %d" %
                      (bytes, len(packet)))
         return bytes
 
+    def send_bulk(self, pkts, batch_size=SEND_BATCH):
+        """
+        Send a stream of packets to dataplane ports in batches
+
+        Packets are collected per port and each batch is submitted with
+        a single syscall (sendmmsg where available).  Packets for the same
+        port are sent in order; ordering across ports is not preserved.
+        When measuring, each packet is signed on the stream of its port.
+
+        @param pkts Iterable (list or generator) of (port_number, packet)
+        pairs; packet may be a string or a scapy object
+        @param batch_size Maximum number of packets per batch
+        @return Dictionary from port number to a triple (sent, short, bytes)
+        where short counts packets not sent or sent with a length mismatch
+        and bytes is the total length of the packets sent in full
+        """
+        counts = {}
+        pending = {}
+        meter = self.meter
+
+        def flush(port_number, frames):
+            sent_lens = self.port_list[port_number].send_many(frames)
+            short = 0
+            sent_bytes = 0
+            for idx in range(len(frames)):
+                if sent_lens[idx] != len(frames[idx]):
+                    short += 1
+                else:
+                    sent_bytes += sent_lens[idx]
+            (sent, prev_short, prev_bytes) = counts.get(port_number,
+                                                        (0, 0, 0))
+            counts[port_number] = (sent + len(frames) - short,
+                                   prev_short + short,
+                                   prev_bytes + sent_bytes)
+            if short:
+                self.logger.error("Send error on port %d, %d of %d short" %
+                                  (port_number, short, len(frames)))
+
+        for (port_number, packet) in pkts:
+            frames = pending.setdefault(port_number, [])
+            if meter is not None:
+                frames.append(meter.tx_sign(port_number, str(packet)))
+            else:
+                frames.append(str(packet))
+            if len(frames) >= batch_size:
+                flush(port_number, frames)
+                pending[port_number] = []
+        for (port_number, frames) in pending.items():
+            if frames:
+                flush(port_number, frames)
+        self.logger.debug("Bulk send: %s", counts)
+        return counts
+
     def flood(self, packet):
         """
         Send a packet to all ports
         @param packet Raw packet data to send to port
         """
-        for port_number in self.port_list.keys():
-            bytes = self.port_list[port_number].send(packet)
-            if bytes != len(packet):
-                self.logger.error("Unhandled send error" +
-                         ", port %d, length mismatch %d != %d" %
-                         (port_number, bytes, len(packet)))
+        self.send_bulk([(port_number, packet)
+                        for port_number in self.port_list.keys()])
 
-    def _oldest_packet_find(self):
-        # Find port with oldest packet
-        oft_assert(min_port != -1, "Could not find port when pkts pending")
+    def measure_start(self, meter=None):
+        """
+        Enter measurement mode
+
+        Every frame sent through send, send_bulk or flood is signed
+        with its stream id, a sequence number and the send time, and
+        signed frames received on any port are accounted in the meter
+        instead of being queued.  See the latency module.
+        @param meter The LatencyMeter to use; a new one if None
+        @return The meter
+        """
+        if meter is None:
+            meter = latency.LatencyMeter()
+        self.meter = meter
+        return meter
+
+    def measure_stop(self):
+        """
+        Leave measurement mode
+        @return The meter that was in use, or None
+        """
+        meter = self.meter
+        self.meter = None
+        return meter
+
+    def register(self, handler, match=None, port_number=None):
+        """
+        Register a receive path callback on one or all dataplane ports
+
+        See DataPlanePort.register.
+        @param handler The callback, for example a PacketCounter
+        @param match Selects the frames given to handler
+        @param port_number The port to register on; all ports if None
+        """
+        if port_number is None:
+            ports = self.port_list.values()
+        else:
+            ports = [self.port_list[port_number]]
+        for port in ports:
+            port.register(handler, match)
+
+    def unregister(self, handler, port_number=None):
+        """
+        Remove a receive path callback from one or all dataplane ports
+        """
+        if port_number is None:
+            ports = self.port_list.values()
+        else:
+            ports = [self.port_list[port_number]]
+        for port in ports:
+            port.unregister(handler)
+
+    def filter_set(self, port_number=None, ignore_dl_type=[],
+                   ignore_dl_dst=[], ignore_dl_src=[], ignore_vlan=[],
+                   exp_pkts=None):
+        """
+        Install an in-kernel filter on one or all dataplane ports
+
+        See bpf.filter_compile for the parameters.  For example, to drop
+        LLDP/STP and IPv6 neighbor discovery chatter on every port:
+
+            dp.filter_set(ignore_dl_type=bpf.NOISE_DL_TYPE,
+                          ignore_dl_dst=bpf.NOISE_DL_DST)
+
+        @param port_number If set, only filter this port
+        """
+        prog = bpf.filter_compile(ignore_dl_type=ignore_dl_type,
+                                  ignore_dl_dst=ignore_dl_dst,
+                                  ignore_dl_src=ignore_dl_src,
+                                  ignore_vlan=ignore_vlan,
+                                  exp_pkts=exp_pkts)
+        self.logger.debug("Attaching %d instruction filter to port %s" %
+                          (len(prog), str(port_number)))
+        if port_number is None:
+            ports = self.port_list.values()
+        else:
+            ports = [self.port_list[port_number]]
+        for port in ports:
+            port.filter_attach(prog)
+
+    def filter_clear(self, port_number=None):
+        """
+        Remove the in-kernel filter from one or all dataplane ports
+        @param port_number If set, only clear this port
+        """
+        if port_number is None:
+            ports = self.port_list.values()
+        else:
+            ports = [self.port_list[port_number]]
+        for port in ports:
+            port.filter_detach()
+
+    def _head_push(self, port):
+        """
+        Index the packet now at the head of port's queue
 
-        return min_port
+        Called with pkt_sync held whenever a port's head changes.  Entries
+        for earlier heads are left in the heap and skipped when they reach
+        the top; the heap is rebuilt if too many of them accumulate.
+        """
+        heapq.heappush(self.arrival_heap, (port.packets[0][1], port.head_seq,
+                                           port.port_number))
+        if len(self.arrival_heap) > 2 * len(self.port_list) + HEAP_SLACK:
+            self.arrival_heap = [(p.packets[0][1], p.head_seq, p.port_number)
+                                 for p in self.port_list.values()
+                                 if len(p.packets) > 0]
+            heapq.heapify(self.arrival_heap)
 
     # Returns the port with the oldest packet, or None if no packets are queued.
     def oldest_port(self):
-        min_port = None
-        min_time = float('inf')
-        for port in self.port_list.values():
-            ptime = port.timestamp_head()
-            if ptime and ptime < min_time:
-                min_time = ptime
-                min_port = port
-        return min_port
+        heap = self.arrival_heap
+        while heap:
+            (ptime, seq, port_number) = heap[0]
+            port = self.port_list.get(port_number)
+            if port and port.head_seq == seq and len(port.packets) > 0:
+                return port
+            heapq.heappop(heap)
+        return None
 
     # Dequeues and yields packets in the order they were received.
     # Yields (port, packet, received time).
@@ -331,7 +1210,7 @@ class DataPlane:
                 # Out of packets
                 break
 
-            pkt, time = port.packets.pop(0)
+            pkt, time = port.dequeue()
             yield (port, pkt, time)
 
     def poll(self, port_number=None, timeout=-1, exp_pkt=None):
@@ -349,21 +1228,26 @@ class DataPlane:
         until a packet is received or for this many seconds
         @param exp_pkt If not None, look for this packet and ignore any
         others received.  Note that if port_number is None, all packets
-        from all ports will be discarded until the exp_pkt is found
+        from all ports will be discarded until the exp_pkt is found.
+        May be a packet or an ExpectedPacket.
         @return The triple port_number, packet, pkt_time where packet
-        is received from port_number at time pkt_time.  If a timeout
-        occurs, return None, None, None
+        is received from port_number at time pkt_time.  pkt_time is on
+        the ofutils.timestamp() clock; it is the kernel receive time on
+        mmap ports, and on socket ports with kernel_timestamps set or
+        while measuring.  If a timeout occurs, return None, None, None
         """
 
         if exp_pkt and not port_number:
             self.logger.warn("Dataplane poll with exp_pkt but no port number")
+        if exp_pkt is not None:
+            exp_pkt = exp_pkt_compile(exp_pkt)
 
         # Retrieve the packet. Returns (port number, packet, time).
         def grab():
             self.logger.debug("Grabbing packet")
             for (port, pkt, time) in self.packets(port_number):
                 self.logger.debug("Checking packet from port %d" % port.port_number)
-                if not exp_pkt or match_exp_pkt(exp_pkt, pkt):
+                if exp_pkt is None or exp_pkt.matches(pkt):
                     return (port, pkt, time)
             self.logger.debug("Did not find packet")
             return None
@@ -383,9 +1267,17 @@ class DataPlane:
         Close all sockets for dataplane
         @param join_threads If True call join on each thread
         """
+        if self.io_thread:
+            self.io_thread.kill()
+            for port in self.port_list.values():
+                self.io_thread.port_unregister(port)
+            if join_threads:
+                self.logger.debug("Joining epoll thread")
+                self.io_thread.join()
+
         for port_number in self.port_list.keys():
             self.port_list[port_number].kill()
-            if join_threads:
+            if join_threads and self.port_list[port_number].isAlive():
                 self.logger.debug("Joining " + str(port_number))
                 self.port_list[port_number].join()
 
@@ -0,0 +1,801 @@
+"""
+OpenFlow Test Framework
+
+Event driven control channel
+
+EventLoop runs any number of switch connections on a single thread.
+Nothing blocks on the loop: requests return a Future that is completed
+when the reply arrives, received messages are delivered to
+MessageStream objects by type, and echo keepalives are timers on the
+loop rather than threads.  One loop can serve several EventController
+listeners, so a test can drive many switches, each with thousands of
+requests in flight.
+
+Python 2 has no asyncio, so completion is callback based:
+Future.add_done_callback runs on the loop thread when the result is
+set.  Synchronous tests run the loop in the background and block on
+Future.result from their own thread:
+
+    loop = EventLoop()
+    loop.start()
+    ctrl = EventController(loop, port=6633)
+    ctrl.start()
+    cxn = ctrl.accept().result(timeout=10)
+    futures = [cxn.transact(req) for req in requests]
+    replies = gather(futures).result()
+    for (msg, rawmsg, rcv_time) in cxn.stream(OFPT_PACKET_IN):
+        ...
+    loop.stop()
+
+Messages are parsed with parse.of_message_parse into the usual message
+classes, lazily: the loop only unpacks headers, and message bodies are
+unpacked by whoever first uses them.  Receive times are from ofutils.timestamp(), the clock used
+for dataplane receive times.
+"""
+
+import os
+import errno
+import fcntl
+import heapq
+import socket
+import struct
+import select
+import logging
+import thread
+from collections import deque
+from threading import Thread
+from threading import Condition
+from message import *
+from parse import *
+from ofutils import *
+import ofutils
+from framing import MessageFramer
+
+OFP_HEADER = struct.Struct("!BBHL")
+
+##@var RCV_SIZE
+# Bytes read from a switch socket per recv call
+RCV_SIZE = 65536
+
+##@var MAX_READ
+# Bytes read from one switch before other events are serviced
+MAX_READ = 1 << 20
+
+class Future:
+    """
+    The result of an operation that completes on the event loop
+
+    Callbacks added with add_done_callback run in the thread that
+    completes the future, which is the loop thread for every future
+    created by this module.  Other threads may block on result().
+
+    @var value The result, or None if cancelled
+    @var finished True once the result is set or the future is cancelled
+    @var cancelled True if the future was cancelled
+    """
+
+    def __init__(self):
+        self.cv = Condition()
+        self.value = None
+        self.finished = False
+        self.cancelled = False
+        self.callbacks = []
+
+    def _finish(self, value, cancelled):
+        with self.cv:
+            if self.finished:
+                return False
+            self.value = value
+            self.finished = True
+            self.cancelled = cancelled
+            callbacks = self.callbacks
+            self.callbacks = []
+            self.cv.notify_all()
+        for fn in callbacks:
+            fn(self)
+        return True
+
+    def set_result(self, value):
+        """
+        Complete the future
+        @return False if it had already finished
+        """
+        return self._finish(value, False)
+
+    def cancel(self):
+        """
+        Complete the future with no result
+        @return False if it had already finished
+        """
+        return self._finish(None, True)
+
+    def done(self):
+        return self.finished
+
+    def add_done_callback(self, fn):
+        """
+        Call fn(future) when the future finishes, or now if it has
+        """
+        with self.cv:
+            if not self.finished:
+                self.callbacks.append(fn)
+                return
+        fn(self)
+
+    def result(self, timeout=-1):
+        """
+        Wait for the future to finish
+
+        Must not be called on the loop thread before the future is done,
+        as the loop could never complete it.
+
+        @param timeout The timeout in seconds; if -1 use default.
+        @return The result, or None on timeout or if cancelled
+        """
+        with self.cv:
+            timed_wait(self.cv, lambda: self.finished or None,
+                       timeout=timeout)
+            return self.value
+
+def gather(futures):
+    """
+    Combine futures into one
+    @param futures List of Future objects
+    @return A Future whose result is the list of their results, in order,
+    once all of them have finished
+    """
+    combined = Future()
+    results = [None] * len(futures)
+    remaining = [len(futures)]
+
+    def finished(idx, future):
+        results[idx] = future.value
+        remaining[0] -= 1
+        if remaining[0] == 0:
+            combined.set_result(results)
+
+    if not futures:
+        combined.set_result(results)
+    for (idx, future) in enumerate(futures):
+        future.add_done_callback(lambda f, idx=idx: finished(idx, f))
+    return combined
+
+class EventLoop:
+    """
+    Single threaded epoll event loop with timers
+
+    Handlers and callbacks run on the loop thread, one at a time, and
+    must not block.  call_soon may be called from any thread; the other
+    methods only from the loop thread or before the loop is started.
+    """
+
+    def __init__(self):
+        self.epoll = select.epoll()
+        self.handlers = {} # Map from fd to handler(events)
+        self.ready = deque()
+        self.timers = []
+        self.timer_seq = 0
+        self.running = False
+        self.thread = None
+        self.loop_ident = None
+        self.logger = logging.getLogger("evloop")
+
+        # Self pipe to wake the loop when called from another thread
+        (self.wake_rd, self.wake_wr) = os.pipe()
+        for fd in (self.wake_rd, self.wake_wr):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self.add_handler(self.wake_rd, self._wake_handle, select.EPOLLIN)
+
+    def _wake_handle(self, events):
+        try:
+            while os.read(self.wake_rd, 4096):
+                pass
+        except OSError:
+            pass
+
+    def in_loop(self):
+        """
+        Return True if called from the loop thread
+        """
+        return thread.get_ident() == self.loop_ident
+
+    def add_handler(self, fd, handler, events):
+        """
+        Call handler(events) when fd is ready for any of events
+        """
+        self.handlers[fd] = handler
+        self.epoll.register(fd, events)
+
+    def modify_handler(self, fd, events):
+        self.epoll.modify(fd, events)
+
+    def remove_handler(self, fd):
+        if self.handlers.pop(fd, None) is not None:
+            try:
+                self.epoll.unregister(fd)
+            except:
+                self.logger.info("Ignoring epoll unregister error")
+
+    def call_soon(self, fn, *args):
+        """
+        Run fn(*args) on the loop thread; safe to call from any thread
+        """
+        self.ready.append((fn, args))
+        if not self.in_loop():
+            try:
+                os.write(self.wake_wr, "x")
+            except OSError:
+                pass # Pipe full; the loop is awake anyway
+
+    def call_later(self, delay, fn, *args):
+        """
+        Run fn(*args) on the loop thread after delay seconds
+        @return A handle for cancel_timer
+        """
+        self.timer_seq += 1
+        timer = [timestamp() + delay, self.timer_seq, fn, args]
+        heapq.heappush(self.timers, timer)
+        return timer
+
+    def cancel_timer(self, timer):
+        timer[2] = None
+
+    def _run_callback(self, fn, args):
+        try:
+            fn(*args)
+        except:
+            self.logger.exception("Error in event loop callback")
+
+    def run(self):
+        """
+        Run the loop in the calling thread until stop() is called
+        """
+        self.loop_ident = thread.get_ident()
+        self.running = True
+        while self.running:
+            if self.ready:
+                timeout = 0
+            elif self.timers:
+                timeout = min(max(0, self.timers[0][0] - timestamp()), 1)
+            else:
+                timeout = 1
+            try:
+                events = self.epoll.poll(timeout)
+            except IOError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                self.logger.error("Epoll error, exiting")
+                break
+
+            for (fd, event) in events:
+                handler = self.handlers.get(fd)
+                if handler is not None:
+                    self._run_callback(handler, (event,))
+
+            now = timestamp()
+            while self.timers and self.timers[0][0] <= now:
+                (when, seq, fn, args) = heapq.heappop(self.timers)
+                if fn is not None:
+                    self._run_callback(fn, args)
+
+            # Callbacks queued by these run on the next pass
+            for idx in range(len(self.ready)):
+                (fn, args) = self.ready.popleft()
+                self._run_callback(fn, args)
+        self.running = False
+        self.logger.info("Event loop exit")
+
+    def start(self):
+        """
+        Run the loop in a background thread
+        """
+        self.thread = Thread(target=self.run, name="evloop")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop the loop after the current pass; safe from any thread
+        """
+        def halt():
+            self.running = False
+        self.call_soon(halt)
+        if self.thread is not None and not self.in_loop():
+            self.thread.join()
+            self.thread = None
+
+class MessageStream:
+    """
+    Messages of one type received from one switch
+
+    Each item is a triple (msg, rawmsg, rcv_time).  Items are buffered
+    until taken with get() (on the loop) or next() (from other threads);
+    once max_pkts are buffered the oldest are discarded.  Iterating
+    over a stream blocks for each item and ends at a timeout or when
+    the stream is closed.
+
+    @var msg_type The OpenFlow message type, or "all" for messages no
+    stream of their own type claims
+    @var expired Number of items discarded because the buffer was full
+    """
+
+    def __init__(self, cxn, msg_type, max_pkts=1024):
+        self.cxn = cxn
+        self.loop = cxn.loop
+        self.msg_type = msg_type
+        self.max_pkts = max_pkts
+        self.items = deque()
+        self.waiters = deque()
+        self.closed = False
+        self.expired = 0
+
+    def _deliver(self, item):
+        while self.waiters:
+            if self.waiters.popleft().set_result(item):
+                return
+        if len(self.items) >= self.max_pkts:
+            self.items.popleft()
+            self.expired += 1
+        self.items.append(item)
+
+    def _get(self, future):
+        if self.items:
+            future.set_result(self.items.popleft())
+        elif self.closed:
+            future.cancel()
+        else:
+            self.waiters.append(future)
+
+    def get(self):
+        """
+        @return A Future for the next item; its result is None if the
+        stream is closed first
+        """
+        future = Future()
+        if self.loop.in_loop():
+            self._get(future)
+        else:
+            self.loop.call_soon(self._get, future)
+        return future
+
+    def next(self, timeout=-1):
+        """
+        Wait for the next item; not for use on the loop thread
+        @param timeout The timeout in seconds; if -1 use default.
+        @return The next (msg, rawmsg, rcv_time), or None on timeout
+        """
+        future = self.get()
+        item = future.result(timeout=timeout)
+        if item is None and not future.cancel():
+            item = future.value # Delivered just as the wait timed out
+        return item
+
+    def __iter__(self):
+        while True:
+            item = self.next()
+            if item is None:
+                return
+            yield item
+
+    def close(self):
+        """
+        Stop receiving; pending get() futures are cancelled
+        """
+        def closer():
+            self.closed = True
+            self.cxn._stream_remove(self)
+            while self.waiters:
+                self.waiters.popleft().cancel()
+        self.loop.call_soon(closer)
+
+class SwitchConnection:
+    """
+    The control channel to one switch
+
+    Received messages are dispatched in order of preference to the
+    transaction waiting for their xid, to the echo keepalive, to the
+    streams for their type and last to the "all" streams.  Messages no
+    one claims are counted and dropped.
+
+    All public methods may be called from any thread.
+
+    @var addr The switch address
+    @var closed A Future completed when the connection closes
+    @var packets_total Number of messages received
+    @var packets_unclaimed Number of messages dropped as unclaimed
+    @var parse_errors Number of messages that could not be parsed
+    """
+
+    def __init__(self, loop, sock, addr, keep_alive=True, echo_interval=None,
+                 max_pkts=1024):
+        """
+        @param loop The EventLoop servicing the connection
+        @param sock The connected switch socket
+        @param addr The switch address
+        @param keep_alive If True, answer echo requests from the switch
+        @param echo_interval If set, send an echo request this often and
+        close the connection if no reply arrives within the interval
+        @param max_pkts Default buffer size of streams
+        """
+        self.loop = loop
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.addr = addr
+        self.keep_alive = keep_alive
+        self.echo_interval = echo_interval
+        self.max_pkts = max_pkts
+        self.framer = MessageFramer(RCV_SIZE)
+        self.outbuf = deque()
+        self.writing = False
+        self.transactions = {} # Map from xid to Future
+        self.streams = {} # Map from msg type to list of MessageStream
+        self.echo_timer = None
+        self.transact_to = 15 # Transact timeout if ofutils has no default
+        self.closed = Future()
+        self.packets_total = 0
+        self.packets_unclaimed = 0
+        self.parse_errors = 0
+        self.logger = logging.getLogger("evcontroller")
+
+        sock.setblocking(0)
+        loop.add_handler(self.fd, self._ready_handle, select.EPOLLIN)
+        if echo_interval:
+            self.echo_timer = loop.call_later(echo_interval, self._echo)
+
+    def _call(self, fn, *args):
+        """
+        Run fn on the loop thread: now if already there, else soon
+        """
+        if self.loop.in_loop():
+            fn(*args)
+        else:
+            self.loop.call_soon(fn, *args)
+
+    def _ready_handle(self, events):
+        if events & select.EPOLLOUT:
+            self._flush()
+        if events & (select.EPOLLIN | select.EPOLLERR | select.EPOLLHUP):
+            self._read()
+
+    def _read(self):
+        total = 0
+        eof = False
+        while total < MAX_READ:
+            try:
+                count = self.framer.recv(self.sock)
+            except socket.error, e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                if e.errno == errno.EINTR:
+                    continue
+                self.logger.warning("Error on switch read: " + str(e))
+                eof = True
+                break
+            if count == 0:
+                eof = True
+                break
+            total += count
+            self._pkt_handle(timestamp())
+            if self.sock is None:
+                return
+        if eof:
+            self.logger.info("Switch %s closed the connection" % str(self.addr))
+            self._close()
+
+    def _pkt_handle(self, rcv_time):
+        while True:
+            try:
+                view = self.framer.next_message()
+            except Exception, e:
+                self.logger.error(str(e))
+                self._close()
+                return
+            if view is None:
+                return
+            (version, msg_type, length, xid) = OFP_HEADER.unpack_from(view)
+            if version != OFP_VERSION:
+                self.logger.error("Version %d does not match OFTest version %d"
+                                  % (version, OFP_VERSION))
+                self._close()
+                return
+            rawmsg = view.tobytes()
+            self.packets_total += 1
+
+            msg = of_message_parse(rawmsg, lazy=True)
+            if not msg:
+                self.parse_errors += 1
+                self.logger.warn("Could not parse message")
+                continue
+            self._dispatch(msg, rawmsg, msg_type, xid, rcv_time)
+
+    def _dispatch(self, msg, rawmsg, msg_type, xid, rcv_time):
+        future = self.transactions.pop(xid, None)
+        if future is not None:
+            future.set_result((msg, rawmsg, rcv_time))
+            return
+
+        if self.keep_alive and msg_type == OFPT_ECHO_REQUEST:
+            rep = echo_reply()
+            rep.header.xid = xid
+            self._send(rep.pack())
+            return
+
+        streams = self.streams.get(msg_type) or self.streams.get("all")
+        if not streams:
+            self.packets_unclaimed += 1
+            return
+        for stream in streams:
+            stream._deliver((msg, rawmsg, rcv_time))
+
+    def _send(self, data):
+        if self.sock is None:
+            return
+        self.outbuf.append(data)
+        if not self.writing:
+            self._flush()
+
+    def _flush(self):
+        while self.outbuf:
+            data = self.outbuf.popleft()
+            try:
+                sent = self.sock.send(data)
+            except socket.error, e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    sent = 0
+                else:
+                    self.logger.warning("Error on switch write: " + str(e))
+                    self._close()
+                    return
+            if sent < len(data):
+                self.outbuf.appendleft(data[sent:])
+                break
+        writing = len(self.outbuf) > 0
+        if writing != self.writing:
+            self.writing = writing
+            events = select.EPOLLIN
+            if writing:
+                events |= select.EPOLLOUT
+            self.loop.modify_handler(self.fd, events)
+
+    def _echo(self):
+        def check(future):
+            if future.value[0] is None and self.sock is not None:
+                self.logger.warning("No echo reply from %s; closing" %
+                                    str(self.addr))
+                self._close()
+        self.echo_timer = self.loop.call_later(self.echo_interval, self._echo)
+        future = Future()
+        future.add_done_callback(check)
+        self._transact(echo_request(), False, self.echo_interval, future)
+
+    def _transact(self, msg, zero_xid, timeout, future):
+        if not zero_xid and msg.header.xid == 0:
+            msg.header.xid = gen_xid()
+        xid = msg.header.xid
+        if self.sock is None or xid in self.transactions:
+            self.logger.error("Cannot start transaction %d" % xid)
+            future.set_result((None, None, None))
+            return
+        self.transactions[xid] = future
+
+        def expire():
+            if self.transactions.get(xid) is future:
+                del self.transactions[xid]
+                self.logger.warning("No response for xid " + str(xid))
+                future.set_result((None, None, None))
+        if timeout == -1:
+            timeout = ofutils.default_timeout
+        if timeout is None:
+            # default_timeout is only set when running under oft
+            timeout = self.transact_to
+        timer = self.loop.call_later(timeout, expire)
+        future.add_done_callback(lambda f: self.loop.cancel_timer(timer))
+        self._send(msg.pack())
+
+    def transact(self, msg, timeout=-1, zero_xid=False):
+        """
+        Send a request and return a Future for its reply
+
+        @param msg The message object or MessageTemplate to send; must
+        not be a string
+        @param timeout Seconds to wait for the reply; if -1 use default.
+        @param zero_xid Normally, if the XID is 0 an XID will be generated
+        for the message.  Set zero_xid to override this behavior
+        @return A Future whose result is the triple (msg, rawmsg, rcv_time)
+        of the reply, or (None, None, None) on timeout or disconnect
+        """
+        future = Future()
+        self._call(self._transact, msg, zero_xid, timeout, future)
+        return future
+
+    def message_send(self, msg, zero_xid=False):
+        """
+        Queue a message to the switch
+
+        @param msg A string, bytearray or OpenFlow message object
+        @param zero_xid If msg is an OpenFlow object (not a string) and if
+        the XID in the header is 0, then an XID will be generated
+        for the message.  Set zero_xid to override this behavior
+        """
+        if isinstance(msg, bytearray):
+            # Copied, since the caller may reuse it before it is sent
+            msg = str(msg)
+        elif type(msg) != type(""):
+            if msg.header.xid == 0 and not zero_xid:
+                msg.header.xid = gen_xid()
+            msg = msg.pack()
+        self._call(self._send, msg)
+
+    def stream(self, msg_type="all", max_pkts=None):
+        """
+        Start receiving messages of one type
+
+        @param msg_type An OFPT_ message type, or "all" for messages of
+        types that have no stream
+        @param max_pkts Buffer size; defaults to the connection's max_pkts
+        @return A new MessageStream
+        """
+        stream = MessageStream(self, msg_type, max_pkts or self.max_pkts)
+
+        def add():
+            # Replace the list so a dispatch in progress is not affected
+            self.streams[msg_type] = self.streams.get(msg_type, []) + [stream]
+        self._call(add)
+        return stream
+
+    def _stream_remove(self, stream):
+        streams = [s for s in self.streams.get(stream.msg_type, [])
+                   if s is not stream]
+        if streams:
+            self.streams[stream.msg_type] = streams
+        else:
+            self.streams.pop(stream.msg_type, None)
+
+    def _close(self):
+        if self.sock is None:
+            return
+        self.loop.remove_handler(self.fd)
+        try:
+            self.sock.close()
+        except:
+            self.logger.info("Ignoring switch socket close error")
+        self.sock = None
+        self.outbuf.clear()
+        if self.echo_timer is not None:
+            self.loop.cancel_timer(self.echo_timer)
+        transactions = self.transactions
+        self.transactions = {}
+        for future in transactions.values():
+            future.set_result((None, None, None))
+        for streams in self.streams.values():
+            for stream in streams:
+                stream.closed = True
+                while stream.waiters:
+                    stream.waiters.popleft().cancel()
+        self.streams = {}
+        self.closed.set_result(True)
+
+    def close(self):
+        """
+        Close the connection; pending transactions complete with no reply
+        """
+        self._call(self._close)
+
+class EventController:
+    """
+    Listen for switch connections on an EventLoop
+
+    Each accepted connection becomes a SwitchConnection.  Several
+    controllers, on different ports, may share one loop.
+
+    @var connections List of SwitchConnection objects accepted
+    """
+
+    def __init__(self, loop, host='127.0.0.1', port=6633, keep_alive=True,
+                 initial_hello=True, echo_interval=None, max_pkts=1024):
+        """
+        @param loop The EventLoop to run on
+        @param host The address to listen on
+        @param port The port to listen on
+        @param keep_alive Passed to each SwitchConnection
+        @param initial_hello If True, send a hello on each new connection
+        @param echo_interval Passed to each SwitchConnection
+        @param max_pkts Passed to each SwitchConnection
+        """
+        self.loop = loop
+        self.host = host
+        self.port = port
+        self.keep_alive = keep_alive
+        self.initial_hello = initial_hello
+        self.echo_interval = echo_interval
+        self.max_pkts = max_pkts
+        self.listen_socket = None
+        self.connections = []
+        self.unclaimed = deque()
+        self.waiters = deque()
+        self.logger = logging.getLogger("evcontroller")
+
+    def start(self):
+        """
+        Open the listening socket and start accepting connections
+        """
+        self.logger.info("Create/listen at " + self.host + ":" +
+                         str(self.port))
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self.host, self.port))
+        sock.listen(16)
+        sock.setblocking(0)
+        self.listen_socket = sock
+        self.loop.call_soon(self.loop.add_handler, sock.fileno(),
+                            self._accept_handle, select.EPOLLIN)
+
+    def _accept_handle(self, events):
+        while True:
+            try:
+                (sock, addr) = self.listen_socket.accept()
+            except socket.error, e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                if e.errno == errno.EINTR:
+                    continue
+                self.logger.warning("Error on accept: " + str(e))
+                return
+            self.logger.info("Incoming connection from %s" % str(addr))
+            cxn = SwitchConnection(self.loop, sock, addr,
+                                   keep_alive=self.keep_alive,
+                                   echo_interval=self.echo_interval,
+                                   max_pkts=self.max_pkts)
+            self.connections.append(cxn)
+            if self.initial_hello:
+                cxn.message_send(hello())
+            self._claim(cxn)
+
+    def _claim(self, cxn):
+        while self.waiters:
+            if self.waiters.popleft().set_result(cxn):
+                return
+        self.unclaimed.append(cxn)
+
+    def _accept(self, future):
+        if self.unclaimed:
+            future.set_result(self.unclaimed.popleft())
+        else:
+            self.waiters.append(future)
+
+    def accept(self):
+        """
+        @return A Future for the next switch connection not yet
+        returned by accept
+        """
+        future = Future()
+        self.loop.call_soon(self._accept, future)
+        return future
+
+    def connect(self, timeout=-1):
+        """
+        Wait for a switch to connect; not for use on the loop thread
+        @param timeout The timeout in seconds; if -1 use default.
+        @return A SwitchConnection, or None on timeout
+        """
+        future = self.accept()
+        cxn = future.result(timeout=timeout)
+        if cxn is None and not future.cancel():
+            cxn = future.value
+        return cxn
+
+    def kill(self):
+        """
+        Stop listening and close every connection
+        """
+        def closer():
+            if self.listen_socket is not None:
+                self.loop.remove_handler(self.listen_socket.fileno())
+                self.listen_socket.close()
+                self.listen_socket = None
+            for cxn in self.connections:
+                cxn._close()
+            while self.waiters:
+                self.waiters.popleft().cancel()
+        self.loop.call_soon(closer)
@@ -0,0 +1,169 @@
+"""
+OpenFlow Test Framework
+
+Bulk flow installation
+
+FlowInstaller sends flow_mods in windows.  A window is a fixed number of
+flow_mods followed by a barrier request, all sent in one write.  Up to
+max_windows windows are in flight; the oldest barrier reply is awaited
+before another window is sent.  Every flow_mod is entered in the
+controller's transaction table by xid, so an OFPT_ERROR it causes
+completes its transaction instead of going to poll or a handler.  The
+switch answers a barrier only after the messages before it, so when
+the barrier reply arrives, the flow_mods of the window that have no
+error are known to be installed:
+
+    installer = flowinstall.FlowInstaller(self.controller, window=200)
+    installer.install(flow_mods)
+    self.assertEqual(installer.errors, [], "Flow install errors")
+    logging.info(str(installer))
+
+flow_mods may be any iterable, including a generator that restamps one
+msgtemplate.MessageTemplate: each message is packed when it is taken.
+The flow_mod reported with an error is parsed from the bytes that were
+sent, so it is the one that failed even if the template has since been
+stamped again.
+"""
+
+import time
+import logging
+import itertools
+from collections import deque
+import message
+from parse import of_message_parse
+
+class FlowInstaller:
+    """
+    Install many flow_mods with windowed barriers
+
+    @var window Flow mods sent before each barrier
+    @var max_windows Windows that may await their barrier reply
+    @var timeout Seconds to wait for each barrier reply; if -1 use default
+    @var sent Number of flow_mods sent
+    @var installed Number of flow_mods confirmed by a barrier with no error
+    @var errors List of (index, flow_mod, error message) for each flow_mod
+    that drew an error; index counts from 0 in the order flow_mods were
+    taken, across calls to install.  flow_mod is a message object parsed
+    from the bytes sent, not the object passed in.
+    @var unconfirmed Number of flow_mods whose barrier reply never came
+    @var elapsed Seconds spent in install
+    """
+
+    def __init__(self, controller, window=100, max_windows=4, timeout=-1):
+        """
+        @param controller The Controller to send on
+        @param window Flow mods sent before each barrier
+        @param max_windows Windows that may await their barrier reply
+        @param timeout Seconds to wait for each barrier reply; if -1 use
+        default.
+        """
+        if window < 1 or max_windows < 1:
+            raise Exception("window and max_windows must be positive")
+        self.controller = controller
+        self.window = window
+        self.max_windows = max_windows
+        self.timeout = timeout
+        self.logger = logging.getLogger("flowinstall")
+        self.sent = 0
+        self.installed = 0
+        self.errors = []
+        self.unconfirmed = 0
+        self.elapsed = 0.0
+
+    def _window_msgs(self, flow_mods):
+        """
+        Generate the messages of the next window
+
+        Yields up to window flow_mods taken from the iterator flow_mods
+        and then a barrier request, or nothing once flow_mods is
+        exhausted.
+        """
+        count = 0
+        for msg in itertools.islice(flow_mods, self.window):
+            count += 1
+            yield msg
+        if count > 0:
+            yield message.barrier_request()
+
+    def _window_finish(self, window):
+        """
+        Wait for a window's barrier reply and account for its flow_mods
+
+        @param window The triple (index of the first flow_mod, flow_mod
+        transactions, barrier transaction)
+        """
+        (first, flow_trans, barrier_trans) = window
+        self.controller.transact_wait_all([barrier_trans],
+                                          timeout=self.timeout)
+        # Errors arrive before the barrier reply, so the flow_mods still
+        # waiting succeeded
+        self.controller.transact_cancel(flow_trans)
+        for (offset, trans) in enumerate(flow_trans):
+            if trans.response is not None:
+                (msg, rawmsg) = trans.response
+                self.logger.debug("Error for flow_mod %d, xid %d" %
+                                  (first + offset, trans.xid))
+                # trans.msg may be a template restamped since; report
+                # the flow_mod as it was sent
+                self.errors.append((first + offset,
+                                    of_message_parse(trans.data), msg))
+            elif barrier_trans.response is None:
+                self.unconfirmed += 1
+            else:
+                self.installed += 1
+
+    def install(self, flow_mods):
+        """
+        Send flow_mods and wait until all are confirmed
+
+        @param flow_mods Iterable of flow_mod message objects or
+        MessageTemplates
+        @return True if every flow_mod was installed without error
+        """
+        errors = len(self.errors)
+        unconfirmed = self.unconfirmed
+        start = time.time()
+        flow_mods = iter(flow_mods)
+        pending = deque()
+        try:
+            while True:
+                if len(pending) >= self.max_windows:
+                    self._window_finish(pending.popleft())
+                transactions = self.controller.transact_start_batch(
+                    self._window_msgs(flow_mods))
+                if not transactions:
+                    break
+                pending.append((self.sent, transactions[:-1],
+                                transactions[-1]))
+                self.sent += len(transactions) - 1
+            while pending:
+                self._window_finish(pending.popleft())
+        finally:
+            for (first, flow_trans, barrier_trans) in pending:
+                self.controller.transact_cancel(flow_trans + [barrier_trans])
+            self.elapsed += time.time() - start
+        self.logger.info("Installed %d flows in %.3f s, %d errors" %
+                         (self.installed, self.elapsed, len(self.errors)))
+        return len(self.errors) == errors and self.unconfirmed == unconfirmed
+
+    def rate(self):
+        """
+        Return the install rate in flows per second, or None
+        """
+        if self.elapsed == 0:
+            return None
+        return self.installed / self.elapsed
+
+    def __str__(self):
+        string = "FlowInstaller:\n"
+        string += "  window          " + str(self.window) + "\n"
+        string += "  max windows     " + str(self.max_windows) + "\n"
+        string += "  sent            " + str(self.sent) + "\n"
+        string += "  installed       " + str(self.installed) + "\n"
+        string += "  errors          " + str(len(self.errors)) + "\n"
+        string += "  unconfirmed     " + str(self.unconfirmed) + "\n"
+        string += "  elapsed         %.3f s\n" % self.elapsed
+        rate = self.rate()
+        if rate is not None:
+            string += "  rate            %.0f flows/s\n" % rate
+        return string
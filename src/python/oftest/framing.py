@@ -0,0 +1,147 @@
+"""
+OpenFlow Test Framework
+
+Control channel framing
+
+MessageFramer receives a switch stream straight into a bytearray with
+recv_into and splits it into OpenFlow messages using the length in
+the 8 byte header.  Each message is handed out as a memoryview of the
+buffer, so received bytes are copied once by the kernel and at most
+once more when the caller keeps a message:
+
+    framer = MessageFramer()
+    while framer.recv(sock) > 0:
+        for view in framer.messages():
+            rawmsg = view.tobytes()
+
+The unconsumed tail is moved to a fresh buffer only when the free space
+runs short, and the buffer grows to hold any message the header
+announces.  A view is only valid until the next recv or feed, which may
+overwrite the bytes under it.  Note str() of a memoryview does not
+return its bytes in Python 2; use tobytes().
+"""
+
+import struct
+
+OFP_HEADER_LEN = 8
+
+##@var RCV_SIZE
+# Default bytes requested per recv_into call
+RCV_SIZE = 32768
+
+class MessageFramer:
+    """
+    Reassemble OpenFlow messages from a stream socket
+
+    @var start Offset of the first unconsumed byte in buf
+    @var end Offset just past the last received byte in buf
+    @var bytes_total Number of bytes received
+    @var copies Number of times the unconsumed tail was moved
+    """
+
+    def __init__(self, rcv_size=RCV_SIZE):
+        """
+        @param rcv_size Bytes requested per recv; the buffer starts at
+        four times this size
+        """
+        self.rcv_size = rcv_size
+        self.buf = bytearray(4 * rcv_size)
+        self.start = 0
+        self.end = 0
+        self.bytes_total = 0
+        self.copies = 0
+
+    def __len__(self):
+        """
+        Return the number of bytes buffered and not yet consumed
+        """
+        return self.end - self.start
+
+    def _reserve(self, size):
+        """
+        Make room for size more bytes after end
+
+        The pending bytes are moved into a new buffer, which is grown
+        if the message at the head is longer than the current one.
+        """
+        if len(self.buf) - self.end >= size:
+            return
+        pending = self.end - self.start
+        capacity = len(self.buf)
+        if pending >= 4:
+            (length,) = struct.unpack_from("!H", self.buf, self.start + 2)
+            capacity = max(capacity, length + size)
+        capacity = max(capacity, pending + size)
+        buf = bytearray(capacity)
+        buf[0:pending] = self.buf[self.start:self.end]
+        self.buf = buf
+        self.start = 0
+        self.end = pending
+        self.copies += 1
+
+    def recv(self, sock, size=None):
+        """
+        Receive into the buffer with one recv_into call
+
+        Socket errors, including EAGAIN on a non-blocking socket, are
+        passed to the caller.
+
+        @param sock The socket to read
+        @param size Bytes to request; default rcv_size
+        @return The number of bytes received, 0 at end of stream
+        """
+        if size is None:
+            size = self.rcv_size
+        if self.start == self.end:
+            self.start = self.end = 0
+        self._reserve(size)
+        count = sock.recv_into(memoryview(self.buf)[self.end:], size)
+        self.end += count
+        self.bytes_total += count
+        return count
+
+    def feed(self, data):
+        """
+        Append bytes received by other means
+        @param data A string
+        """
+        self._reserve(len(data))
+        self.buf[self.end:self.end + len(data)] = data
+        self.end += len(data)
+        self.bytes_total += len(data)
+
+    def next_message(self):
+        """
+        Consume the next complete message
+
+        A header with a length shorter than the header raises an
+        exception and leaves the message unconsumed.
+        @return The message as a memoryview, or None if no complete
+        message is buffered
+        """
+        if self.end - self.start < OFP_HEADER_LEN:
+            return None
+        (length,) = struct.unpack_from("!H", self.buf, self.start + 2)
+        if length < OFP_HEADER_LEN:
+            raise Exception("Bad OpenFlow message length %d" % length)
+        if self.start + length > self.end:
+            return None
+        view = memoryview(self.buf)[self.start:self.start + length]
+        self.start += length
+        return view
+
+    def messages(self):
+        """
+        Generator yielding each complete message as a memoryview
+        """
+        while True:
+            view = self.next_message()
+            if view is None:
+                return
+            yield view
+
+    def peek(self, count):
+        """
+        Return up to count unconsumed bytes as a string, for debugging
+        """
+        return str(self.buf[self.start:min(self.end, self.start + count)])
@@ -92,7 +92,7 @@ class illegal_message_type:
         @param other Other object in comparison
 
         """
-        if type(self) != type(other): return False
+        if type(self) != type(other): return NotImplemented
         if not self.header.__eq__(other.header): return False
 
         if self.data != other.data: return False
@@ -105,4 +105,6 @@ class illegal_message_type:
         @param other Other object in comparison
 
         """
-        return not self.__eq__(other)
+        eq = self.__eq__(other)
+        if eq is NotImplemented: return eq
+        return not eq
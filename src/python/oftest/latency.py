@@ -0,0 +1,286 @@
+"""
+OpenFlow Test Framework
+
+Latency, loss and reordering measurement with payload signatures
+
+In measurement mode the dataplane overwrites the last SIG_LEN bytes of
+every frame it sends with a signature:
+
+    magic (4 bytes) | stream id (2) | sequence number (4) | tx time (8)
+
+The tx time is in nanoseconds on the ofutils.timestamp() clock, the
+same clock as the kernel receive timestamps.  The signature sits at the
+end of the frame so header rewrites, VLAN push/pop and encapsulation by
+the switch leave it in place.  The frame length is unchanged; L4
+checksums are not updated, which switches do not verify.  Frames must
+be at least MIN_FRAME_LEN bytes so Ethernet padding cannot be appended
+after the signature.
+
+The receive side checks the tail of each frame in the port thread.
+Signed frames are counted into a LatencyMeter and never queued, so a
+test can offer traffic at a high rate and read back statistics per
+(stream, receive port):
+
+    meter = dp.measure_start()
+    gen = trafficgen.TrafficGen(dp, [(1, pkt)], pps=10000, duration=5)
+    gen.run()
+    time.sleep(0.1) # let frames in flight arrive
+    dp.measure_stop()
+    meter.show()
+"""
+
+import math
+import struct
+import logging
+from threading import Lock
+from ofutils import *
+
+SIG_MAGIC = "OFTs"
+SIG = struct.Struct("!4sHIQ")
+SIG_LEN = SIG.size
+
+##@var MIN_FRAME_LEN
+# Shortest frame that can carry a signature: minimum Ethernet frame
+# without CRC, so the tail is never padding
+MIN_FRAME_LEN = 60
+
+##@var REORDER_WINDOW
+# Sequence numbers this far behind the highest seen are forgotten;
+# duplicates older than that are not detected
+REORDER_WINDOW = 4096
+
+def sign(pkt, stream_id, seq, tx_time):
+    """
+    Return pkt with its tail overwritten by a signature
+
+    @param pkt The frame as a string
+    @param stream_id Stream id, 0 to 65535
+    @param seq Sequence number within the stream
+    @param tx_time Send time on the ofutils.timestamp() clock
+    """
+    if len(pkt) < MIN_FRAME_LEN:
+        raise Exception("Frame of %d bytes too short to sign" % len(pkt))
+    return pkt[:-SIG_LEN] + SIG.pack(SIG_MAGIC, stream_id,
+                                     seq & 0xffffffff,
+                                     int(tx_time * 1e9))
+
+def signature_parse(pkt):
+    """
+    Extract the signature from a frame
+    @return The triple (stream_id, seq, tx_time) or None if unsigned
+    """
+    if len(pkt) < MIN_FRAME_LEN or pkt[-SIG_LEN:-SIG_LEN + 4] != SIG_MAGIC:
+        return None
+    (magic, stream_id, seq, tx_ns) = SIG.unpack_from(pkt, len(pkt) - SIG_LEN)
+    return (stream_id, seq, tx_ns * 1e-9)
+
+class LatencyHistogram:
+    """
+    Log-linear latency histogram
+
+    Each power of two is split into SUB_BUCKETS buckets, so a
+    percentile is reported within about 1/SUB_BUCKETS of its value at
+    any scale.  Values are in seconds; the resolution floor is 1 ns.
+    """
+
+    SUB_BUCKETS = 32
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def _index(self, ns):
+        if ns < self.SUB_BUCKETS:
+            return ns
+        (mant, exp) = math.frexp(ns) # ns = mant * 2**exp, 0.5 <= mant < 1
+        return exp * self.SUB_BUCKETS + int((mant * 2 - 1) * self.SUB_BUCKETS)
+
+    def _upper(self, index):
+        """
+        Return the largest value in ns that falls in bucket index
+        """
+        if index < self.SUB_BUCKETS:
+            return index
+        (exp, sub) = divmod(index, self.SUB_BUCKETS)
+        return math.ldexp(1 + float(sub + 1) / self.SUB_BUCKETS, exp - 1) - 1
+
+    def add(self, value):
+        """
+        Record one latency sample in seconds
+        """
+        ns = max(0, int(value * 1e9))
+        index = self._index(ns)
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def avg(self):
+        if self.count == 0:
+            return None
+        return self.total / self.count
+
+    def percentile(self, pct):
+        """
+        Return the latency below which pct percent of samples fall
+
+        Reported as the top of the bucket, capped at the maximum seen.
+        """
+        if self.count == 0:
+            return None
+        rank = max(1, int(math.ceil(self.count * pct / 100.0)))
+        seen = 0
+        for index in sorted(self.buckets.keys()):
+            seen += self.buckets[index]
+            if seen >= rank:
+                return min(self._upper(index) * 1e-9, self.max)
+        return self.max
+
+class StreamStats:
+    """
+    Statistics for one stream as seen on one receive port
+
+    @var received Frames received, including duplicates
+    @var duplicates Frames whose sequence number was already seen
+    @var reordered Frames with a sequence number below the highest seen
+    @var max_seq Highest sequence number seen
+    @var latency LatencyHistogram of tx to rx time
+    """
+
+    def __init__(self):
+        self.received = 0
+        self.duplicates = 0
+        self.reordered = 0
+        self.max_seq = None
+        self.seen = set()
+        self.latency = LatencyHistogram()
+
+    def rx(self, seq, latency):
+        """
+        Record a received frame
+        """
+        self.received += 1
+        if seq in self.seen:
+            self.duplicates += 1
+            return
+        self.seen.add(seq)
+        if self.max_seq is None or seq > self.max_seq:
+            self.max_seq = seq
+        elif seq < self.max_seq:
+            self.reordered += 1
+        self.latency.add(latency)
+        if len(self.seen) > 2 * REORDER_WINDOW:
+            floor = self.max_seq - REORDER_WINDOW
+            self.seen = set([s for s in self.seen if s >= floor])
+
+    def unique(self):
+        return self.received - self.duplicates
+
+class LatencyMeter:
+    """
+    Sign transmitted frames and collect per-stream receive statistics
+
+    Frames are signed with a per-stream sequence number starting at 0.
+    Loss for a stream on a port is the number of frames signed for the
+    stream less the unique frames received, so frames still in flight
+    count as lost until they arrive.
+
+    @var tx_count Map from stream id to number of frames signed
+    @var streams Map from (stream id, rx port number) to StreamStats
+    """
+
+    def __init__(self):
+        self.tx_count = {}
+        self.streams = {}
+        self.lock = Lock()
+        self.logger = logging.getLogger("latency")
+
+    def tx_sign(self, stream_id, pkt):
+        """
+        Sign a frame for sending on stream stream_id
+        @return The signed frame
+        """
+        with self.lock:
+            seq = self.tx_count.get(stream_id, 0)
+            self.tx_count[stream_id] = seq + 1
+        return sign(pkt, stream_id, seq, timestamp())
+
+    def rx_batch(self, port_number, pkts):
+        """
+        Account for signed frames in a batch received on a port
+
+        @param port_number The port the batch was received on
+        @param pkts List of (packet, receive time) pairs
+        @return List of the pairs that were not signed
+        """
+        rest = []
+        with self.lock:
+            for (pkt, rcv_time) in pkts:
+                sig = signature_parse(pkt)
+                if sig is None:
+                    rest.append((pkt, rcv_time))
+                    continue
+                (stream_id, seq, tx_time) = sig
+                key = (stream_id, port_number)
+                stats = self.streams.get(key)
+                if stats is None:
+                    stats = self.streams[key] = StreamStats()
+                stats.rx(seq, rcv_time - tx_time)
+        return rest
+
+    def loss(self, stream_id, port_number):
+        """
+        Return frames sent on stream_id and not received on port_number
+        """
+        stats = self.streams.get((stream_id, port_number))
+        sent = self.tx_count.get(stream_id, 0)
+        if stats is None:
+            return sent
+        return max(0, sent - stats.unique())
+
+    def summary(self):
+        """
+        Return a dictionary from (stream id, rx port) to a dictionary of
+        counts and latencies in seconds: sent, received, lost, duplicates,
+        reordered, min, avg, p50, p99 and max
+        """
+        result = {}
+        with self.lock:
+            for (key, stats) in self.streams.items():
+                hist = stats.latency
+                result[key] = {
+                    "sent"       : self.tx_count.get(key[0], 0),
+                    "received"   : stats.received,
+                    "lost"       : self.loss(key[0], key[1]),
+                    "duplicates" : stats.duplicates,
+                    "reordered"  : stats.reordered,
+                    "min"        : hist.min,
+                    "avg"        : hist.avg(),
+                    "p50"        : hist.percentile(50),
+                    "p99"        : hist.percentile(99),
+                    "max"        : hist.max
+                }
+        return result
+
+    def __str__(self):
+        us = lambda v: v is None and "-" or "%.1f" % (v * 1e6)
+        string = "LatencyMeter (latency in us):\n"
+        string += "  stream port     sent     rcvd     lost  dup  reord" + \
+            "      min      avg      p50      p99      max\n"
+        summary = self.summary()
+        for key in sorted(summary.keys()):
+            s = summary[key]
+            string += "  %6d %4d %8d %8d %8d %4d %6d %8s %8s %8s %8s %8s\n" % \
+                (key[0], key[1], s["sent"], s["received"], s["lost"],
+                 s["duplicates"], s["reordered"], us(s["min"]),
+                 us(s["avg"]), us(s["p50"]), us(s["p99"]), us(s["max"]))
+        return string
+
+    def show(self):
+        print str(self)
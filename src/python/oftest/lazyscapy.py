@@ -0,0 +1,62 @@
+"""
+OpenFlow Test Framework
+
+Deferred scapy import
+
+Importing scapy takes seconds and a lot of memory, and control plane
+suites never build or dissect a packet.  Modules use the scapy object
+defined here in place of the scapy module; the real import happens on
+the first attribute access, e.g. the first scapy.Ether(...).
+
+    from lazyscapy import scapy
+
+Setting disabled (oft --no-scapy) makes that first access fail instead,
+so a run can be kept entirely free of scapy.
+"""
+
+import sys
+
+##@var disabled
+# If True, refuse to import scapy
+disabled = False
+
+_scapy = None
+
+def load():
+    """
+    Import scapy if that has not been done yet and return the module
+    """
+    global _scapy
+    if _scapy is None:
+        if disabled:
+            raise ImportError("scapy is disabled for this run (--no-scapy)")
+        try:
+            import scapy.all as module
+        except:
+            try:
+                import scapy as module
+            except:
+                sys.exit("Need to install scapy for packet parsing")
+        _scapy = module
+    return _scapy
+
+def loaded():
+    """
+    Return True if scapy has been imported
+    """
+    return _scapy is not None
+
+class LazyScapy:
+    """
+    Stand-in for the scapy module that imports it on first use
+    """
+
+    def __getattr__(self, name):
+        return getattr(load(), name)
+
+    def __repr__(self):
+        if loaded():
+            return repr(_scapy)
+        return "<scapy, not yet imported>"
+
+scapy = LazyScapy()
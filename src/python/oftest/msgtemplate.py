@@ -0,0 +1,187 @@
+"""
+OpenFlow Test Framework
+
+Prebuilt OpenFlow messages
+
+A MessageTemplate packs a message object once and afterwards changes
+only the xid, and optionally a few named integer fields, in place with
+pack_into.  Requests that are sent over and over with nothing but a
+new xid, such as barriers, echoes and stats polls, then cost a
+pack_into and a copy instead of a full encode:
+
+    barrier = msgtemplate.MessageTemplate(message.barrier_request())
+    for i in range(count):
+        (resp, pkt) = self.controller.transact(barrier.stamp())
+
+stamp() gives the template a new xid and returns it.  A template has a
+header.xid and a pack() like a message object, so Controller.transact,
+transact_start and message_send and the EventController's
+SwitchConnection accept it in place of one.  The current bytes are also
+available as a bytearray in buf, which Controller.message_send takes
+directly.  The controllers read the xid and copy the bytes when the
+request is sent, so one template can be stamped and sent again while
+earlier requests are outstanding:
+
+    trans = [self.controller.transact_start(barrier.stamp())
+             for i in range(count)]
+    self.controller.transact_wait_all(trans)
+
+Named fields are given as attribute paths of the message object, for
+example "priority" or "match.in_port".  Their offsets are found when
+the template is built by packing the message with different values in
+the field:
+
+    fm = msgtemplate.MessageTemplate(flow_mod, fields=["match.in_port"])
+    for port in ports:
+        self.controller.message_send(fm.stamp(match_in_port=port))
+
+In keyword arguments the dots become underscores.  Only fixed size
+integer fields can be named; members that change the message length,
+such as data or an action list, cannot.
+"""
+
+import struct
+from ofutils import gen_xid
+
+# Offset and format of the xid in the OpenFlow header
+XID_OFFSET = 4
+XID = struct.Struct("!L")
+
+# Field formats tried when locating a field, widest first
+_FIELD_FORMATS = [(8, "!Q"), (4, "!L"), (2, "!H"), (1, "!B")]
+
+def _resolve(msg, name):
+    """
+    Return the object holding attribute name of msg and the attribute
+
+    @param msg A message object
+    @param name A dotted attribute path such as "match.in_port"
+    """
+    path = name.split(".")
+    obj = msg
+    for attr in path[:-1]:
+        obj = getattr(obj, attr)
+    if not hasattr(obj, path[-1]):
+        raise Exception("Message has no field " + name)
+    return (obj, path[-1])
+
+def _pack_with(msg, obj, attr, value):
+    """
+    Pack msg with attribute attr of obj set to value
+
+    @return The packed string, or None if the value does not fit
+    """
+    setattr(obj, attr, value)
+    try:
+        return msg.pack()
+    except struct.error:
+        return None
+
+def _diff(a, b):
+    return [i for i in range(len(a)) if a[i] != b[i]]
+
+def field_locate(msg, name):
+    """
+    Find where an integer field of a message object is packed
+
+    The field is packed with a few probe values and the packed strings
+    compared.  The field's value is restored afterwards.
+
+    @param msg A message object
+    @param name A dotted attribute path such as "match.in_port"
+    @return The pair (offset, struct.Struct) for the field
+    """
+    (obj, attr) = _resolve(msg, name)
+    saved = getattr(obj, attr)
+    if not isinstance(saved, (int, long)):
+        raise Exception("Field " + name + " is not an integer")
+    try:
+        zero = _pack_with(msg, obj, attr, 0)
+        one = _pack_with(msg, obj, attr, 1)
+        if zero is None or one is None or len(zero) != len(one) or \
+                len(_diff(zero, one)) != 1:
+            raise Exception("Cannot locate field " + name)
+        end = _diff(zero, one)[0] + 1
+        for (width, fmt) in _FIELD_FORMATS:
+            if end < width:
+                continue
+            # Only a field at least width bytes long takes this value
+            probe = _pack_with(msg, obj, attr, 1 << (8 * width - 8))
+            if probe is not None and len(probe) == len(zero) and \
+                    _diff(zero, probe) == [end - width]:
+                return (end - width, struct.Struct(fmt))
+        raise Exception("Cannot locate field " + name)
+    finally:
+        setattr(obj, attr, saved)
+
+class MessageTemplate(object):
+    """
+    A packed message whose xid and named fields can be changed in place
+
+    @var buf The packed message as a bytearray
+    @var msg_type The OFPT_ type of the message
+    @var fields Map from keyword name to (offset, struct.Struct)
+    """
+
+    def __init__(self, msg, fields=[]):
+        """
+        @param msg The message object to pack; it is not kept
+        @param fields List of attribute paths of msg to be set by
+        set() and stamp()
+        """
+        self.fields = {}
+        for name in fields:
+            self.fields[name.replace(".", "_")] = field_locate(msg, name)
+        self.msg_type = msg.header.type
+        self.buf = bytearray(msg.pack())
+
+    # Controllers read and set header.xid of the messages they send
+    header = property(lambda self: self)
+
+    def _xid_get(self):
+        return XID.unpack_from(self.buf, XID_OFFSET)[0]
+
+    def _xid_set(self, xid):
+        XID.pack_into(self.buf, XID_OFFSET, xid)
+
+    xid = property(_xid_get, _xid_set)
+
+    def set(self, **fields):
+        """
+        Change named fields in place
+
+        @param fields Keyword arguments naming fields given to the
+        constructor, with dots replaced by underscores
+        """
+        for (name, value) in fields.items():
+            if name not in self.fields:
+                raise Exception("Template has no field " + name)
+            (offset, codec) = self.fields[name]
+            codec.pack_into(self.buf, offset, value)
+
+    def stamp(self, xid=None, **fields):
+        """
+        Give the message a new xid and change named fields
+
+        @param xid The xid to use; if None one is generated
+        @param fields As for set()
+        @return self, to be passed to transact or message_send
+        """
+        if xid is None:
+            xid = gen_xid()
+        XID.pack_into(self.buf, XID_OFFSET, xid)
+        if fields:
+            self.set(**fields)
+        return self
+
+    def pack(self):
+        """
+        Return the current message as a string
+        """
+        return str(self.buf)
+
+    def __len__(self):
+        return len(self.buf)
+
+    def __str__(self):
+        return str(self.buf)
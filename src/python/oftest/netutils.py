@@ -25,6 +25,10 @@ Network utilities for the OpenFlow test framework
 import socket
 from fcntl import ioctl
 import struct
+import select
+import errno
+import ctypes
+import ctypes.util
 
 # From net/if_arp.h
 ARPHDR_ETHER = 1
@@ -33,14 +37,30 @@ ARPHDR_LOOPBACK = 772
 # From bits/ioctls.h
 SIOCGIFHWADDR  = 0x8927          # Get hardware address
 SIOCGIFINDEX   = 0x8933          # name -> if_index mapping
+SIOCGSTAMPNS   = 0x8907          # Receive timestamp of last packet
 
 # From netpacket/packet.h
 PACKET_ADD_MEMBERSHIP  = 1
+PACKET_DROP_MEMBERSHIP = 2
 PACKET_MR_PROMISC      = 1
+PACKET_RX_RING         = 5
+PACKET_VERSION         = 10
+
+# From linux/if_packet.h
+TPACKET_V3             = 2
+TP_STATUS_KERNEL       = 0
+TP_STATUS_USER         = 1
+TP_STATUS_VLAN_VALID   = 0x10
+TP_STATUS_VLAN_TPID_VALID = 0x40
+TP_FT_REQ_FILL_RXHASH  = 1
 
 # From bits/socket.h
 SOL_PACKET = 263
 
+# From asm-generic/socket.h
+SO_ATTACH_FILTER = 26
+SO_DETACH_FILTER = 27
+
 def get_if(iff,cmd):
   s=socket.socket()
   ifreq = ioctl(s, cmd, struct.pack("16s16x",iff))
@@ -65,3 +85,114 @@ def set_promisc(s,iff,val=1):
       cmd = PACKET_DROP_MEMBERSHIP
   s.setsockopt(SOL_PACKET, cmd, mreq)
 
+def enable_timestamps(s):
+  """
+  Ask the kernel to timestamp packets received on socket s
+
+  The first SIOCGSTAMPNS on a socket turns timestamping on and fails
+  with ENOENT since no packet has been stamped yet.
+  """
+  try:
+    get_timestamp(s)
+  except IOError, e:
+    if e.errno != errno.ENOENT:
+      raise
+
+def get_timestamp(s):
+  """
+  Return the kernel receive time of the last packet read from s
+
+  The kernel stamps packets from CLOCK_REALTIME, as seen by time.time().
+  @param s A socket or file descriptor
+  @return Seconds since the epoch as a float
+  """
+  (sec, nsec) = struct.unpack("ll", ioctl(s, SIOCGSTAMPNS, "\0" * 16))
+  return sec + nsec * 1e-9
+
+def set_rx_ring(s, block_size, block_nr, frame_size, retire_blk_tov=0):
+  """
+  Switch a packet socket to TPACKET_V3 and request a receive ring
+
+  Must be called before the socket is bound.  The ring is
+  block_size * block_nr bytes and should be mmap'd by the caller.
+  @param retire_blk_tov Block retire timeout in ms; 0 lets the kernel pick
+  """
+  s.setsockopt(SOL_PACKET, PACKET_VERSION, TPACKET_V3)
+  frame_nr = (block_size / frame_size) * block_nr
+  req = struct.pack("IIIIIII", block_size, block_nr, frame_size, frame_nr,
+                    retire_blk_tov, 0, 0)
+  s.setsockopt(SOL_PACKET, PACKET_RX_RING, req)
+
+
+def attach_filter(s, prog):
+  """
+  Attach a classic BPF program to a socket
+  @param s The socket
+  @param prog The packed struct sock_filter array (see bpf.filter_pack)
+  """
+  buf = ctypes.create_string_buffer(prog, len(prog))
+  fprog = struct.pack("HL", len(prog) / 8, ctypes.addressof(buf))
+  s.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, fprog)
+
+def detach_filter(s):
+  s.setsockopt(socket.SOL_SOCKET, SO_DETACH_FILTER, 0)
+
+##@var sendmmsg
+# libc sendmmsg(2), or None if the C library does not provide it
+_libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+sendmmsg = getattr(_libc, "sendmmsg", None)
+
+# struct iovec and struct mmsghdr (native layout; size_t is unsigned long)
+IOVEC = struct.Struct("PL")
+MMSGHDR = struct.Struct("PI4xPLPLi4xI4x")
+MMSGHDR_LEN_OFFSET = 56
+
+def send_batch(s, frames, timeout=1):
+  """
+  Send a list of frames on a connected or bound socket
+
+  Uses a single sendmmsg call when possible.  The frames are copied
+  into one buffer and the iovec and mmsghdr arrays are packed with
+  struct, which is much cheaper than filling ctypes structures.  If the
+  socket buffer fills, waits up to timeout seconds for it to drain
+  before giving up.
+  @param s The socket
+  @param frames List of strings to send
+  @return List giving the number of bytes sent for each frame
+  """
+  if sendmmsg is None:
+    return [s.send(frame) for frame in frames]
+
+  count = len(frames)
+  data = "".join(frames)
+  addr = ctypes.cast(ctypes.c_char_p(data), ctypes.c_void_p).value
+  iov_fields = []
+  for frame in frames:
+    iov_fields.append(addr)
+    iov_fields.append(len(frame))
+    addr += len(frame)
+  iovs = ctypes.create_string_buffer(
+    struct.pack("PL" * count, *iov_fields), IOVEC.size * count)
+  iov_addr = ctypes.addressof(iovs)
+  msgs = ctypes.create_string_buffer(
+    "".join([MMSGHDR.pack(0, 0, iov_addr + idx * IOVEC.size, 1, 0, 0, 0, 0)
+             for idx in xrange(count)]), MMSGHDR.size * count)
+  msgs_addr = ctypes.addressof(msgs)
+
+  fd = s.fileno()
+  done = 0
+  while done < count:
+    rv = sendmmsg(fd, ctypes.c_void_p(msgs_addr + done * MMSGHDR.size),
+                  count - done, 0)
+    if rv < 0:
+      err = ctypes.get_errno()
+      if err == errno.EINTR:
+        continue
+      if err in [errno.EAGAIN, errno.ENOBUFS]:
+        if select.select([], [s], [], timeout)[1]:
+          continue
+      break
+    done += rv
+  sent = struct.unpack_from("I60x" * (done - 1) + "I" if done else "",
+                            msgs.raw, MMSGHDR_LEN_OFFSET)
+  return list(sent) + [0] * (count - done)
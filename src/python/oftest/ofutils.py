@@ -8,6 +8,17 @@ import time
 
 default_timeout = None # set by oft
 
+def timestamp():
+    """
+    Return the current time on the clock used for receive timestamps
+
+    Dataplane frames are stamped by the kernel from CLOCK_REALTIME, so
+    controller messages and anything compared against pkt_time must use
+    the same clock.  Python 2 has no monotonic clock, and a kernel
+    receive timestamp cannot be taken from one anyway.
+    """
+    return time.time()
+
 def gen_xid():
     return random.randrange(1,0xffffffff)
 
@@ -3,19 +3,16 @@ OpenFlow message parsing functions
 """
 
 import sys
+import copy
+import struct
 import logging
+from threading import Lock
 from message import *
 from error import *
 from action import *
 from action_list import action_list
 from cstruct import *
-try:
-    import scapy.all as scapy
-except:
-    try:
-        import scapy as scapy
-    except:
-        sys.exit("Need to install scapy for packet parsing")
+from lazyscapy import scapy
 
 """
 of_message.py
@@ -25,6 +22,24 @@ function information into the of_message namespace
 """
 
 parse_logger = logging.getLogger("parse")
+
+# Header layouts for the raw packet parser used by packet_to_flow_match
+ETHER_HDR = struct.Struct("!6s6sH")
+VLAN_HDR = struct.Struct("!HH")
+IPV4_HDR = struct.Struct("!BBxxxxHxBxxII")
+ARP_HDR = struct.Struct("!6xH6xI6xI")
+IPV6_HDR = struct.Struct("!6xB")
+IPV6_HDR_LEN = 40
+L4_PORTS = struct.Struct("!HH")
+ICMP_HDR = struct.Struct("!BB")
+
+ETH_TYPE_IP = 0x0800
+ETH_TYPE_ARP = 0x0806
+ETH_TYPE_VLAN = 0x8100
+ETH_TYPE_IPV6 = 0x86dd
+
+# Shortest L4 header decoded, by IP protocol
+L4_HDR_MIN = {1: 8, 6: 20, 17: 8}
 #parse_logger.setLevel(logging.DEBUG)
 
 # These message types are subclassed
@@ -123,7 +138,88 @@ def _of_message_to_object(binary_string):
         parse_logger.error("Cannot parse pkt to message")
         return None
 
-def of_message_parse(binary_string, raw=False):
+_lazy_lock = Lock()
+
+class LazyMessage(object):
+    """
+    A parsed message whose body is unpacked on first use
+
+    Returned by of_message_parse with lazy=True.  The message class is
+    chosen and the header unpacked up front; the rest of the message,
+    e.g. a packet_in payload or the entries of a stats reply, is
+    unpacked the first time any other attribute is read or set.  The
+    wrapper forwards every public attribute, len and == to the message
+    object, so it can be used in place of one except with isinstance
+    and type.  copy, deepcopy and pickle give the message object
+    itself.  Errors in the body are raised at that first access rather
+    than at parse time.
+
+    @var header The ofp_header object of the message
+    """
+
+    def __init__(self, obj, binary_string):
+        self.__dict__["_obj"] = obj
+        self.__dict__["_raw"] = binary_string
+        self.__dict__["header"] = obj.header
+        obj.header.unpack(binary_string)
+
+    def _decode(self):
+        """
+        Unpack the body if that has not been done and return the object
+        """
+        if "_raw" in self.__dict__:
+            with _lazy_lock:
+                raw = self.__dict__.get("_raw")
+                if raw is not None:
+                    self._obj.unpack(raw)
+                    del self.__dict__["_raw"]
+        return self._obj
+
+    def decoded(self):
+        """
+        Return True if the body has been unpacked
+        """
+        return "_raw" not in self.__dict__
+
+    def __getattr__(self, name):
+        # Private and special names are not forwarded: copy and pickle
+        # look them up on instances made without __init__
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self._decode(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._decode(), name, value)
+        if name == "header":
+            self.__dict__["header"] = value
+
+    def __nonzero__(self):
+        # Truth testing would otherwise go through __len__ and decode
+        return True
+
+    def __len__(self):
+        return len(self._decode())
+
+    def __eq__(self, other):
+        if isinstance(other, LazyMessage):
+            other = other._decode()
+        return self._decode() == other
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __copy__(self):
+        return copy.copy(self._decode())
+
+    def __deepcopy__(self, memo):
+        return copy.deepcopy(self._decode(), memo)
+
+    def __reduce__(self):
+        # Protocol 2 form (__newobj__) must name the pickled object's own
+        # class, so use the copy_reg form that rebuilds the message
+        return self._decode().__reduce_ex__(1)
+
+def of_message_parse(binary_string, raw=False, lazy=False):
     """
     Parse an OpenFlow packet
 
@@ -133,6 +229,8 @@ def of_message_parse(binary_string, raw=False):
     @param binary_string The packet (string) to be parsed
     @param raw If true, interpret the packet as an L2 packet.  Not
     yet supported.
+    @param lazy If true, return a LazyMessage that unpacks the body
+    of the message only when it is used
     @return An object of some message class or None if fails
     Note that any data beyond that parsed is not returned
 
@@ -144,6 +242,8 @@ def of_message_parse(binary_string, raw=False):
 
     obj = _of_message_to_object(binary_string)
     if obj:
+        if lazy:
+            return LazyMessage(obj, binary_string)
         obj.unpack(binary_string)
     return obj
 
@@ -245,14 +345,116 @@ def packet_type_classify(ether):
     except:
         icmp = None
 
-    # @todo arp is not yet supported
-    arp = None
+    try:
+        arp = ether[scapy.ARP]
+    except:
+        arp = None
+
     return (dot1q, ip, tcp, udp, icmp, arp)
 
 def packet_to_flow_match(packet, pkt_format="L2"):
     """
     Create a flow match that matches packet with the given wildcards
 
+    Raw frames are decoded directly from their bytes: Ethernet,
+    802.1Q, ARP, IPv4 and TCP/UDP/ICMP in unfragmented or first
+    fragment IP packets, and TCP/UDP directly over IPv6 (as scapy sets
+    their ports).  The result is the same as scapy_packet_to_flow_match
+    for all of those.  L4 headers that are truncated, IPv6 extension
+    headers and anything carried inside L4 payloads (tunnels) are not
+    parsed.
+
+    Scapy packets are handed to scapy_packet_to_flow_match, since
+    serializing them costs more than walking their layers.
+
+    @param packet The packet to use as a flow template; a string as
+    received from the dataplane, a scapy packet or any object whose
+    str() is the frame, such as a pkttemplate.PacketTemplate
+    @param pkt_format Currently only L2 is supported.  Will indicate the 
+    overall packet type for parsing
+    @return An ofp_match object if successful.  None if format is not
+    recognized.  The wildcards of the match will be cleared for the
+    values extracted from the packet.  As for scapy, ICMP type and code
+    are stored in tp_src and tp_dst but left wildcarded.
+    """
+
+    if pkt_format.upper() != "L2":
+        parse_logger.error("Only L2 supported for packet_to_flow")
+        return None
+
+    if type(packet) != type(""):
+        if hasattr(packet, "haslayer"):
+            return scapy_packet_to_flow_match(packet, pkt_format)
+        packet = str(packet)
+    if len(packet) < ETHER_HDR.size:
+        parse_logger.error("packet_to_flow_match: Packet too short")
+        return None
+
+    match = ofp_match()
+    (dl_dst, dl_src, dl_type) = ETHER_HDR.unpack_from(packet)
+    match.dl_dst = map(ord, dl_dst)
+    match.dl_src = map(ord, dl_src)
+    match.dl_vlan = OFP_VLAN_NONE
+    match.dl_vlan_pcp = 0
+    offset = ETHER_HDR.size
+    proto = None
+    wildcards = OFPFW_ALL & ~(OFPFW_DL_DST | OFPFW_DL_SRC | OFPFW_DL_TYPE |
+                              OFPFW_DL_VLAN | OFPFW_DL_VLAN_PCP)
+
+    # The match takes the outer tag; skip any further (QinQ) tags
+    eth_type = dl_type
+    if eth_type == ETH_TYPE_VLAN and len(packet) >= offset + VLAN_HDR.size:
+        (tci, dl_type) = VLAN_HDR.unpack_from(packet, offset)
+        match.dl_vlan = tci & 0xfff
+        match.dl_vlan_pcp = tci >> 13
+        while eth_type == ETH_TYPE_VLAN and \
+                len(packet) >= offset + VLAN_HDR.size:
+            (tci, eth_type) = VLAN_HDR.unpack_from(packet, offset)
+            offset += VLAN_HDR.size
+    match.dl_type = dl_type
+
+    if eth_type == ETH_TYPE_IP and len(packet) >= offset + IPV4_HDR.size:
+        (ver_ihl, tos, frag, proto, nw_src, nw_dst) = \
+            IPV4_HDR.unpack_from(packet, offset)
+        match.nw_src = nw_src
+        match.nw_dst = nw_dst
+        match.nw_tos = tos
+        wildcards &= ~(OFPFW_NW_SRC_MASK | OFPFW_NW_DST_MASK | OFPFW_NW_TOS)
+        offset += max(5, ver_ihl & 0xf) * 4
+        if frag & 0x1fff != 0:
+            proto = None
+    elif eth_type == ETH_TYPE_IPV6 and \
+            len(packet) >= offset + IPV6_HDR_LEN:
+        (proto,) = IPV6_HDR.unpack_from(packet, offset)
+        offset += IPV6_HDR_LEN
+        if proto == 1: # ICMP means nothing over IPv6
+            proto = None
+    elif eth_type == ETH_TYPE_ARP and len(packet) >= offset + ARP_HDR.size:
+        (op, nw_src, nw_dst) = ARP_HDR.unpack_from(packet, offset)
+        match.nw_proto = op & 0xff
+        match.nw_src = nw_src
+        match.nw_dst = nw_dst
+        wildcards &= ~(OFPFW_NW_PROTO | OFPFW_NW_SRC_MASK | OFPFW_NW_DST_MASK)
+
+    if eth_type in [ETH_TYPE_IP, ETH_TYPE_IPV6] and proto in L4_HDR_MIN and \
+            len(packet) >= offset + L4_HDR_MIN[proto]:
+        match.nw_proto = proto
+        if proto == 1:
+            (match.tp_src, match.tp_dst) = ICMP_HDR.unpack_from(packet, offset)
+        else:
+            (match.tp_src, match.tp_dst) = L4_PORTS.unpack_from(packet, offset)
+            wildcards &= ~(OFPFW_NW_PROTO | OFPFW_TP_SRC | OFPFW_TP_DST)
+
+    match.wildcards = wildcards
+    return match
+
+def scapy_packet_to_flow_match(packet, pkt_format="L2"):
+    """
+    Create a flow match from a packet by walking its scapy layers
+
+    This is the reference for packet_to_flow_match, which parses the raw
+    bytes instead and gives the same result much faster.
+
     @param packet The packet to use as a flow template
     @param pkt_format Currently only L2 is supported.  Will indicate the 
     overall packet type for parsing
@@ -262,7 +464,6 @@ def packet_to_flow_match(packet, pkt_format="L2"):
 
     @todo check min length of packet
     @todo Check if packet is other than L2 format
-    @todo Implement ICMP and ARP fields
     """
 
     #@todo check min length of packet
@@ -279,7 +480,7 @@ def packet_to_flow_match(packet, pkt_format="L2"):
     try:
         (dot1q, ip, tcp, udp, icmp, arp) = packet_type_classify(ether)
     except:
-        parse_logger.error("packet_to_flow_match: Classify error")
+        parse_logger.error("scapy_packet_to_flow_match: Classify error")
         return None
 
     match = ofp_match()
@@ -329,6 +530,12 @@ def packet_to_flow_match(packet, pkt_format="L2"):
         match.tp_src = icmp.type
         match.tp_dst = icmp.code
 
-    #@todo Implement ARP fields
+    if arp:
+        match.nw_proto = arp.op & 0xff
+        match.wildcards &= ~OFPFW_NW_PROTO
+        match.nw_src = parse_ip(arp.psrc)
+        match.wildcards &= ~OFPFW_NW_SRC_MASK
+        match.nw_dst = parse_ip(arp.pdst)
+        match.wildcards &= ~OFPFW_NW_DST_MASK
 
     return match
@@ -0,0 +1,524 @@
+"""
+OpenFlow Test Framework
+
+Packet templates built without scapy
+
+tcp_template, icmp_template and eth_template take the same arguments
+as simple_tcp_packet, simple_icmp_packet and simple_eth_packet in
+testutils and build byte-identical frames directly with struct.  The
+result is a PacketTemplate whose header fields can then be changed in
+place; IP and L4 checksums are updated incrementally (RFC 1624) rather
+than recomputed, so a new flow costs a few pack_into calls:
+
+    tmpl = pkttemplate.tcp_template()
+    for sport in range(1000):
+        tmpl.set(tcp_sport=sport)
+        self.dataplane.send(port, str(tmpl))
+
+str(tmpl) returns the current frame; copy() gives an independent
+template.
+
+For sweeps over many flows, batch() builds all the variants at once
+from columns of field values, with the checksum fix-ups done column
+wise (vectorized when numpy is installed):
+
+    batch = tmpl.batch(tcp_sport=array.array("H", range(1000)),
+                       ip_dst=[0x0a000000 + i for i in range(1000)])
+    self.dataplane.send_bulk(batch.pkts(port))
+"""
+
+import sys
+import struct
+import socket
+import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+ETH_P_8021Q = 0x8100
+ETH_P_IP = 0x0800
+IP_PROTO_ICMP = 1
+IP_PROTO_TCP = 6
+
+# Header defaults used by scapy for the packets built in testutils
+IP_ID = 1
+IP_TTL = 64
+TCP_FLAGS_SYN = 0x02
+TCP_WINDOW = 8192
+
+ETH_HDR = struct.Struct("!6s6sH")
+VLAN_HDR = struct.Struct("!HH")
+IP_HDR = struct.Struct("!BBHHHBBH4s4s")
+TCP_HDR = struct.Struct("!HHIIBBHHH")
+ICMP_HDR = struct.Struct("!BBHHH")
+
+def _icmp_hdr_len(icmp_type):
+    """
+    Return the length of the ICMP header scapy builds for icmp_type
+
+    Every type has 4 bytes of zeroed type-specific fields except address
+    mask messages, which add the mask.  Timestamp messages carry the
+    current time, so they cannot be reproduced and are not supported.
+    """
+    if icmp_type in [13, 14]:
+        raise Exception("ICMP timestamp messages are not supported")
+    if icmp_type in [17, 18]:
+        return 12
+    return 8
+
+def _column_ints(values):
+    """
+    Convert a column of MAC or IP address strings to integers
+    """
+    if len(values) == 0 or not isinstance(values[0], str):
+        return values
+    if ":" in values[0]:
+        return [int(v.replace(":", ""), 16) for v in values]
+    return [struct.unpack("!I", socket.inet_aton(v))[0] for v in values]
+
+def mac_bytes(mac):
+    """
+    Convert a MAC address string like '00:01:02:03:04:05' to 6 bytes
+    """
+    return "".join([chr(int(x, 16)) for x in mac.split(":")])
+
+def checksum(data):
+    """
+    Return the Internet checksum of a string or bytearray
+    """
+    if len(data) % 2:
+        data = data + "\0"
+    words = struct.unpack("!%dH" % (len(data) / 2), str(data))
+    s = sum(words)
+    s = (s & 0xffff) + (s >> 16)
+    s = (s & 0xffff) + (s >> 16)
+    return ~s & 0xffff
+
+def checksum_update(csum, old, new):
+    """
+    Update a checksum for one 16 bit word changing from old to new
+
+    RFC 1624, eqn. 3: HC' = ~(~HC + ~m + m')
+    """
+    s = (~csum & 0xffff) + (~old & 0xffff) + new
+    s = (s & 0xffff) + (s >> 16)
+    s = (s & 0xffff) + (s >> 16)
+    return ~s & 0xffff
+
+class PacketBatch:
+    """
+    A set of frames of the same length in one contiguous buffer
+
+    Frame i is buf[offsets[i]:offsets[i] + frame_len].  Indexing and
+    iteration return frames as strings, which DataPlane.send accepts.
+
+    @var buf The frames as one string
+    @var offsets array.array of the offset of each frame in buf
+    @var frame_len Length of every frame
+    """
+
+    def __init__(self, buf, offsets, frame_len):
+        self.buf = buf
+        self.offsets = offsets
+        self.frame_len = frame_len
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, idx):
+        offset = self.offsets[idx]
+        return self.buf[offset:offset + self.frame_len]
+
+    def __iter__(self):
+        for offset in self.offsets:
+            yield self.buf[offset:offset + self.frame_len]
+
+    def pkts(self, port_number):
+        """
+        Return a generator of (port_number, frame) pairs for send_bulk
+        """
+        for offset in self.offsets:
+            yield (port_number, self.buf[offset:offset + self.frame_len])
+
+class PacketTemplate:
+    """
+    A frame in a bytearray with the offsets of its header fields
+
+    @var buf The frame
+    @var vlan Offset of the VLAN TCI, or None if untagged
+    @var l3 Offset of the IP header, or None if not IP
+    @var l4 Offset of the TCP or ICMP header, or None
+    @var proto IP protocol number, or None
+    """
+
+    def __init__(self, buf, vlan=None, l3=None, l4=None, proto=None):
+        self.buf = buf
+        self.vlan = vlan
+        self.l3 = l3
+        self.l4 = l4
+        self.proto = proto
+
+    def copy(self):
+        return PacketTemplate(bytearray(self.buf), self.vlan, self.l3,
+                              self.l4, self.proto)
+
+    def __str__(self):
+        return str(self.buf)
+
+    def __len__(self):
+        return len(self.buf)
+
+    def _csum_offsets(self, pseudo):
+        """
+        Return the offsets of the checksums covering a changed word
+
+        @param pseudo True if the word is in the IP addresses, which the
+        TCP checksum covers through its pseudo header
+        """
+        offsets = [self.l3 + 10]
+        if pseudo and self.proto == IP_PROTO_TCP:
+            offsets.append(self.l4 + 16)
+        return offsets
+
+    def _word_set(self, offset, value, csum_offsets):
+        """
+        Write a 16 bit word and update the given checksums
+        """
+        (old,) = struct.unpack_from("!H", self.buf, offset)
+        if old == value:
+            return
+        struct.pack_into("!H", self.buf, offset, value)
+        for csum_offset in csum_offsets:
+            (csum,) = struct.unpack_from("!H", self.buf, csum_offset)
+            struct.pack_into("!H", self.buf, csum_offset,
+                             checksum_update(csum, old, value))
+
+    def _require(self, name, offset):
+        if offset is None:
+            raise Exception("Packet template has no field " + name)
+
+    def _tci_set(self, name, value, shift, mask):
+        self._require(name, self.vlan)
+        (tci,) = struct.unpack_from("!H", self.buf, self.vlan)
+        tci = (tci & ~(mask << shift)) | ((value & mask) << shift)
+        struct.pack_into("!H", self.buf, self.vlan, tci)
+
+    def _layout(self, name):
+        """
+        Describe where a field lives for batch()
+
+        @return (offset, size, shift, mask, csum_offsets): the field is
+        the bits mask << shift of the size byte big endian value at
+        offset (mask None for the whole value), covered by the
+        checksums at csum_offsets
+        """
+        if name in ["dl_dst", "dl_src"]:
+            return ({"dl_dst": 0, "dl_src": 6}[name], 6, 0, None, [])
+        if name == "dl_type":
+            if self.vlan is not None:
+                return (self.vlan + 2, 2, 0, None, [])
+            return (12, 2, 0, None, [])
+        if name in ["dl_vlan", "dl_vlan_pcp", "dl_vlan_cfi"]:
+            self._require(name, self.vlan)
+            (shift, mask) = {"dl_vlan": (0, 0xfff), "dl_vlan_pcp": (13, 0x7),
+                             "dl_vlan_cfi": (12, 0x1)}[name]
+            return (self.vlan, 2, shift, mask, [])
+        if name in ["ip_src", "ip_dst", "ip_tos"]:
+            self._require(name, self.l3)
+            if name == "ip_tos":
+                return (self.l3 + 1, 1, 0, None, self._csum_offsets(False))
+            offset = self.l3 + {"ip_src": 12, "ip_dst": 16}[name]
+            return (offset, 4, 0, None, self._csum_offsets(True))
+        if name in ["tcp_sport", "tcp_dport"]:
+            if self.proto != IP_PROTO_TCP:
+                self._require(name, None)
+            offset = self.l4 + {"tcp_sport": 0, "tcp_dport": 2}[name]
+            return (offset, 2, 0, None, [self.l4 + 16])
+        if name in ["icmp_type", "icmp_code"]:
+            if self.proto != IP_PROTO_ICMP:
+                self._require(name, None)
+            offset = self.l4 + {"icmp_type": 0, "icmp_code": 1}[name]
+            return (offset, 1, 0, None, [self.l4 + 2])
+        raise Exception("Unknown packet template field " + name)
+
+    def _value(self, offset, size):
+        value = 0
+        for idx in range(offset, offset + size):
+            value = (value << 8) | self.buf[idx]
+        return value
+
+    def batch(self, **columns):
+        """
+        Build one frame per row of the given field columns
+
+        Fields are as for set().  Each column is a sequence of integers
+        (a numpy array, array.array or list; MAC and IP addresses may
+        also be given as strings) and all columns must have the same
+        length.  Checksums are fixed up incrementally from the
+        template's.  Changing icmp_type is not checked for header
+        length changes as set() does.
+
+        @return A PacketBatch
+        """
+        if len(columns) == 0:
+            raise Exception("Packet batch needs at least one column")
+        count = len(columns.values()[0])
+        for (name, values) in columns.items():
+            if len(values) != count:
+                raise Exception("Column %s has %d values, expected %d" %
+                                (name, len(values), count))
+
+        fields = []
+        covered = {} # Map from checksum offset to set of word offsets
+        for (name, values) in columns.items():
+            (offset, size, shift, mask, csums) = self._layout(name)
+            fields.append((offset, size, shift, mask, _column_ints(values)))
+            words = set(range(offset & ~1, offset + size, 2))
+            for csum_offset in csums:
+                covered.setdefault(csum_offset, set()).update(words)
+        checksums = [(csum_offset, sorted(words))
+                     for (csum_offset, words) in covered.items()]
+
+        frame_len = len(self.buf)
+        offsets = array.array("I", xrange(0, count * frame_len, frame_len))
+        if numpy is not None:
+            buf = self._batch_numpy(count, fields, checksums)
+        else:
+            buf = self._batch_python(count, fields, checksums)
+        return PacketBatch(buf, offsets, frame_len)
+
+    def _batch_numpy(self, count, fields, checksums):
+        """
+        Build the batch as a count by frame length array of bytes
+        """
+        base = numpy.frombuffer(str(self.buf), dtype=numpy.uint8)
+        frames = numpy.tile(base, (count, 1))
+        for (offset, size, shift, mask, values) in fields:
+            values = numpy.asarray(values, dtype=numpy.uint64)
+            if mask is not None:
+                keep = self._value(offset, size) & ~(mask << shift)
+                values = numpy.uint64(keep) | \
+                    ((values & numpy.uint64(mask)) << numpy.uint64(shift))
+            for idx in range(size):
+                frames[:, offset + idx] = \
+                    (values >> numpy.uint64(8 * (size - 1 - idx))) & 0xff
+        for (csum_offset, words) in checksums:
+            acc = numpy.empty(count, dtype=numpy.uint64)
+            acc.fill(numpy.uint64(~self._value(csum_offset, 2) & 0xffff))
+            for word in words:
+                acc += numpy.uint64(~self._value(word, 2) & 0xffff)
+                acc += frames[:, word].astype(numpy.uint64) << numpy.uint64(8)
+                acc += frames[:, word + 1]
+            for idx in range(3):
+                acc = (acc & numpy.uint64(0xffff)) + (acc >> numpy.uint64(16))
+            acc = ~acc & numpy.uint64(0xffff)
+            frames[:, csum_offset] = acc >> numpy.uint64(8)
+            frames[:, csum_offset + 1] = acc & numpy.uint64(0xff)
+        return frames.tostring()
+
+    def _batch_python(self, count, fields, checksums):
+        """
+        Build the batch row by row in a bytearray
+        """
+        frame_len = len(self.buf)
+        buf = bytearray(str(self.buf) * count)
+        for (offset, size, shift, mask, values) in fields:
+            keep = 0
+            if mask is not None:
+                keep = self._value(offset, size) & ~(mask << shift)
+            for row in xrange(count):
+                value = values[row]
+                if mask is not None:
+                    value = keep | ((value & mask) << shift)
+                base = row * frame_len + offset
+                for idx in range(size - 1, -1, -1):
+                    buf[base + idx] = value & 0xff
+                    value >>= 8
+        for (csum_offset, words) in checksums:
+            acc0 = ~self._value(csum_offset, 2) & 0xffff
+            for word in words:
+                acc0 += ~self._value(word, 2) & 0xffff
+            for row in xrange(count):
+                base = row * frame_len
+                acc = acc0
+                for word in words:
+                    acc += (buf[base + word] << 8) | buf[base + word + 1]
+                acc = (acc & 0xffff) + (acc >> 16)
+                acc = (acc & 0xffff) + (acc >> 16)
+                acc = ~acc & 0xffff
+                buf[base + csum_offset] = acc >> 8
+                buf[base + csum_offset + 1] = acc & 0xff
+        return str(buf)
+
+    def set(self, **fields):
+        """
+        Change header fields in place
+
+        Accepts dl_dst, dl_src, dl_type, dl_vlan, dl_vlan_pcp,
+        dl_vlan_cfi, ip_src, ip_dst, ip_tos, tcp_sport, tcp_dport,
+        icmp_type and icmp_code, with values as for the testutils
+        packet functions.  Setting dl_type on an IP packet does not
+        change how the rest of the frame is laid out.
+        @return self
+        """
+        buf = self.buf
+        for (name, value) in fields.items():
+            if name == "dl_dst":
+                struct.pack_into("!6s", buf, 0, mac_bytes(value))
+            elif name == "dl_src":
+                struct.pack_into("!6s", buf, 6, mac_bytes(value))
+            elif name == "dl_type":
+                offset = 12
+                if self.vlan is not None:
+                    offset = self.vlan + 2
+                struct.pack_into("!H", buf, offset, value)
+            elif name == "dl_vlan":
+                self._tci_set(name, value, 0, 0xfff)
+            elif name == "dl_vlan_pcp":
+                self._tci_set(name, value, 13, 0x7)
+            elif name == "dl_vlan_cfi":
+                self._tci_set(name, value, 12, 0x1)
+            elif name in ["ip_src", "ip_dst"]:
+                self._require(name, self.l3)
+                offset = self.l3 + {"ip_src": 12, "ip_dst": 16}[name]
+                (hi, lo) = struct.unpack("!HH", socket.inet_aton(value))
+                self._word_set(offset, hi, self._csum_offsets(True))
+                self._word_set(offset + 2, lo, self._csum_offsets(True))
+            elif name == "ip_tos":
+                self._require(name, self.l3)
+                self._word_set(self.l3, (buf[self.l3] << 8) | value,
+                               self._csum_offsets(False))
+            elif name in ["tcp_sport", "tcp_dport"]:
+                if self.proto != IP_PROTO_TCP:
+                    self._require(name, None)
+                offset = self.l4 + {"tcp_sport": 0, "tcp_dport": 2}[name]
+                self._word_set(offset, value, [self.l4 + 16])
+            elif name in ["icmp_type", "icmp_code"]:
+                if self.proto != IP_PROTO_ICMP:
+                    self._require(name, None)
+                (icmp_type, icmp_code) = (buf[self.l4], buf[self.l4 + 1])
+                if name == "icmp_type":
+                    if _icmp_hdr_len(value) != _icmp_hdr_len(icmp_type):
+                        raise Exception("ICMP type %d has a different "
+                                        "header length" % value)
+                    icmp_type = value
+                else:
+                    icmp_code = value
+                self._word_set(self.l4, (icmp_type << 8) | icmp_code,
+                               [self.l4 + 2])
+            else:
+                raise Exception("Unknown packet template field " + name)
+        return self
+
+def _eth_build(dl_dst, dl_src, dl_type, dl_vlan_enable, dl_vlan, dl_vlan_pcp,
+               dl_vlan_cfi):
+    """
+    Return the Ethernet (and VLAN) header and the TCI offset or None
+    """
+    if dl_vlan_enable:
+        tci = (dl_vlan_pcp << 13) | (dl_vlan_cfi << 12) | dl_vlan
+        return (ETH_HDR.pack(mac_bytes(dl_dst), mac_bytes(dl_src),
+                             ETH_P_8021Q) + VLAN_HDR.pack(tci, dl_type), 14)
+    return (ETH_HDR.pack(mac_bytes(dl_dst), mac_bytes(dl_src), dl_type), None)
+
+def _pktlen(pktlen):
+    """
+    Return pktlen raised to testutils.MINSIZE, as the testutils builders do
+
+    oft sets MINSIZE from --minsize.  testutils is not imported here, as
+    it needs the generated OpenFlow modules; if nothing has imported it,
+    MINSIZE cannot have been set.
+    """
+    testutils = sys.modules.get("oftest.testutils")
+    if testutils is None:
+        return pktlen
+    return max(pktlen, testutils.MINSIZE)
+
+def _ip_build(eth, vlan, proto, ip_src, ip_dst, ip_tos, l4_hdr, pktlen, fill,
+              l4_csum_offset, pseudo):
+    """
+    Assemble an IPv4 frame and compute its checksums
+
+    @param eth The Ethernet (and VLAN) header
+    @param l4_hdr The L4 header with a zero checksum
+    @param fill Payload byte repeated up to pktlen
+    @param l4_csum_offset Offset of the checksum in l4_hdr
+    @param pseudo True if the L4 checksum covers the IP pseudo header
+    """
+    payload = fill * (pktlen - len(eth) - IP_HDR.size - len(l4_hdr))
+    segment = bytearray(l4_hdr + payload)
+    src = socket.inet_aton(ip_src)
+    dst = socket.inet_aton(ip_dst)
+    total_len = IP_HDR.size + len(segment)
+    if pseudo:
+        csum = checksum(struct.pack("!4s4sBBH", src, dst, 0, proto,
+                                    len(segment)) + str(segment))
+    else:
+        csum = checksum(segment)
+    struct.pack_into("!H", segment, l4_csum_offset, csum)
+    ip_hdr = bytearray(IP_HDR.pack(0x45, ip_tos, total_len, IP_ID, 0, IP_TTL,
+                                   proto, 0, src, dst))
+    struct.pack_into("!H", ip_hdr, 10, checksum(ip_hdr))
+    l3 = len(eth)
+    return PacketTemplate(bytearray(eth) + ip_hdr + segment, vlan=vlan,
+                          l3=l3, l4=l3 + IP_HDR.size, proto=proto)
+
+def tcp_template(pktlen=100,
+                 dl_dst='00:01:02:03:04:05',
+                 dl_src='00:06:07:08:09:0a',
+                 dl_vlan_enable=False,
+                 dl_vlan=0,
+                 dl_vlan_pcp=0,
+                 dl_vlan_cfi=0,
+                 ip_src='192.168.0.1',
+                 ip_dst='192.168.0.2',
+                 ip_tos=0,
+                 tcp_sport=1234,
+                 tcp_dport=80
+                 ):
+    """
+    Return a template for the frame built by testutils.simple_tcp_packet
+    """
+    pktlen = _pktlen(pktlen)
+    (eth, vlan) = _eth_build(dl_dst, dl_src, ETH_P_IP, dl_vlan_enable,
+                             dl_vlan, dl_vlan_pcp, dl_vlan_cfi)
+    tcp_hdr = TCP_HDR.pack(tcp_sport, tcp_dport, 0, 0, 5 << 4, TCP_FLAGS_SYN,
+                           TCP_WINDOW, 0, 0)
+    return _ip_build(eth, vlan, IP_PROTO_TCP, ip_src, ip_dst, ip_tos, tcp_hdr,
+                     pktlen, "D", 16, True)
+
+def icmp_template(pktlen=60,
+                  dl_dst='00:01:02:03:04:05',
+                  dl_src='00:06:07:08:09:0a',
+                  dl_vlan_enable=False,
+                  dl_vlan=0,
+                  dl_vlan_pcp=0,
+                  ip_src='192.168.0.1',
+                  ip_dst='192.168.0.2',
+                  ip_tos=0,
+                  icmp_type=8,
+                  icmp_code=0
+                  ):
+    """
+    Return a template for the frame built by testutils.simple_icmp_packet
+    """
+    pktlen = _pktlen(pktlen)
+    (eth, vlan) = _eth_build(dl_dst, dl_src, ETH_P_IP, dl_vlan_enable,
+                             dl_vlan, dl_vlan_pcp, 0)
+    icmp_hdr = ICMP_HDR.pack(icmp_type, icmp_code, 0, 0, 0)
+    icmp_hdr += "\0" * (_icmp_hdr_len(icmp_type) - ICMP_HDR.size)
+    return _ip_build(eth, vlan, IP_PROTO_ICMP, ip_src, ip_dst, ip_tos,
+                     icmp_hdr, pktlen, "0", 2, False)
+
+def eth_template(pktlen=60,
+                 dl_dst='00:01:02:03:04:05',
+                 dl_src='01:80:c2:00:00:00',
+                 dl_type=0x88cc):
+    """
+    Return a template for the frame built by testutils.simple_eth_packet
+    """
+    pktlen = _pktlen(pktlen)
+    (eth, vlan) = _eth_build(dl_dst, dl_src, dl_type, False, 0, 0, 0)
+    return PacketTemplate(bytearray(eth + "0" * (pktlen - len(eth))))
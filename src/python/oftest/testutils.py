@@ -2,14 +2,7 @@
 import sys
 import copy
 
-try:
-    import scapy.all as scapy
-except:
-    try:
-        import scapy as scapy
-    except:
-        sys.exit("Need to install scapy for packet parsing")
-
+from oftest.lazyscapy import scapy
 import oftest.controller as controller
 import oftest.cstruct as ofp
 import oftest.message as message
@@ -30,6 +23,16 @@ UDP_PROTOCOL = 0x11
 
 MINSIZE = 0
 
+# Fields of the expected packet whose value depends on how the switch
+# implements a rewrite of each field (mainly checksum updates)
+MOD_FIELD_DONT_CARE = {
+    'ip_src' : ['checksums'],
+    'ip_dst' : ['checksums'],
+    'ip_tos' : ['ip_checksum'],
+    'tcp_sport' : ['l4_checksum'],
+    'tcp_dport' : ['l4_checksum']
+}
+
 def clear_switch(parent, port_list):
     """
     Clear the switch configuration
@@ -260,6 +263,8 @@ def receive_pkt_check(dp, pkt, yes_ports, no_ports, assert_if, config):
     @param no_ports Set or list of ports that should not receive packet
     @param assert_if Object that implements assertXXX
     """
+    if pkt is not None:
+        pkt = dataplane.exp_pkt_compile(pkt)
     exp_pkt_arg = None
     if config and config["relax"]:
         exp_pkt_arg = pkt
@@ -270,10 +275,11 @@ def receive_pkt_check(dp, pkt, yes_ports, no_ports, assert_if, config):
             port_number=ofport, exp_pkt=exp_pkt_arg)
         assert_if.assertTrue(rcv_pkt is not None, 
                              "Did not receive pkt on " + str(ofport))
-        if not dataplane.match_exp_pkt(pkt, rcv_pkt):
+        matched = pkt.matches(rcv_pkt)
+        if not matched:
             logging.debug("Sent %s" % format_packet(pkt))
             logging.debug("Resp %s" % format_packet(rcv_pkt))
-        assert_if.assertTrue(dataplane.match_exp_pkt(pkt, rcv_pkt),
+        assert_if.assertTrue(matched,
                              "Response packet does not match send packet " +
                              "on port " + str(ofport))
     if len(no_ports) > 0:
@@ -293,6 +299,7 @@ def receive_pkt_verify(parent, egr_ports, exp_pkt, ing_port):
 
     parent must implement dataplane, assertTrue and assertEqual
     """
+    exp_pkt = dataplane.exp_pkt_compile(exp_pkt)
     exp_pkt_arg = None
     if parent.config["relax"]:
         exp_pkt_arg = exp_pkt
@@ -319,14 +326,14 @@ def receive_pkt_verify(parent, egr_ports, exp_pkt, ing_port):
         logging.debug("Packet len " + str(len(rcv_pkt)) + " in on " + 
                             str(rcv_port))
 
-        if str(exp_pkt) != str(rcv_pkt):
+        if not exp_pkt.equals(rcv_pkt):
             logging.error("ERROR: Packet match failed.")
             logging.debug("Expected len " + str(len(exp_pkt)) + ": "
-                                + str(exp_pkt).encode('hex'))
+                                + exp_pkt.data.encode('hex'))
             logging.debug("Received len " + str(len(rcv_pkt)) + ": "
                                 + str(rcv_pkt).encode('hex'))
-        parent.assertEqual(str(exp_pkt), str(rcv_pkt),
-                           "Packet match error on port " + str(check_port))
+        parent.assertTrue(exp_pkt.equals(rcv_pkt),
+                          "Packet match error on port " + str(check_port))
 
 def match_verify(parent, req_match, res_match):
     """
@@ -651,17 +658,23 @@ def test_param_get(config, key, default=None):
     except:
         return default
 
-def action_generate(parent, field_to_mod, mod_field_vals):
+def action_generate(parent, field_to_mod, mod_field_vals, dont_care=None):
     """
     Create an action to modify the field indicated in field_to_mod
 
     @param parent Must implement, assertTrue
     @param field_to_mod The field to modify as a string name
     @param mod_field_vals Hash of values to use for modified values
+    @param dont_care If a list, the names of the fields (see
+    dataplane.MaskedPacket) that the rewrite leaves up to the switch are
+    appended to it
     """
 
     act = None
 
+    if dont_care is not None:
+        dont_care.extend(MOD_FIELD_DONT_CARE.get(field_to_mod, []))
+
     if field_to_mod in ['pktlen']:
         return None
 
@@ -703,7 +716,8 @@ def action_generate(parent, field_to_mod, mod_field_vals):
     return act
 
 def pkt_action_setup(parent, start_field_vals={}, mod_field_vals={}, 
-                     mod_fields={}, check_test_params=False):
+                     mod_fields={}, check_test_params=False, masked=False,
+                     dont_care=[]):
     """
     Set up the ingress and expected packet and action list for a test
 
@@ -713,6 +727,9 @@ def pkt_action_setup(parent, start_field_vals={}, mod_field_vals={},
     @param mod_fields The list of fields to be modified by the switch in the test.
     @params check_test_params If True, will check the parameters vid, add_vlan
     and strip_vlan from the command line.
+    @param masked If True, the expected packet is a dataplane.MaskedPacket
+    ignoring the fields the actions leave up to the switch
+    @param dont_care With masked, further fields to ignore, e.g. ip_ttl
 
     Returns a triple:  pkt-to-send, expected-pkt, action-list
     """
@@ -784,13 +801,18 @@ def pkt_action_setup(parent, start_field_vals={}, mod_field_vals={},
     ingress_pkt = simple_tcp_packet(**base_pkt_params)
 
     # Build the expected packet, modifying the indicated fields
+    exp_dont_care = list(dont_care)
     for item in mod_fields:
         base_pkt_params[item] = mod_pkt_params[item]
-        act = action_generate(parent, item, mod_pkt_params)
+        act = action_generate(parent, item, mod_pkt_params,
+                              dont_care=exp_dont_care)
         if act:
             new_actions.append(act)
 
     expected_pkt = simple_tcp_packet(**base_pkt_params)
+    if masked:
+        expected_pkt = dataplane.MaskedPacket(expected_pkt,
+                                              dont_care=exp_dont_care)
 
     return (ingress_pkt, expected_pkt, new_actions)
 
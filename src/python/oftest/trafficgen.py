@@ -0,0 +1,226 @@
+"""
+OpenFlow Test Framework
+
+TrafficGen class
+
+Offer a controlled load to the switch under test through a DataPlane
+object.  Template frames are sent round robin at a target packet or bit
+rate, in bursts, until a frame count or duration limit is reached.
+
+Pacing uses a token bucket: each burst is sent with a single
+DataPlane.send_bulk call once enough tokens have accumulated.  The
+bucket holds the larger of one burst and MAX_LAG seconds of traffic,
+enough to absorb sleep jitter without line rate catch-up after a long
+stall.  The generator sleeps between bursts; with busy_poll it
+sleeps only until shortly before the deadline and spins for the rest,
+which gives much more precise inter-burst gaps at the cost of a CPU.
+
+Typical use:
+
+    gen = trafficgen.TrafficGen(self.dataplane, [(1, str(pkt))],
+                                pps=10000, duration=5)
+    gen.start()
+    ...
+    gen.join()
+    logging.info(str(gen))
+"""
+
+import time
+import logging
+from threading import Thread
+
+##@var SPIN_MARGIN
+# With busy_poll, sleep until this many seconds before a deadline, then spin
+SPIN_MARGIN = 0.002
+
+##@var MAX_LAG
+# Token bucket depth in seconds of traffic
+MAX_LAG = 0.01
+
+class TrafficGen(Thread):
+    """
+    Rate paced traffic source built on the dataplane
+
+    Inherits from Thread so a test can poll the dataplane or controller
+    while traffic is offered; call run() directly to send synchronously.
+
+    @var pps Requested rate in frames per second (or None)
+    @var bps Requested rate in bits per second (or None)
+    @var frames_sent Number of frames sent successfully
+    @var bytes_sent Number of frame bytes sent successfully
+    @var frames_short Number of frames not sent or sent short
+    @var port_counts Map from port number to (sent, short) counts
+    @var elapsed Time in seconds from the first to the last burst
+    """
+
+    def __init__(self, dataplane, pkts, pps=None, bps=None, burst=1,
+                 count=None, duration=None, busy_poll=False, overhead=0):
+        """
+        Set up a traffic generator
+
+        Exactly one of pps and bps must be given, and at least one of
+        count and duration.
+
+        @param dataplane The DataPlane object to send through
+        @param pkts List of (port_number, packet) templates sent round robin
+        @param pps Target rate in frames per second
+        @param bps Target rate in bits per second
+        @param burst Number of frames sent back to back in each burst
+        @param count Stop after this many frames
+        @param duration Stop after this many seconds
+        @param busy_poll If True, spin instead of sleeping near deadlines
+        @param overhead Bytes added to each frame when computing bps;
+        use 24 for preamble, inter-frame gap and CRC on Ethernet
+        """
+        Thread.__init__(self)
+        if (pps is None) == (bps is None):
+            raise Exception("TrafficGen needs exactly one of pps or bps")
+        if count is None and duration is None:
+            raise Exception("TrafficGen needs a count or a duration")
+        if len(pkts) == 0:
+            raise Exception("TrafficGen needs at least one packet")
+        self.dataplane = dataplane
+        self.pkts = [(port_number, str(pkt)) for (port_number, pkt) in pkts]
+        self.pps = pps
+        self.bps = bps
+        self.burst = max(1, burst)
+        self.count = count
+        self.duration = duration
+        self.busy_poll = busy_poll
+        self.overhead = overhead
+        # Set here rather than in run so a kill before the thread is
+        # scheduled is not lost
+        self.running = True
+        self.logger = logging.getLogger("trafficgen")
+
+        self.frames_sent = 0
+        self.bytes_sent = 0
+        self.frames_short = 0
+        self.port_counts = {}
+        self.elapsed = 0.0
+
+    def _wait_until(self, deadline):
+        """
+        Block until time.time() reaches deadline
+        """
+        now = time.time()
+        if self.busy_poll:
+            if deadline - now > SPIN_MARGIN:
+                time.sleep(deadline - now - SPIN_MARGIN)
+            while time.time() < deadline:
+                pass
+        elif deadline > now:
+            time.sleep(deadline - now)
+
+    def _cost(self, frames):
+        """
+        Tokens consumed by a burst: frames, or bits when pacing by bps
+        """
+        if self.pps is not None:
+            return len(frames)
+        return sum([(len(pkt) + self.overhead) * 8 for (port, pkt) in frames])
+
+    def run(self):
+        """
+        Send traffic until the count or duration limit is reached, or
+        until kill is called
+        """
+        rate = float(self.pps or self.bps)
+        total = len(self.pkts)
+        idx = 0
+        sent_frames = 0
+        start = time.time()
+        deadline = start
+        if self.duration is not None:
+            end = start + self.duration
+        else:
+            end = None
+
+        self.logger.info("Starting: %s pps, %s bps, burst %d" %
+                         (str(self.pps), str(self.bps), self.burst))
+        while self.running:
+            n = self.burst
+            if self.count is not None:
+                n = min(n, self.count - sent_frames)
+                if n <= 0:
+                    break
+            frames = [self.pkts[(idx + i) % total] for i in range(n)]
+            idx = (idx + n) % total
+            interval = self._cost(frames) / rate
+
+            self._wait_until(deadline)
+            now = time.time()
+            if end is not None and now >= end:
+                break
+            # Tokens beyond the bucket depth are lost (e.g. when
+            # descheduled) rather than sent as one long burst
+            lag = max(interval, MAX_LAG)
+            if now - deadline > lag:
+                deadline = now - lag
+
+            counts = self.dataplane.send_bulk(frames, batch_size=n)
+            for (port_number, (sent, short, sent_bytes)) in counts.items():
+                (prev_sent, prev_short) = self.port_counts.get(port_number,
+                                                               (0, 0))
+                self.port_counts[port_number] = (prev_sent + sent,
+                                                 prev_short + short)
+                self.frames_sent += sent
+                self.frames_short += short
+                self.bytes_sent += sent_bytes
+            sent_frames += n
+            deadline += interval
+
+        # Count the slot of the last burst so N frames at rate R take N/R
+        self.elapsed = max(time.time(), deadline) - start
+        self.running = False
+        self.logger.info("Done: " + self.summary())
+
+    def kill(self):
+        """
+        Stop sending at the next burst
+        """
+        self.running = False
+
+    def achieved_pps(self):
+        """
+        Return the achieved frame rate
+        """
+        if self.elapsed <= 0:
+            return 0.0
+        return self.frames_sent / self.elapsed
+
+    def achieved_bps(self):
+        """
+        Return the achieved bit rate, counting overhead as for bps
+        """
+        if self.elapsed <= 0:
+            return 0.0
+        bits = (self.bytes_sent + self.frames_sent * self.overhead) * 8
+        return bits / self.elapsed
+
+    def summary(self):
+        """
+        Return a one line string of requested versus achieved rate
+        """
+        if self.pps is not None:
+            return "requested %d pps, achieved %.1f pps (%d frames in %.3fs)" \
+                % (self.pps, self.achieved_pps(), self.frames_sent,
+                   self.elapsed)
+        return "requested %d bps, achieved %.1f bps (%d frames in %.3fs)" \
+            % (self.bps, self.achieved_bps(), self.frames_sent, self.elapsed)
+
+    def __str__(self):
+        string = "TrafficGen:\n"
+        string += "  requested pps   " + str(self.pps) + "\n"
+        string += "  requested bps   " + str(self.bps) + "\n"
+        string += "  achieved pps    " + "%.1f" % self.achieved_pps() + "\n"
+        string += "  achieved bps    " + "%.1f" % self.achieved_bps() + "\n"
+        string += "  burst           " + str(self.burst) + "\n"
+        string += "  frames sent     " + str(self.frames_sent) + "\n"
+        string += "  bytes sent      " + str(self.bytes_sent) + "\n"
+        string += "  frames short    " + str(self.frames_short) + "\n"
+        string += "  elapsed         " + "%.3f" % self.elapsed + "\n"
+        return string
+
+    def show(self):
+        print str(self)
@@ -72,6 +72,7 @@ import oftest.dataplane   as dataplane
 import oftest.action      as action
 import oftest.action_list as action_list
 import oftest.parse       as parse
+import oftest.flowinstall as flowinstall
 import pktact
 import basic
 
@@ -1357,7 +1358,7 @@ class Switch:
                 break                   # No more responses expected
         return (n > 0)
 
-    def flow_add(self, flow_cfg, overlapf = False):
+    def _flow_mod_build(self, flow_cfg, overlapf):
         flow_mod_msg = message.flow_mod()
         flow_mod_msg.command     = ofp.OFPFC_ADD
         flow_mod_msg.buffer_id   = 0xffffffff
@@ -1366,12 +1367,35 @@ class Switch:
             flow_mod_msg.flags = flow_mod_msg.flags | ofp.OFPFF_CHECK_OVERLAP
         if flow_cfg.send_rem:
             flow_mod_msg.flags = flow_mod_msg.flags | ofp.OFPFF_SEND_FLOW_REM
+        return flow_mod_msg
+
+    def flow_add(self, flow_cfg, overlapf = False):
+        flow_mod_msg = self._flow_mod_build(flow_cfg, overlapf)
         flow_mod_msg.header.xid = random.randrange(1,0xffffffff)
         logging.info("Sending flow_mod(add), xid=%d"
                         % (flow_mod_msg.header.xid)
                         )
         return (self.controller.message_send(flow_mod_msg) != -1)
 
+    def flow_add_bulk(self, flow_cfgs, overlapf = False):
+        # Add many flows with windowed barriers; errors are correlated
+        # to flows by xid and added to error_msgs
+        def flow_mod_msgs():
+            for flow_cfg in flow_cfgs:
+                logging.info("Adding flow:")
+                logging.info(str(flow_cfg))
+                yield self._flow_mod_build(flow_cfg, overlapf)
+        installer = flowinstall.FlowInstaller(self.controller, timeout=30)
+        installer.install(flow_mod_msgs())
+        logging.info(str(installer))
+        for (index, flow_mod_msg, err) in installer.errors:
+            logging.info("Got an ERROR message for flow_mod xid=%d,"
+                         " type=%d, code=%d"
+                         % (flow_mod_msg.header.xid, err.type, err.code)
+                         )
+            self.error_msgs.append(err)
+        return (installer.unconfirmed == 0)
+
     def flow_mod(self, flow_cfg, strictf):
         flow_mod_msg = message.flow_mod()
         flow_mod_msg.command     = ofp.OFPFC_MODIFY_STRICT if strictf \
@@ -1616,14 +1640,8 @@ class Flow_Add_5(basic.SimpleProtocol):
         # Send flow table to switch
 
         logging.info("Sending flow adds to switch")
-        for fc in ft.values():          # Randomizes order of sending
-            logging.info("Adding flow:")
-            logging.info(str(fc));
-            self.assertTrue(sw.flow_add(fc), "Failed to add flow")
-
-        # Do barrier, to make sure all flows are in
-
-        self.assertTrue(sw.barrier(), "Barrier failed")
+        # Randomizes order of sending
+        self.assertTrue(sw.flow_add_bulk(ft.values()), "Failed to add flows")
 
         result = True
 
@@ -26,6 +26,7 @@ import oftest.message as message
 import oftest.dataplane as dataplane
 import oftest.action as action
 import oftest.parse as parse
+import oftest.msgtemplate as msgtemplate
 import basic
 import time
 
@@ -92,8 +93,10 @@ class LoadBarrier(basic.SimpleProtocol):
         rv = self.controller.message_send(msg)
         self.assertTrue(rv == 0, "Error sending out message")
 
+        barrier = msgtemplate.MessageTemplate(message.barrier_request())
         for idx in range(0, barrier_count):
-            self.assertEqual(do_barrier(self.controller), 0, "Barrier failed")
+            (resp, pkt) = self.controller.transact(barrier.stamp())
+            self.assertTrue(resp is not None, "Barrier failed")
             # To do:  Add some interesting functionality here
             logging.info("Barrier %d completed" % idx)
 
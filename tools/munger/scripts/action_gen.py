@@ -72,6 +72,7 @@ class action_--TYPE--(--PARENT_TYPE--):
 
     --DOC_INFO--
     \"""
+    __slots__ = []
     def __init__(self):
         --PARENT_TYPE--.__init__(self)
         self.type = --ACTION_NAME--
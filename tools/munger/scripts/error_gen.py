@@ -35,6 +35,7 @@ class --TYPE--_error_msg(ofp_error_msg):
     @arg data: Binary string following message members
     
     \"""
+    __slots__ = ['header', 'data']
     def __init__(self):
         ofp_error_msg.__init__(self)
         self.header = ofp_header()
@@ -67,12 +68,15 @@ class --TYPE--_error_msg(ofp_error_msg):
         return outstr
 
     def __eq__(self, other):
-        if type(self) != type(other): return False
+        if type(self) != type(other): return NotImplemented
         return (self.header == other.header and
                 ofp_error_msg.__eq__(self, other) and
                 self.data == other.data)
 
-    def __ne__(self, other): return not self.__eq__(other)
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        if eq is NotImplemented: return eq
+        return not eq
 """
 
 error_types = [
@@ -270,7 +270,7 @@ def gen_message_wrapper(msg):
     if has_core_members:
         print "class " + msg + "(" + parent + "):"
     else:
-        print "class " + msg + ":"
+        print "class " + msg + "(ofp_base):"
     _p1('"""')
     _p1("Wrapper class for " + msg)
     print
@@ -294,6 +294,12 @@ def gen_message_wrapper(msg):
         _p1("@arg data: Binary string following message members")
     print
     _p1('"""')
+    slots = ['header']
+    if has_list:
+        slots.append(list_var)
+    if has_string:
+        slots.append('data')
+    _p1("__slots__ = " + str(slots))
 
     print
     _p1("def __init__(self):")
@@ -444,7 +450,7 @@ def gen_message_wrapper(msg):
         @param other Other object in comparison
 
         \"""
-        if type(self) != type(other): return False
+        if type(self) != type(other): return NotImplemented
         if not self.header.__eq__(other.header): return False
 """
     if has_core_members:
@@ -463,7 +469,9 @@ def gen_message_wrapper(msg):
         @param other Other object in comparison
 
         \"""
-        return not self.__eq__(other)
+        eq = self.__eq__(other)
+        if eq is NotImplemented: return eq
+        return not eq
     """
 
 
@@ -479,10 +487,11 @@ extra_ofp_stats_req_defs = """
 # Stats request bodies for desc and table stats are not defined in the
 # OpenFlow header;  We define them here.  They are empty classes, really
 
-class ofp_desc_stats_request:
+class ofp_desc_stats_request(ofp_base):
     \"""
     Forced definition of ofp_desc_stats_request (empty class)
     \"""
+    __slots__ = []
     def __init__(self):
         pass
     def pack(self, assertstruct=True):
@@ -494,16 +503,19 @@ class ofp_desc_stats_request:
     def show(self, prefix=''):
         return prefix + "ofp_desc_stats_request (empty)\\n"
     def __eq__(self, other):
-        return type(self) == type(other)
+        if type(self) != type(other): return NotImplemented
+        return True
     def __ne__(self, other):
-        return type(self) != type(other)
+        if type(self) != type(other): return NotImplemented
+        return False
 
 OFP_DESC_STATS_REQUEST_BYTES = 0
 
-class ofp_table_stats_request:
+class ofp_table_stats_request(ofp_base):
     \"""
     Forced definition of ofp_table_stats_request (empty class)
     \"""
+    __slots__ = []
     def __init__(self):
         pass
     def pack(self, assertstruct=True):
@@ -515,9 +527,11 @@ class ofp_table_stats_request:
     def show(self, prefix=''):
         return prefix + "ofp_table_stats_request (empty)\\n"
     def __eq__(self, other):
-        return type(self) == type(other)
+        if type(self) != type(other): return NotImplemented
+        return True
     def __ne__(self, other):
-        return type(self) != type(other)
+        if type(self) != type(other): return NotImplemented
+        return False
 
 OFP_TABLE_STATS_REQUEST_BYTES = 0
 
@@ -528,6 +542,7 @@ class --TYPE--_stats_request(ofp_stats_request, ofp_--TYPE--_stats_request):
     \"""
     Wrapper class for --TYPE-- stats request message
     \"""
+    __slots__ = ['header']
     def __init__(self):
         self.header = ofp_header()
         ofp_stats_request.__init__(self)
@@ -563,12 +578,15 @@ class --TYPE--_stats_request(ofp_stats_request, ofp_--TYPE--_stats_request):
         return outstr
 
     def __eq__(self, other):
-        if type(self) != type(other): return False
+        if type(self) != type(other): return NotImplemented
         return (self.header == other.header and
                 ofp_stats_request.__eq__(self, other) and
                 ofp_--TYPE--_stats_request.__eq__(self, other))
 
-    def __ne__(self, other): return not self.__eq__(other)
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        if eq is NotImplemented: return eq
+        return not eq
 """
 
 ################################################################
@@ -586,6 +604,7 @@ class --TYPE--_stats_reply(ofp_stats_reply):
     \"""
     Wrapper class for --TYPE-- stats reply
     \"""
+    __slots__ = ['header', 'stats']
     def __init__(self):
         self.header = ofp_header()
         ofp_stats_reply.__init__(self)
@@ -606,13 +625,15 @@ class --TYPE--_stats_reply(ofp_stats_reply):
         binary_string = self.header.unpack(binary_string)
         binary_string = ofp_stats_reply.unpack(self, binary_string)
         dummy = --TYPE--_stats_entry()
-        while len(binary_string) >= len(dummy):
+        # Entries are unpacked in place rather than by slicing
+        offset = 0
+        while len(binary_string) - offset >= len(dummy):
             obj = --TYPE--_stats_entry()
-            binary_string = obj.unpack(binary_string)
+            offset = obj.unpack_from(binary_string, offset)
             self.stats.append(obj)
-        if len(binary_string) != 0:
+        if offset != len(binary_string):
             print "ERROR unpacking --TYPE-- stats string: extra bytes"
-        return binary_string
+        return binary_string[offset:]
 
     def __len__(self):
         length = len(self.header) + OFP_STATS_REPLY_BYTES
@@ -631,12 +652,15 @@ class --TYPE--_stats_reply(ofp_stats_reply):
         return outstr
 
     def __eq__(self, other):
-        if type(self) != type(other): return False
+        if type(self) != type(other): return NotImplemented
         return (self.header == other.header and
                 ofp_stats_reply.__eq__(self, other) and
                 self.stats == other.stats)
 
-    def __ne__(self, other): return not self.__eq__(other)
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        if eq is NotImplemented: return eq
+        return not eq
 """
 
 #
@@ -667,6 +691,7 @@ class flow_stats_entry(ofp_flow_stats):
     \"""
     Special case flow stats entry to handle action list object
     \"""
+    __slots__ = ['actions']
     def __init__(self):
         ofp_flow_stats.__init__(self)
         self.actions = action_list()
@@ -689,6 +714,15 @@ class flow_stats_entry(ofp_flow_stats):
         binary_string = self.actions.unpack(binary_string, bytes=ai_len)
         return binary_string
 
+    def unpack_from(self, buffer, offset=0):
+        offset = ofp_flow_stats.unpack_from(self, buffer, offset)
+        ai_len = self.length - OFP_FLOW_STATS_BYTES
+        if ai_len < 0:
+            print("ERROR: flow_stats_entry unpack length too small",
+                  self.length)
+        offset = self.actions.unpack_from(buffer, offset, bytes=ai_len)
+        return offset
+
     def __len__(self):
         return OFP_FLOW_STATS_BYTES + len(self.actions)
 
@@ -699,11 +733,14 @@ class flow_stats_entry(ofp_flow_stats):
         return outstr
 
     def __eq__(self, other):
-        if type(self) != type(other): return False
+        if type(self) != type(other): return NotImplemented
         return (ofp_flow_stats.__eq__(self, other) and 
                 self.actions == other.actions)
 
-    def __ne__(self, other): return not self.__eq__(other)
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        if eq is NotImplemented: return eq
+        return not eq
 """
 
 stats_types = [
@@ -17,6 +17,9 @@ GEN_OBJ_EQUALITY = True
 # Generate object show functions
 GEN_OBJ_SHOW = True
 
+# Name of the class all generated structures derive from
+STRUCT_BASE = "ofp_base"
+
 # Generate lists of enum values
 GEN_ENUM_VALUES_LIST = False
 
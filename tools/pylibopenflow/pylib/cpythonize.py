@@ -40,6 +40,9 @@ class rules:
         self.excluded_macros = []
         ##Enforce mapping
         self.enforced_maps = {}
+        ##Structs generated without __slots__, e.g. those combined with
+        ##another struct by multiple inheritance
+        self.dict_structs = []
 
     def get_enforced_map(self, structname):
         """Get code to enforce mapping
@@ -76,6 +79,11 @@ class rules:
         """
         return not (name in self.excluded_macros)
 
+    def use_slots(self, structname):
+        """Check if struct should declare __slots__
+        """
+        return not (structname in self.dict_structs)
+
 class pythonizer:
     """Class that pythonize C structures
 
@@ -106,6 +114,11 @@ class pythonizer:
         code = []
         code.append("import struct")
         code.append("")
+        code.append("# Set to False to skip the sanity checks run by pack()")
+        code.append("struct_assert = True")
+        code.append("")
+        code.extend(self.pycode_base())
+        code.append("")
         if (preamble != None):
             fileRef = open(preamble,"r")
             for l in fileRef:
@@ -140,6 +153,34 @@ class pythonizer:
 
         return code
 
+    def pycode_base(self):
+        """Return Python code for the base class of all structs
+
+        Structs declare __slots__, so the base class provides the
+        __getstate__ and __setstate__ that pickle needs for them.
+        """
+        code = []
+        code.append("class "+STRUCT_BASE+"(object):")
+        code.append(self.tab+"\"\"\"Base class of the generated structs")
+        code.append("")
+        code.append(self.tab+"Pickles the members held in __slots__ of every class")
+        code.append(self.tab+"in the hierarchy, and __dict__ if there is one.")
+        code.append(self.tab+"\"\"\"")
+        code.append(self.tab+"__slots__ = ()")
+        code.append("")
+        code.append(self.tab+"def __getstate__(self):")
+        code.append(self.tab*2+"state = getattr(self, \"__dict__\", {}).copy()")
+        code.append(self.tab*2+"for cls in type(self).__mro__:")
+        code.append(self.tab*3+"for name in cls.__dict__.get(\"__slots__\", ()):")
+        code.append(self.tab*4+"if hasattr(self, name):")
+        code.append(self.tab*5+"state[name] = getattr(self, name)")
+        code.append(self.tab*2+"return state")
+        code.append("")
+        code.append(self.tab+"def __setstate__(self, state):")
+        code.append(self.tab*2+"for (name, value) in state.items():")
+        code.append(self.tab*3+"setattr(self, name, value)")
+        return code
+
     def pycode_enum(self, name, enum):
         """Return Python array for enum
         """
@@ -203,15 +244,25 @@ class pythonizer:
 
         code=[]
         self.__assertcode = []
+        layout = self.struct_layout(struct_in)
+        if (layout != None):
+            code.append(self.struct_codec_name(struct_in)+" = struct.Struct(\"!"+
+                        layout[0]+"\")")
         code.extend(self.codeheader(struct_in))
         code.extend(self.codeinit(struct_in))
         code.append("")
         code.extend(self.codeassert(struct_in))
         code.append("")
-        code.extend(self.codepack(struct_in))
-        code.append("")
-        code.extend(self.codeunpack(struct_in))
-        code.append("")
+        if (layout != None):
+            code.extend(self.codepack_compiled(struct_in, layout))
+            code.append("")
+            code.extend(self.codeunpack_compiled(struct_in, layout))
+            code.append("")
+        else:
+            code.extend(self.codepack(struct_in))
+            code.append("")
+            code.extend(self.codeunpack(struct_in))
+            code.append("")
         code.extend(self.codelen(struct_in))
         code.append("")
         if GEN_OBJ_EQUALITY:
@@ -226,7 +277,7 @@ class pythonizer:
         """Return Python code for header
         """
         code=[]
-        code.append("class "+struct_in.typename+":")
+        code.append("class "+struct_in.typename+"("+STRUCT_BASE+"):")
         code.append(self.tab+"\"\"\"Automatically generated Python class for "+struct_in.typename)
         code.append("")
         code.append(self.tab+"Date "+str(datetime.date.today()))
@@ -236,6 +287,9 @@ class pythonizer:
         if IGNORE_ZERO_ARRAYS:
             code.append(self.tab+"Does not include var-length arrays")
         code.append(self.tab+"\"\"\"")
+        if self.rules.use_slots(struct_in.typename):
+            code.append(self.tab+"__slots__ = "+
+                        str([member.name for member in struct_in.members]))
         return code
 
     def codeinit(self, struct_in):
@@ -354,7 +408,7 @@ class pythonizer:
         code.append(self.tab*2+"\"\"\"Pack message")
         code.append(self.tab*2+"Packs empty array used as placeholder")
         code.append(self.tab*2+"\"\"\"")
-        code.append(self.tab*2+"if(assertstruct):")
+        code.append(self.tab*2+"if(assertstruct and struct_assert):")
         code.extend(self.__addassert(self.tab*3))
         code.append(self.tab*2+"packed = \"\"")
         primPattern = ""
@@ -408,6 +462,132 @@ class pythonizer:
         code.append(self.tab*2+"return packed")
         return code
 
+    def struct_codec_name(self, struct_in):
+        """Return name of the module level struct.Struct for struct_in
+        """
+        return "_"+struct_in.typename+"_struct"
+
+    def struct_layout(self, struct_in, name="self"):
+        """Return the fixed length layout of struct_in, flattened
+
+        Returns (pattern, fields, strings) where pattern is a struct
+        pattern covering every fixed length member, including those of
+        nested structs and arrays, fields is the list of expressions
+        for the items in pattern and strings lists the char array
+        expressions among them.  Variable length arrays are left out
+        as by pack and unpack.  Returns None if the struct cannot be
+        done with one struct.Struct: it has no fixed members, or a
+        variable length array is not the last member.
+        """
+        pattern = ""
+        fields = []
+        strings = []
+        members = struct_in.members
+        for member in members:
+            mname = name+"."+member.name
+            if (isinstance(member, cheader.carray) and member.size == 0):
+                if (member is not members[-1] or name != "self"):
+                    return None
+            elif (isinstance(member, cheader.cprimitive)):
+                pattern += self.__c2py.structmap[member.typename]
+                fields.append(mname)
+            elif (isinstance(member, cheader.cstruct)):
+                sub = self.struct_layout(member, mname)
+                if (sub == None):
+                    return None
+                pattern += sub[0]
+                fields.extend(sub[1])
+                strings.extend(sub[2])
+            elif (isinstance(member, cheader.carray) and member.typename == "char"):
+                pattern += str(member.size)+"s"
+                fields.append(mname)
+                strings.append(mname)
+            elif (isinstance(member, cheader.carray) and \
+                  isinstance(member.object, cheader.cprimitive)):
+                pattern += self.__c2py.structmap[member.object.typename]*member.size
+                for x in range(0, member.size):
+                    fields.append(mname+"["+str(x)+"]")
+            elif (isinstance(member, cheader.carray) and \
+                  isinstance(member.object, cheader.cstruct)):
+                for x in range(0, member.size):
+                    sub = self.struct_layout(member.object,
+                                             mname+"["+str(x)+"]")
+                    if (sub == None):
+                        return None
+                    pattern += sub[0]
+                    fields.extend(sub[1])
+                    strings.extend(sub[2])
+            else:
+                return None
+        if (len(fields) == 0):
+            return None
+        return (pattern, fields, strings)
+
+    def codepack_compiled(self, struct_in, layout):
+        """Return code that packs struct with its precompiled struct.Struct
+        """
+        codec = self.struct_codec_name(struct_in)
+        (pattern, fields, strings) = layout
+        size = struct.calcsize("!"+pattern)
+        args = ", ".join(fields)
+        code = []
+        code.append(self.tab+"def pack(self, assertstruct=True):")
+        code.append(self.tab*2+"\"\"\"Pack message")
+        code.append(self.tab*2+"Packs empty array used as placeholder")
+        code.append(self.tab*2+"\"\"\"")
+        code.append(self.tab*2+"if(assertstruct and struct_assert):")
+        code.extend(self.__addassert(self.tab*3))
+        code.append(self.tab*2+"packed = "+codec+".pack("+args+")")
+        member = struct_in.members[-1]
+        if (isinstance(member, cheader.carray) and member.size == 0):
+            if (isinstance(member.object, cheader.cstruct)):
+                code.append(self.tab*2+"for i in self."+member.name+":")
+                code.append(self.tab*3+"packed += i.pack(assertstruct)")
+            elif (member.typename != "char"):
+                code.append(self.tab*2+"for i in self."+member.name+":")
+                code.append(self.tab*3+"packed += struct.pack(\"!"+\
+                            self.__c2py.get_pattern(member.object)+"\",i)")
+        code.append(self.tab*2+"return packed")
+        code.append("")
+        code.append(self.tab+"def pack_into(self, buffer, offset=0):")
+        code.append(self.tab*2+"\"\"\"Pack fixed length members into buffer at offset")
+        code.append(self.tab*2+"Does not run sanity checks or pack var-length arrays")
+        code.append(self.tab*2+"Return offset following the packed members")
+        code.append(self.tab*2+"\"\"\"")
+        code.append(self.tab*2+codec+".pack_into(buffer, offset, "+args+")")
+        code.append(self.tab*2+"return offset + "+str(size))
+        return code
+
+    def codeunpack_compiled(self, struct_in, layout):
+        """Return code that unpacks struct with its precompiled struct.Struct
+        """
+        codec = self.struct_codec_name(struct_in)
+        (pattern, fields, strings) = layout
+        size = struct.calcsize("!"+pattern)
+        targets = "("+", ".join(fields)+",)"
+        code = []
+        code.append(self.tab+"def unpack(self, binaryString):")
+        code.append(self.tab*2+"\"\"\"Unpack message")
+        code.append(self.tab*2+"Do not unpack empty array used as placeholder")
+        code.append(self.tab*2+"since they can contain heterogeneous type")
+        code.append(self.tab*2+"\"\"\"")
+        code.append(self.tab*2+"if (len(binaryString) < "+str(size)+"):")
+        code.append(self.tab*3+"return binaryString")
+        code.append(self.tab*2+targets+" = "+codec+".unpack_from(binaryString)")
+        for name in strings:
+            code.append(self.tab*2+name+" = "+name+".replace(\"\\0\",\"\")")
+        code.append(self.tab*2+"return binaryString["+str(size)+":]")
+        code.append("")
+        code.append(self.tab+"def unpack_from(self, buffer, offset=0):")
+        code.append(self.tab*2+"\"\"\"Unpack fixed length members from buffer at offset")
+        code.append(self.tab*2+"Return offset following the unpacked members")
+        code.append(self.tab*2+"\"\"\"")
+        code.append(self.tab*2+targets+" = "+codec+".unpack_from(buffer, offset)")
+        for name in strings:
+            code.append(self.tab*2+name+" = "+name+".replace(\"\\0\",\"\")")
+        code.append(self.tab*2+"return offset + "+str(size))
+        return code
+
     def __codepackprimitive(self, code, primPattern, primMemberNames, prefix):
         """Return code for packing primitives
         """
@@ -447,13 +627,18 @@ class pythonizer:
         code.append(self.tab+"def __eq__(self, other):")
         code.append(self.tab*2+"\"\"\"Return True if self and other have same values")
         code.append(self.tab*2+"\"\"\"")
-        code.append(self.tab*2+"if type(self) != type(other): return False")
+        # NotImplemented lets the other operand, e.g. a lazily parsed
+        # message, compare itself
+        code.append(self.tab*2+"if type(self) != type(other): return NotImplemented")
         for member in struct_in.members:
             code.append(self.tab*2 + "if self." + member.name + " !=  other." +
                         member.name + ": return False")
         code.append(self.tab*2+"return True")
         code.append("")
-        code.append(self.tab+"def __ne__(self, other): return not self.__eq__(other)")
+        code.append(self.tab+"def __ne__(self, other):")
+        code.append(self.tab*2+"eq = self.__eq__(other)")
+        code.append(self.tab*2+"if eq is NotImplemented: return eq")
+        code.append(self.tab*2+"return not eq")
         return code
 
     def codeshow(self, struct_in):
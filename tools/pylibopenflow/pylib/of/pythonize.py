@@ -41,6 +41,12 @@ class rules(cpythonize.rules):
         elif GEN_ENUM_DICTIONARY:
             self.enforced_maps['ofp_header'] = \
                 [ ('type','ofp_type_map.keys()') ]
+        ##Stats request bodies are combined with ofp_stats_request by
+        ##multiple inheritance, which only one slotted base allows
+        self.dict_structs = ['ofp_aggregate_stats_request',
+                             'ofp_flow_stats_request',
+                             'ofp_port_stats_request',
+                             'ofp_queue_stats_request']
         
 class pythonizer(cpythonize.pythonizer):
     """Class that pythonize C structures of OpenFlow messages
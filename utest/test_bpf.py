@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+"""
+Unit tests for in-kernel dataplane filters
+
+Needs root to create a veth pair; skipped otherwise.
+"""
+
+import os
+import sys
+import time
+import unittest
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                '../src/python'))
+
+from oftest import bpf
+from oftest import dataplane
+from oftest import pkttemplate
+
+VETH = ("utbpf0", "utbpf1")
+
+def veth_create():
+    """
+    Create the test veth pair; return False if that is not possible
+    """
+    if os.geteuid() != 0:
+        return False
+    devnull = open(os.devnull, "w")
+    subprocess.call(["ip", "link", "del", VETH[0]],
+                    stdout=devnull, stderr=devnull)
+    cmds = [["ip", "link", "add", VETH[0], "type", "veth",
+             "peer", "name", VETH[1]]]
+    for intf in VETH:
+        cmds.append(["sysctl", "-q", "-w",
+                     "net.ipv6.conf.%s.disable_ipv6=1" % intf])
+        cmds.append(["ip", "link", "set", intf, "up"])
+    for cmd in cmds:
+        if subprocess.call(cmd, stdout=devnull, stderr=devnull) != 0:
+            return False
+    return True
+
+class BpfExpPktTest(unittest.TestCase):
+    def setUp(self):
+        if not veth_create():
+            self.skipTest("cannot create veth pair")
+        self.dp = dataplane.DataPlane()
+        self.dp.port_add(VETH[0], 1)
+        self.dp.port_add(VETH[1], 2)
+
+    def tearDown(self):
+        if hasattr(self, "dp"):
+            self.dp.kill()
+        subprocess.call(["ip", "link", "del", VETH[0]])
+
+    def test_masked_ttl(self):
+        pkt = pkttemplate.tcp_template(ip_dst="192.168.0.2")
+        exp = dataplane.MaskedPacket(pkt, dont_care=["ip_ttl", "checksums"])
+        self.dp.filter_set(port_number=2, exp_pkts=[exp])
+
+        # The TTL and IP checksum bytes differ from the template, as
+        # after a decrement by the switch
+        l3 = 14
+        rewritten = bytearray(str(pkt))
+        rewritten[l3 + 8] = 63
+        rewritten[l3 + 10] ^= 0xff
+        rewritten = str(rewritten)
+        other = pkttemplate.tcp_template(ip_dst="192.168.0.3")
+
+        self.dp.send(1, str(other))
+        self.dp.send(1, rewritten)
+        time.sleep(0.2)
+        rcv = [pkt for (pkt, t) in self.dp.port_list[2].packets]
+        self.assertEqual(rcv, [rewritten])
+        self.assertTrue(exp.matches(rcv[0]))
+
+    def test_exact(self):
+        pkt = pkttemplate.tcp_template(ip_dst="192.168.0.2")
+        self.dp.filter_set(port_number=2, exp_pkts=[pkt])
+        rewritten = bytearray(str(pkt))
+        rewritten[14 + 8] = 63
+        self.dp.send(1, str(rewritten))
+        self.dp.send(1, str(pkt))
+        time.sleep(0.2)
+        rcv = [pkt for (pkt, t) in self.dp.port_list[2].packets]
+        self.assertEqual(rcv, [str(pkt)])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+"""
+Unit tests for scapy-free packet templates
+
+Frames are compared with those of the testutils builders, so scapy and
+the generated OpenFlow modules are needed; skipped otherwise.
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                '../src/python'))
+
+from oftest import pkttemplate
+
+try:
+    import oftest.testutils as testutils
+    import scapy.all
+except ImportError:
+    testutils = None
+
+class MinsizeTest(unittest.TestCase):
+    def setUp(self):
+        if testutils is None:
+            self.skipTest("testutils or scapy not available")
+        self.saved = testutils.MINSIZE
+
+    def tearDown(self):
+        if testutils is not None:
+            testutils.MINSIZE = self.saved
+
+    def check(self, minsize):
+        testutils.MINSIZE = minsize
+        cases = [(pkttemplate.tcp_template, testutils.simple_tcp_packet),
+                 (pkttemplate.icmp_template, testutils.simple_icmp_packet),
+                 (pkttemplate.eth_template, testutils.simple_eth_packet)]
+        for (template, simple) in cases:
+            for pktlen in [60, 100]:
+                self.assertEqual(str(template(pktlen=pktlen)),
+                                 str(simple(pktlen=pktlen)))
+                self.assertEqual(len(template(pktlen=pktlen)),
+                                 max(pktlen, minsize))
+
+    def test_default(self):
+        self.check(0)
+
+    def test_minsize(self):
+        self.check(80)
+
+if __name__ == "__main__":
+    unittest.main()